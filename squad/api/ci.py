@@ -1,13 +1,17 @@
+import json
+import re
+from collections import OrderedDict
 from django.core.exceptions import PermissionDenied
-from django.http import HttpResponse, HttpResponseBadRequest
+from django.db import connection, transaction
+from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 
 from squad.http import auth_write, read_file_upload
 from squad.ci import models
-from squad.ci.tasks import submit
+from squad.ci.tasks import submit, submit_batch
 from squad.ci.models import Backend, TestJob
-from squad.core.models import Project
+from squad.core.models import Project, slug_pattern
 
 
 @require_http_methods(["POST"])
@@ -56,6 +60,83 @@ def submit_job(request, group_slug, project_slug, version, environment_slug):
     return HttpResponse(test_job.id, status=201)
 
 
+@require_http_methods(["POST"])
+@csrf_exempt
+@auth_write
+def submit_jobs(request, group_slug, project_slug, version):
+    # project has to exist or request will result with 404
+    project = Project.objects.get(slug=project_slug, group__slug=group_slug)
+
+    # the list of jobs can be received as a file upload or as a POST parameter
+    if 'jobs' in request.FILES:
+        jobs = read_file_upload(request.FILES['jobs']).decode('utf-8')
+    else:
+        jobs = request.POST.get('jobs')
+    if jobs is None:
+        return HttpResponseBadRequest("jobs field is required")
+    try:
+        jobs = json.loads(jobs)
+    except ValueError as e:
+        return HttpResponseBadRequest("invalid jobs: %s" % str(e))
+    if not isinstance(jobs, list) or not all(isinstance(job, dict) for job in jobs):
+        return HttpResponseBadRequest("jobs must be a list of objects")
+
+    backends = {}
+    for job in jobs:
+        backend_name = job.get('backend', request.POST.get('backend'))
+        if backend_name is None:
+            return HttpResponseBadRequest("backend field is required")
+        if backend_name not in backends:
+            try:
+                backends[backend_name] = Backend.objects.get(name=backend_name)
+            except Backend.DoesNotExist:
+                return HttpResponseBadRequest("requested backend does not exist")
+        definition = job.get('definition')
+        if not definition:
+            return HttpResponseBadRequest("test job definition is required")
+        if not isinstance(definition, str):
+            return HttpResponseBadRequest("test job definition must be a string")
+        environment = job.get('environment')
+        if not isinstance(environment, str) or not re.match('^%s$' % slug_pattern, environment):
+            return HttpResponseBadRequest("invalid environment: %s" % environment)
+        job['backend'] = backends[backend_name]
+
+    # create Build object
+    build, _ = project.builds.get_or_create(version=version)
+
+    # bulk_create does not call save(), so fields that it would fill in must
+    # be set here
+    test_jobs = [
+        TestJob(
+            backend=job['backend'],
+            definition=job['definition'],
+            target=project,
+            build=version,
+            target_build=build,
+            environment=job['environment'],
+        )
+        for job in jobs
+    ]
+    with transaction.atomic():
+        if connection.features.can_return_ids_from_bulk_insert:
+            # e.g. PostgreSQL: a single INSERT, which sets the ids
+            TestJob.objects.bulk_create(test_jobs)
+        else:
+            # the ids of rows inserted in bulk are not known
+            for test_job in test_jobs:
+                test_job.save()
+
+    # schedule submission, in one task per backend
+    batches = OrderedDict()
+    for test_job in test_jobs:
+        batches.setdefault(test_job.backend_id, []).append(test_job.id)
+    for job_ids in batches.values():
+        submit_batch.delay(job_ids)
+
+    # return IDs of test jobs, in the same order as the input
+    return JsonResponse([test_job.id for test_job in test_jobs], safe=False, status=201)
+
+
 @require_http_methods(["POST"])
 @csrf_exempt
 @auth_write
@@ -1,15 +1,23 @@
 import json
+import sys
 import yaml
+from collections import OrderedDict
 
 from django.contrib.auth.models import Group as UserGroup
 from squad.core.models import Group, Project, ProjectStatus, Build, TestRun, Environment, Test, Metric, EmailTemplate, KnownIssue, PatchSource, Suite
 from squad.core.notification import Notification
+from squad.core.queries import get_builds_results
+from squad.core.utils import join_name
 from squad.ci.models import Backend, TestJob
-from django.http import HttpResponse
+from django.core.exceptions import FieldDoesNotExist
+from django.http import HttpResponse, StreamingHttpResponse
+from django.middleware.gzip import re_accepts_gzip
 from django.urls import reverse
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_sequence
 from django import forms
 from rest_framework import routers, serializers, views, viewsets, status
-from rest_framework.decorators import detail_route
+from rest_framework.decorators import detail_route, list_route
 from rest_framework.exceptions import NotFound
 from rest_framework.response import Response
 from rest_framework.pagination import CursorPagination, PageNumberPagination
@@ -136,6 +144,20 @@ class APIRouter(routers.DefaultRouter):
 
 
 class ModelViewSet(viewsets.ModelViewSet):
+    """
+    Base class for the API viewsets.
+
+    For list and detail requests, clients can pass a comma-separated list of
+    fields to be included in the response in the `fields` parameter, and a
+    list of related objects to be included inline (instead of as links) in
+    the `expand` parameter, e.g. `/api/builds/?fields=id,version&expand=project`.
+
+    The relations to be loaded with `select_related()`/`prefetch_related()`,
+    and the columns to be loaded with `only()`, are derived from the fields
+    that will actually be serialized.
+    """
+
+    optimized_actions = ('list', 'retrieve')
 
     def get_project_ids(self):
         """
@@ -143,12 +165,149 @@ class ModelViewSet(viewsets.ModelViewSet):
         Returns a list of project ids to be used in get_queryset() for
         filtering.
         """
-        user = self.request.user
-        projects = Project.objects.accessible_to(user).values('id')
-        return [p['id'] for p in projects]
+        if getattr(self, '__project_ids__', None) is None:
+            user = self.request.user
+            self.__project_ids__ = Project.objects.accessible_ids(user)
+        return self.__project_ids__
+
+    def get_list_param(self, name):
+        value = self.request.query_params.get(name)
+        if not value:
+            return None
+        return [f.strip() for f in value.split(',') if f.strip()]
+
+    def get_serializer_context(self):
+        context = super(ModelViewSet, self).get_serializer_context()
+        if self.action in self.optimized_actions:
+            context['fields'] = self.get_list_param('fields')
+            context['expand'] = self.get_list_param('expand')
+        return context
+
+    def filter_queryset(self, queryset):
+        queryset = super(ModelViewSet, self).filter_queryset(queryset)
+        if self.action in self.optimized_actions:
+            queryset = self.optimize_queryset(queryset)
+        return queryset
+
+    def optimize_queryset(self, queryset):
+        serializer = self.get_serializer()
+        if not isinstance(serializer, DynamicFieldsMixin):
+            return queryset
+
+        only, select_related, prefetch_related = serializer.get_query_hints()
+        if select_related:
+            queryset = queryset.select_related(*select_related)
+        if prefetch_related:
+            queryset = queryset.prefetch_related(*prefetch_related)
+        if only and serializer.context.get('fields'):
+            queryset = queryset.only(*only)
+        return queryset
+
+
+class DynamicFieldsMixin(object):
+    """
+    Serializer mixin implementing the `fields` and `expand` parameters (see
+    ModelViewSet). Those only apply to the top-level serializer, i.e. never
+    to serializers for expanded objects.
+
+    Serializers can declare in their Meta class:
 
+    * `expandable_fields`: a mapping of related field names to the name of the
+      serializer class to use when expanding them.
+    * `field_dependencies`: a mapping of field names to the list of model
+      attributes needed to produce them, for fields that are not backed by a
+      model field (e.g. properties).
+    """
 
-class UserGroupSerializer(serializers.HyperlinkedModelSerializer):
+    def get_fields(self):
+        fields = super(DynamicFieldsMixin, self).get_fields()
+        if not self.is_toplevel:
+            return fields
+
+        requested = self.context.get('fields')
+        expand = self.context.get('expand') or []
+
+        expandable = getattr(self.Meta, 'expandable_fields', {})
+        for name in expand:
+            if name in expandable:
+                fields[name] = self.get_expanded_field(name, expandable[name])
+
+        if requested:
+            wanted = set(requested) | set(expand)
+            fields = OrderedDict((k, v) for k, v in fields.items() if k in wanted)
+        return fields
+
+    @property
+    def is_toplevel(self):
+        parent = self.parent
+        if isinstance(parent, serializers.ListSerializer):
+            parent = parent.parent
+        return parent is None
+
+    def get_expanded_field(self, name, serializer_name):
+        serializer_class = getattr(sys.modules[__name__], serializer_name)
+        model_field = self.Meta.model._meta.get_field(name)
+        many = model_field.many_to_many or model_field.one_to_many
+        return serializer_class(many=many, read_only=True)
+
+    def get_query_hints(self):
+        """
+        Returns a tuple (only, select_related, prefetch_related) with the
+        names to be passed to the corresponding QuerySet methods so that
+        serializing each object does not need any further queries. `only` is
+        None if the needed columns cannot be determined.
+        """
+        model = self.Meta.model
+        dependencies = getattr(self.Meta, 'field_dependencies', {})
+        only = set([model._meta.pk.name])
+        select_related = set()
+        prefetch_related = set()
+
+        for name, field in self.fields.items():
+            if field.write_only:
+                continue
+
+            nested = field
+            if isinstance(nested, serializers.ListSerializer):
+                nested = nested.child
+
+            if name in dependencies:
+                attrs = dependencies[name]
+                needs_object = True
+            elif field.source == '*':
+                attrs = []
+                needs_object = False
+            else:
+                attrs = [field.source.split('.')[0]]
+                needs_object = '.' in field.source or isinstance(nested, serializers.BaseSerializer)
+
+            for attr in attrs:
+                try:
+                    model_field = model._meta.get_field(attr)
+                except FieldDoesNotExist:
+                    only = None
+                    continue
+
+                if model_field.many_to_many or model_field.one_to_many:
+                    prefetch_related.add(attr)
+                    if isinstance(nested, DynamicFieldsMixin):
+                        _, nested_select, nested_prefetch = nested.get_query_hints()
+                        prefetch_related.update(attr + '__' + r for r in nested_select | nested_prefetch)
+                    continue
+
+                if only is not None:
+                    only.add(attr)
+                if model_field.is_relation and needs_object:
+                    select_related.add(attr)
+                    if isinstance(nested, DynamicFieldsMixin):
+                        _, nested_select, nested_prefetch = nested.get_query_hints()
+                        select_related.update(attr + '__' + r for r in nested_select)
+                        prefetch_related.update(attr + '__' + r for r in nested_prefetch)
+
+        return (only, select_related, prefetch_related)
+
+
+class UserGroupSerializer(DynamicFieldsMixin, serializers.HyperlinkedModelSerializer):
 
     url = serializers.HyperlinkedIdentityField(view_name='usergroups-detail')
 
@@ -157,7 +316,7 @@ class UserGroupSerializer(serializers.HyperlinkedModelSerializer):
         fields = ('id', 'name', 'url')
 
 
-class UserGroupViewSet(viewsets.ModelViewSet):
+class UserGroupViewSet(ModelViewSet):
     """
     List of user groups.
     """
@@ -168,7 +327,7 @@ class UserGroupViewSet(viewsets.ModelViewSet):
     ordering_fields = ('name',)
 
 
-class GroupSerializer(serializers.HyperlinkedModelSerializer):
+class GroupSerializer(DynamicFieldsMixin, serializers.HyperlinkedModelSerializer):
 
     id = serializers.IntegerField(read_only=True)
     user_groups = serializers.HyperlinkedRelatedField(
@@ -181,7 +340,7 @@ class GroupSerializer(serializers.HyperlinkedModelSerializer):
         fields = '__all__'
 
 
-class GroupViewSet(viewsets.ModelViewSet):
+class GroupViewSet(ModelViewSet):
     """
     List of groups. Includes public groups and groups that the current
     user has access to.
@@ -197,7 +356,7 @@ class GroupViewSet(viewsets.ModelViewSet):
 #        return self.queryset.accessible_to(self.request.user)
 
 
-class ProjectSerializer(serializers.HyperlinkedModelSerializer):
+class ProjectSerializer(DynamicFieldsMixin, serializers.HyperlinkedModelSerializer):
 
     builds = serializers.HyperlinkedIdentityField(
         view_name='project-builds',
@@ -208,27 +367,75 @@ class ProjectSerializer(serializers.HyperlinkedModelSerializer):
     class Meta:
         model = Project
         fields = '__all__'
+        expandable_fields = {
+            'group': 'GroupSerializer',
+        }
+        field_dependencies = {
+            'full_name': ['group', 'slug'],
+        }
 
 
 class LatestTestResults(object):
-    def __init__(self, build, test_name):
-        self.build = build
-        self.environments = build.project.environments.all()
+    """
+    Collects the results of a single test across a list of builds of the same
+    project, indexed by (build, environment). All the tests are loaded in a
+    single query, so that this can be used to serialize a whole page of builds
+    at once.
+    """
+
+    def __init__(self, builds, test_name):
+        self.builds = list(builds)
+        self.environments = []
+        self.results = {}
+        if not self.builds:
+            return
+
+        project = self.builds[0].project
+        self.environments = list(project.environments.order_by("name", "slug"))
         test_suite_name, test_case_name = test_name.split("/", 1)
-        self.test_list = Test.objects.filter(
-            test_run__build=self.build,
+        tests = Test.objects.filter(
+            test_run__build__in=self.builds,
             test_run__environment__in=self.environments,
             name=test_case_name,
-            suite__slug=test_suite_name)
+            suite__slug=test_suite_name,
+        ).select_related(
+            'suite',
+            'test_run',
+        ).prefetch_related(
+            'known_issues',
+        ).order_by('id')
+        for test in tests:
+            key = (test.test_run.build_id, test.test_run.environment_id)
+            self.results.setdefault(key, test)
 
+    def get(self, build, environment):
+        return self.results.get((build.id, environment.id))
 
-class LatestTestResultsSerializer(serializers.BaseSerializer):
-    def to_representation(self, obj):
+
+class LatestTestResultsListSerializer(serializers.ListSerializer):
+
+    def to_representation(self, data):
+        builds = list(data)
         test_name = self.context.get('test_name')
-        latest_result = LatestTestResults(obj, test_name)
+        self.child.latest_results = LatestTestResults(builds, test_name)
+        return super(LatestTestResultsListSerializer, self).to_representation(builds)
+
+
+class LatestTestResultsSerializer(serializers.BaseSerializer):
+
+    latest_results = None
+
+    class Meta:
+        list_serializer_class = LatestTestResultsListSerializer
+
+    def to_representation(self, build):
+        latest_results = self.latest_results
+        if latest_results is None:
+            latest_results = LatestTestResults([build], self.context.get('test_name'))
+        project = build.project
         environments = []
-        for environment in latest_result.environments.order_by("name", "slug"):
-            test = latest_result.test_list.filter(test_run__environment=environment).first()
+        for environment in latest_results.environments:
+            test = latest_results.get(build, environment)
             entry = {
                 'environment': EnvironmentSerializer(environment, context=self.context).data,
                 'test': TestSerializer(test, context=self.context).data,
@@ -238,27 +445,27 @@ class LatestTestResultsSerializer(serializers.BaseSerializer):
                     {'test_url_path': reverse(
                         'test_history',
                         args=[
-                            latest_result.build.project.group.slug,
-                            latest_result.build.project.slug,
+                            project.group.slug,
+                            project.slug,
                             test.full_name
                         ])}
                 )
             environments.append(entry)
         serialized_obj = {
-            'build': BuildSerializer(latest_result.build, context=self.context).data,
+            'build': BuildSerializer(build, context=self.context).data,
             'build_url_path': reverse(
                 'build',
                 args=[
-                    latest_result.build.project.group.slug,
-                    latest_result.build.project.slug,
-                    latest_result.build.version
+                    project.group.slug,
+                    project.slug,
+                    build.version
                 ]),
             'environments': environments
         }
         return serialized_obj
 
 
-class ProjectViewSet(viewsets.ModelViewSet):
+class ProjectViewSet(ModelViewSet):
     """
     List of projects. Includes public projects and projects that the current
     user has access to.
@@ -287,7 +494,7 @@ class ProjectViewSet(viewsets.ModelViewSet):
         """
         List of builds for the current project.
         """
-        builds = self.get_object().builds.prefetch_related('test_runs').order_by('-datetime')
+        builds = self.get_object().builds.select_related('status').order_by('-datetime')
         page = self.paginate_queryset(builds)
         serializer = BuildSerializer(page, many=True, context={'request': request})
         return self.get_paginated_response(serializer.data)
@@ -296,7 +503,8 @@ class ProjectViewSet(viewsets.ModelViewSet):
     def test_results(self, request, pk=None):
         test_name = request.query_params.get("test_name", None)
 
-        builds = self.get_object().builds.prefetch_related('test_runs').order_by('-datetime')
+        project = self.get_object()
+        builds = project.builds.prefetch_related('status').order_by('-datetime')
         page = self.paginate_queryset(builds)
         serializer = LatestTestResultsSerializer(
             page,
@@ -306,13 +514,13 @@ class ProjectViewSet(viewsets.ModelViewSet):
         return Response(serializer.data)
 
 
-class ProjectStatusSerializer(serializers.HyperlinkedModelSerializer):
+class ProjectStatusSerializer(DynamicFieldsMixin, serializers.HyperlinkedModelSerializer):
 
     def to_representation(self, instance):
         ret = super().to_representation(instance)
-        if instance.regressions is not None:
+        if ret.get('regressions') is not None:
             ret['regressions'] = json.dumps(yaml.load(ret['regressions']))
-        if instance.fixes is not None:
+        if ret.get('fixes') is not None:
             ret['fixes'] = json.dumps(yaml.load(ret['fixes']))
         return ret
 
@@ -332,9 +540,12 @@ class ProjectStatusSerializer(serializers.HyperlinkedModelSerializer):
                   'created_at',
                   'regressions',
                   'fixes')
+        expandable_fields = {
+            'build': 'BuildSerializer',
+        }
 
 
-class ProjectStatusViewSet(viewsets.ModelViewSet):
+class ProjectStatusViewSet(ModelViewSet):
     queryset = ProjectStatus.objects
     serializer_class = ProjectStatusSerializer
     filter_fields = ('build',)
@@ -343,7 +554,7 @@ class ProjectStatusViewSet(viewsets.ModelViewSet):
     ordering_fields = ('created_at', 'last_updated')
 
 
-class PatchSourceSerializer(serializers.HyperlinkedModelSerializer):
+class PatchSourceSerializer(DynamicFieldsMixin, serializers.HyperlinkedModelSerializer):
 
     class Meta:
         model = PatchSource
@@ -354,13 +565,13 @@ class PatchSourceSerializer(serializers.HyperlinkedModelSerializer):
         }
 
 
-class PatchSourceViewSet(viewsets.ModelViewSet):
+class PatchSourceViewSet(ModelViewSet):
     queryset = PatchSource.objects
     serializer_class = PatchSourceSerializer
     filter_fields = ('implementation', 'url', 'name')
 
 
-class BuildSerializer(serializers.HyperlinkedModelSerializer):
+class BuildSerializer(DynamicFieldsMixin, serializers.HyperlinkedModelSerializer):
     id = serializers.IntegerField(read_only=True)
     testruns = serializers.HyperlinkedIdentityField(view_name='build-testruns')
     testjobs = serializers.HyperlinkedIdentityField(view_name='build-testjobs')
@@ -371,6 +582,11 @@ class BuildSerializer(serializers.HyperlinkedModelSerializer):
     class Meta:
         model = Build
         fields = '__all__'
+        expandable_fields = {
+            'project': 'ProjectSerializer',
+            'status': 'ProjectStatusSerializer',
+            'patch_source': 'PatchSourceSerializer',
+        }
 
 
 class BuildViewSet(ModelViewSet):
@@ -378,7 +594,7 @@ class BuildViewSet(ModelViewSet):
     List of all builds in the system. Only builds belonging to public projects
     and to projects you have access to are available.
     """
-    queryset = Build.objects.prefetch_related('status', 'test_runs').order_by('-datetime').all()
+    queryset = Build.objects.order_by('-datetime').all()
     serializer_class = BuildSerializer
     filter_fields = ('version', 'project')
     filter_class = BuildFilter
@@ -388,6 +604,48 @@ class BuildViewSet(ModelViewSet):
     def get_queryset(self):
         return self.queryset.filter(project__in=self.get_project_ids())
 
+    MAX_RESULTS_BUILDS = 100
+
+    @list_route(methods=['get'], suffix='results')
+    def results(self, request):
+        """
+        Summary of test results for several builds at once, by environment
+        and suite. Takes either a comma-separated list of build ids in the
+        `builds` parameter, or a project id in the `project` parameter plus the
+        number of latest builds of that project in `last` (default: 10).
+        """
+        builds = self.get_queryset().only('id', 'version', 'datetime', 'project')
+        try:
+            if 'builds' in request.query_params:
+                ids = [int(i) for i in request.query_params['builds'].split(',') if i]
+                builds = builds.filter(id__in=ids[:self.MAX_RESULTS_BUILDS])
+            elif 'project' in request.query_params:
+                project_id = int(request.query_params['project'])
+                last = int(request.query_params.get('last', 10))
+                if last < 1:
+                    raise ValueError("`last` must be a positive integer")
+                last = min(last, self.MAX_RESULTS_BUILDS)
+                builds = builds.filter(project_id=project_id)[:last]
+            else:
+                data = {"message": "either `builds` or `project` must be specified"}
+                return Response(data, status=status.HTTP_400_BAD_REQUEST)
+        except ValueError as e:
+            return Response({"message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        builds = list(builds)
+        results = get_builds_results(builds)
+        data = [
+            {
+                'id': build.id,
+                'version': build.version,
+                'datetime': build.datetime,
+                'project': build.project_id,
+                'environments': results.get(build.id, {}),
+            }
+            for build in builds
+        ]
+        return Response({'results': data})
+
     @detail_route(methods=['get'], suffix='metadata')
     def metadata(self, request, pk=None):
         build = self.get_object()
@@ -409,6 +667,14 @@ class BuildViewSet(ModelViewSet):
         serializer = TestRunSerializer(page, many=True, context={'request': request})
         return self.get_paginated_response(serializer.data)
 
+    @detail_route(methods=['get'], suffix='tests stream')
+    def tests_stream(self, request, pk=None):
+        """
+        All tests of this build, as newline-delimited JSON.
+        """
+        build = self.get_object()
+        return stream_tests(request, Test.objects.filter(test_run__build=build))
+
     @detail_route(methods=['get'], suffix='test jobs')
     def testjobs(self, request, pk=None):
         testjobs = self.get_object().test_jobs.order_by('-id')
@@ -488,12 +754,15 @@ class BuildViewSet(ModelViewSet):
             return Response({}, status=status.HTTP_404_NOT_FOUND)
 
 
-class EnvironmentSerializer(serializers.HyperlinkedModelSerializer):
+class EnvironmentSerializer(DynamicFieldsMixin, serializers.HyperlinkedModelSerializer):
     id = serializers.IntegerField(read_only=True)
 
     class Meta:
         model = Environment
         fields = '__all__'
+        expandable_fields = {
+            'project': 'ProjectSerializer',
+        }
 
 
 class EnvironmentViewSet(ModelViewSet):
@@ -512,7 +781,7 @@ class EnvironmentViewSet(ModelViewSet):
         return self.queryset.filter(project__in=self.get_project_ids())
 
 
-class TestRunSerializer(serializers.HyperlinkedModelSerializer):
+class TestRunSerializer(DynamicFieldsMixin, serializers.HyperlinkedModelSerializer):
 
     id = serializers.IntegerField(read_only=True)
     tests_file = serializers.HyperlinkedIdentityField(view_name='testrun-tests-file')
@@ -525,23 +794,30 @@ class TestRunSerializer(serializers.HyperlinkedModelSerializer):
     class Meta:
         model = TestRun
         fields = '__all__'
+        expandable_fields = {
+            'build': 'BuildSerializer',
+            'environment': 'EnvironmentSerializer',
+        }
 
 
-class SuiteSerializer(serializers.ModelSerializer):
+class SuiteSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
 
     class Meta:
         model = Suite
         exclude = ('metadata',)
+        expandable_fields = {
+            'project': 'ProjectSerializer',
+        }
 
 
-class SuiteViewSet(viewsets.ModelViewSet):
+class SuiteViewSet(ModelViewSet):
 
     queryset = Suite.objects.all()
     serializer_class = SuiteSerializer
     filter_class = SuiteFilter
 
 
-class TestSerializer(serializers.ModelSerializer):
+class TestSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     name = serializers.CharField(source='full_name', read_only=True)
     short_name = serializers.CharField(source='name')
     status = serializers.CharField(read_only=True)
@@ -549,6 +825,14 @@ class TestSerializer(serializers.ModelSerializer):
     class Meta:
         model = Test
         exclude = ('test_run',)
+        expandable_fields = {
+            'suite': 'SuiteSerializer',
+            'known_issues': 'KnownIssueSerializer',
+        }
+        field_dependencies = {
+            'name': ['suite', 'name'],
+            'status': ['result', 'has_known_issues'],
+        }
 
 
 class TestViewSet(ModelViewSet):
@@ -563,6 +847,51 @@ class TestViewSet(ModelViewSet):
         return self.queryset.filter(test_run__build__project__in=self.get_project_ids())
 
 
+STREAM_CHUNK_SIZE = 1000
+
+
+def stream_tests(request, tests):
+    """
+    Returns a response that streams all the given tests as newline-delimited
+    JSON, one test per line. Tests are read with QuerySet.iterator(), i.e.
+    using a server-side cursor where the database supports it, so the whole
+    result set is never held in memory. The response is gzip-compressed if
+    the client accepts it.
+    """
+    rows = tests.order_by('id').values_list(
+        'suite__slug',
+        'name',
+        'test_run__environment__slug',
+        'result',
+        'has_known_issues',
+    ).iterator()
+
+    def ndjson():
+        lines = []
+        for suite, name, environment, result, has_known_issues in rows:
+            lines.append(json.dumps({
+                'name': join_name(suite, name),
+                'environment': environment,
+                'status': Test.get_status(result, has_known_issues),
+                'has_known_issues': bool(has_known_issues),
+            }))
+            if len(lines) == STREAM_CHUNK_SIZE:
+                yield ('\n'.join(lines) + '\n').encode('utf-8')
+                lines = []
+        if lines:
+            yield ('\n'.join(lines) + '\n').encode('utf-8')
+
+    content = ndjson()
+    gzip = re_accepts_gzip.search(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    if gzip:
+        content = compress_sequence(content)
+    response = StreamingHttpResponse(content, content_type='application/x-ndjson')
+    if gzip:
+        response['Content-Encoding'] = 'gzip'
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response
+
+
 class MetricSerializer(serializers.ModelSerializer):
     name = serializers.CharField(source='full_name', read_only=True)
     measurement_list = serializers.ListField(read_only=True)
@@ -619,10 +948,18 @@ class TestRunViewSet(ModelViewSet):
         testrun = self.get_object()
         return HttpResponse(testrun.log_file, content_type='text/plain')
 
+    @detail_route(methods=['get'], suffix='tests stream')
+    def tests_stream(self, request, pk=None):
+        """
+        All tests of this test run, as newline-delimited JSON.
+        """
+        testrun = self.get_object()
+        return stream_tests(request, testrun.tests.all())
+
     @detail_route(methods=['get'], suffix='tests')
     def tests(self, request, pk=None):
         testrun = self.get_object()
-        tests = testrun.tests.prefetch_related('suite').order_by('id')
+        tests = testrun.tests.select_related('suite').prefetch_related('known_issues').order_by('id')
         paginator = PageNumberPagination()
         page = paginator.paginate_queryset(tests, request)
         serializer = TestSerializer(page, many=True, context={'request': request})
@@ -631,14 +968,14 @@ class TestRunViewSet(ModelViewSet):
     @detail_route(methods=['get'], suffix='metrics')
     def metrics(self, request, pk=None):
         testrun = self.get_object()
-        metrics = testrun.metrics.prefetch_related('suite').order_by('id')
+        metrics = testrun.metrics.select_related('suite').order_by('id')
         paginator = PageNumberPagination()
         page = paginator.paginate_queryset(metrics, request)
         serializer = MetricSerializer(page, many=True, context={'request': request})
         return paginator.get_paginated_response(serializer.data)
 
 
-class BackendSerializer(serializers.ModelSerializer):
+class BackendSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     id = serializers.IntegerField(read_only=True)
 
     class Meta:
@@ -649,7 +986,7 @@ class BackendSerializer(serializers.ModelSerializer):
         }
 
 
-class BackendViewSet(viewsets.ModelViewSet):
+class BackendViewSet(ModelViewSet):
     """
     List of CI backends used.
     """
@@ -660,7 +997,7 @@ class BackendViewSet(viewsets.ModelViewSet):
     ordering_fields = ('id', 'implementation_type', 'name', 'url')
 
 
-class TestJobSerializer(serializers.HyperlinkedModelSerializer):
+class TestJobSerializer(DynamicFieldsMixin, serializers.HyperlinkedModelSerializer):
     url = serializers.HyperlinkedIdentityField(view_name='testjob-detail')
     external_url = serializers.CharField(source='url', read_only=True)
     definition = serializers.HyperlinkedIdentityField(view_name='testjob-definition')
@@ -668,6 +1005,15 @@ class TestJobSerializer(serializers.HyperlinkedModelSerializer):
     class Meta:
         model = TestJob
         fields = '__all__'
+        expandable_fields = {
+            'backend': 'BackendSerializer',
+            'target': 'ProjectSerializer',
+            'target_build': 'BuildSerializer',
+            'testrun': 'TestRunSerializer',
+        }
+        field_dependencies = {
+            'external_url': ['backend', 'job_id'],
+        }
 
 
 class TestJobViewSet(ModelViewSet):
@@ -675,7 +1021,7 @@ class TestJobViewSet(ModelViewSet):
     List of CI test jobs. Only testjobs for public projects, and for projects
     you have access to, are available.
     """
-    queryset = TestJob.objects.prefetch_related('backend').order_by('-id')
+    queryset = TestJob.objects.order_by('-id')
     serializer_class = TestJobSerializer
     filter_fields = (
         "name",
@@ -707,7 +1053,7 @@ class TestJobViewSet(ModelViewSet):
         return HttpResponse(definition, content_type='text/plain')
 
 
-class EmailTemplateSerializer(serializers.HyperlinkedModelSerializer):
+class EmailTemplateSerializer(DynamicFieldsMixin, serializers.HyperlinkedModelSerializer):
 
     id = serializers.IntegerField(read_only=True)
 
@@ -716,7 +1062,7 @@ class EmailTemplateSerializer(serializers.HyperlinkedModelSerializer):
         fields = '__all__'
 
 
-class EmailTemplateViewSet(viewsets.ModelViewSet):
+class EmailTemplateViewSet(ModelViewSet):
     """
     List of email templates used.
     """
@@ -726,7 +1072,7 @@ class EmailTemplateViewSet(viewsets.ModelViewSet):
     ordering_fields = ('name', 'id')
 
 
-class KnownIssueSerializer(serializers.HyperlinkedModelSerializer):
+class KnownIssueSerializer(DynamicFieldsMixin, serializers.HyperlinkedModelSerializer):
 
     id = serializers.IntegerField(read_only=True)
 
@@ -735,7 +1081,7 @@ class KnownIssueSerializer(serializers.HyperlinkedModelSerializer):
         fields = '__all__'
 
 
-class KnownIssueViewSet(viewsets.ModelViewSet):
+class KnownIssueViewSet(ModelViewSet):
 
     queryset = KnownIssue.objects.all()
     serializer_class = KnownIssueSerializer
@@ -17,6 +17,7 @@ urlpatterns = [
     url(r'^createbuild/(%s)/(%s)/(%s)' % ((slug_pattern,) * 3), views.create_build),
     url(r'^submit/(%s)/(%s)/(%s)/(%s)' % ((slug_pattern,) * 4), views.add_test_run),
     url(r'^submitjob/(%s)/(%s)/(%s)/(%s)' % ((slug_pattern,) * 4), ci.submit_job),
+    url(r'^submitjobs/(%s)/(%s)/(%s)' % ((slug_pattern,) * 3), ci.submit_jobs),
     url(r'^watchjob/(%s)/(%s)/(%s)/(%s)' % ((slug_pattern,) * 4), ci.watch_job),
     url(r'^data/(%s)/(%s)' % ((slug_pattern,) * 2), data.get),
     url(r'^resubmit/([0-9]+)', ci.resubmit_job),
@@ -1,7 +1,31 @@
+from django.utils.translation import ugettext_lazy as _
 from django_filters.rest_framework import DjangoFilterBackend
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+
+
+from squad.http import get_token
 
 
 class DisabledHTMLFilterBackend(DjangoFilterBackend):
 
     def to_html(self, request, queryset, view):
         return ""
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    Same as rest_framework's TokenAuthentication, but looks up tokens with
+    squad.http.get_token, so that they are not read from the database on
+    every request.
+    """
+
+    def authenticate_credentials(self, key):
+        token = get_token(key)
+        if token is None:
+            raise exceptions.AuthenticationFailed(_('Invalid token.'))
+
+        if not token.user.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+
+        return (token.user, token)
@@ -1,6 +1,6 @@
 from django.contrib import admin
 from django.utils.translation import ugettext_lazy as _
-from squad.ci.models import Backend, TestJob
+from squad.ci.models import Backend, TestJob, ListenerLease
 from squad.ci.tasks import submit, fetch, poll
 
 
@@ -13,7 +13,7 @@ poll_backends.short_description = "Poll selected backends"
 
 
 class BackendAdmin(admin.ModelAdmin):
-    list_display = ('name', 'url', 'implementation_type', 'poll_enabled', 'poll_interval', 'max_fetch_attempts')
+    list_display = ('name', 'url', 'implementation_type', 'poll_enabled', 'poll_interval', 'max_fetch_attempts', 'max_concurrency', 'max_requests_per_second')
     actions = [poll_backends]
 
 
@@ -68,5 +68,17 @@ class TestJobAdmin(admin.ModelAdmin):
     job_id_link.short_description = 'Job ID ⇒'
 
 
+class ListenerLeaseAdmin(admin.ModelAdmin):
+    list_display = ('backend', 'listener', 'message_rate', 'lag', 'last_message_at', 'heartbeat_at')
+    readonly_fields = ('backend', 'listener', 'messages', 'message_rate', 'lag', 'last_message_at')
+
+    def heartbeat_at(self, lease):
+        return lease.listener.heartbeat_at
+
+    def get_queryset(self, request):
+        return super(ListenerLeaseAdmin, self).get_queryset(request).select_related('backend', 'listener')
+
+
 admin.site.register(Backend, BackendAdmin)
 admin.site.register(TestJob, TestJobAdmin)
+admin.site.register(ListenerLease, ListenerLeaseAdmin)
@@ -1,7 +1,10 @@
+import asyncio
 import random
 import time
 from squad.ci.models import TestJob
 from squad.ci.tasks import fetch
+from squad.ci.utils import run_in_database_thread
+from squad.ci.backend.null import Backend as BaseBackend
 
 
 description = "Fake"
@@ -10,10 +13,7 @@ TESTS = ("test1", "test2", "foo/test1", "foo/test2", "bar/test1", "bar/test2")
 METRICS = ("metric1", "metric2", "foobenchmarks/metric1", "barbenchmarks/metric1")
 
 
-class Backend(object):
-
-    def __init__(self, data):
-        self.data = data
+class Backend(BaseBackend):
 
     def submit(self, test_job):
         return str(test_job.id)
@@ -48,14 +48,24 @@ class Backend(object):
         max_id = 0
         while True:
             time.sleep(random.randint(1, 5))
-            jobs = self.data.test_jobs.filter(
-                submitted=True,
-                fetched=False,
-                id__gt=max_id,
-            ).order_by('id')
-            for job in jobs:
-                fetch.apply_async(args=[job.id])
-                max_id = job.id
+            max_id = self.__schedule_fetches__(max_id)
+
+    async def listen_async(self):
+        max_id = 0
+        while True:
+            await asyncio.sleep(random.randint(1, 5))
+            max_id = await run_in_database_thread(self.__schedule_fetches__, max_id)
+
+    def __schedule_fetches__(self, max_id):
+        jobs = self.data.test_jobs.filter(
+            submitted=True,
+            fetched=False,
+            id__gt=max_id,
+        ).order_by('id')
+        for job in jobs:
+            fetch.apply_async(args=[job.id])
+            max_id = job.id
+        return max_id
 
     def job_url(selt, test_job):
         return 'https://example.com/job/%s' % test_job.job_id
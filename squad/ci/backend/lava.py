@@ -1,24 +1,35 @@
+import asyncio
+import dateutil.parser
+import dateutil.tz
+import io
 import json
 import logging
 import re
-import requests
 import ssl
 import traceback
 import yaml
 import xmlrpc
 import zmq
+import zmq.asyncio
 
 from zmq.utils.strtypes import u
 
+from django.conf import settings
+from django.utils import timezone
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from xmlrpc import client as xmlrpclib
 from urllib.parse import urlsplit
 
 
 from squad.ci.models import TestJob
-from squad.ci.tasks import fetch, send_testjob_resubmit_admin_email
+from squad.ci.tasks import fetch_batch, send_testjob_resubmit_admin_email
 from squad.ci.exceptions import SubmissionIssue, TemporarySubmissionIssue
 from squad.ci.exceptions import FetchIssue, TemporaryFetchIssue
 from squad.ci.backend.null import Backend as BaseBackend
+from squad.ci.transport import SessionTransport, connection_stats, get_session
+from squad.ci.utils import run_in_database_thread
 
 
 description = "LAVA"
@@ -35,20 +46,38 @@ class Backend(BaseBackend):
             job_id = self.__submit__(test_job.definition)
             test_job.name = self.__lava_job_name(test_job.definition)
             return job_id
-        except xmlrpc.client.ProtocolError as error:
-            raise TemporarySubmissionIssue(self.url_remove_token(str(error)))
-        except xmlrpc.client.Fault as fault:
-            if fault.faultCode // 100 == 5:
-                # assume HTTP errors 5xx are temporary issues
-                raise TemporarySubmissionIssue(self.url_remove_token(str(fault)))
+        except (xmlrpc.client.ProtocolError, xmlrpc.client.Fault, ssl.SSLError) as error:
+            raise self.__submission_issue__(error)
+
+    def submit_many(self, test_jobs):
+        try:
+            responses = self.__submit_many__([test_job.definition for test_job in test_jobs])
+        except (xmlrpc.client.ProtocolError, xmlrpc.client.Fault, ssl.SSLError) as error:
+            raise self.__submission_issue__(error)
+        results = []
+        for test_job, response in zip(test_jobs, responses):
+            if isinstance(response, xmlrpclib.Fault):
+                results.append(self.__submission_issue__(response))
             else:
-                raise SubmissionIssue(self.url_remove_token(str(fault)))
-        except ssl.SSLError as fault:
-            raise SubmissionIssue(self.url_remove_token(str(fault)))
+                test_job.name = self.__lava_job_name(test_job.definition)
+                results.append(response)
+        return results
+
+    def __submission_issue__(self, error):
+        message = self.url_remove_token(str(error))
+        if isinstance(error, xmlrpc.client.ProtocolError):
+            return TemporarySubmissionIssue(message)
+        if isinstance(error, xmlrpc.client.Fault) and error.faultCode // 100 == 5:
+            # assume HTTP errors 5xx are temporary issues
+            return TemporarySubmissionIssue(message)
+        return SubmissionIssue(message)
 
     def fetch(self, test_job):
         try:
-            data = self.__get_job_details__(test_job.job_id)
+            data = self.__prefetched__.pop(test_job.job_id, None)
+            if data is None:
+                data = self.__get_job_details__(test_job.job_id)
+            data = self.__unwrap__(data)
 
             if data['status'] in self.complete_statuses:
                 data['results'] = self.__get_testjob_results_yaml__(test_job.job_id)
@@ -60,6 +89,9 @@ class Backend(BaseBackend):
                 except Exception:
                     self.log_warn(("Logs for job %s are not available" % test_job.job_id) + "\n" + traceback.format_exc())
 
+                stats = connection_stats()
+                logger.debug("%d HTTP requests made over %d connections so far" % (stats['requests'], stats['connections']))
+
                 return self.__parse_results__(data, test_job) + (logs,)
         except xmlrpc.client.ProtocolError as error:
             raise TemporaryFetchIssue(self.url_remove_token(str(error)))
@@ -72,34 +104,115 @@ class Backend(BaseBackend):
         except ssl.SSLError as fault:
             raise FetchIssue(self.url_remove_token(str(fault)))
 
+    def prefetch(self, test_jobs):
+        """
+        Retrieves the details (including the status) of all test jobs at
+        once. Test results are not prefetched: they can be large, so they
+        are streamed when each test job is fetched.
+        """
+        job_ids = [test_job.job_id for test_job in test_jobs if test_job.job_id]
+        if not job_ids:
+            return
+        try:
+            details = self.__get_many_job_details__(job_ids)
+        except (xmlrpclib.ProtocolError, ssl.SSLError, OSError) as error:
+            # not fatal; each test job will be fetched on its own
+            self.log_warn("could not prefetch test jobs: %s" % self.url_remove_token(str(error)))
+            return
+        # implementation objects are long lived; don't keep data for test
+        # jobs that were prefetched before but never fetched
+        self.__prefetched__ = details
+
     def listen(self):
         listener_url = self.get_listener_url()
 
+        self.context = zmq.Context()
+        self.socket = self.__connect__(self.context, listener_url)
+
+        while True:
+            try:
+                # wait for the first message, then take whatever else is
+                # already queued, and handle it all at once
+                messages = [self.socket.recv_multipart()]
+                while len(messages) < self.listen_batch_size:
+                    try:
+                        messages.append(self.socket.recv_multipart(zmq.NOBLOCK))
+                    except zmq.Again:
+                        break
+                self.__handle_messages__(messages)
+            except Exception as e:
+                self.log_error(str(e) + "\n" + traceback.format_exc())
+
+    async def listen_async(self):
+        listener_url = await run_in_database_thread(self.get_listener_url)
+
+        context = zmq.asyncio.Context()
+        socket = self.__connect__(context, listener_url)
+        try:
+            while True:
+                try:
+                    messages = [await socket.recv_multipart()]
+                    while len(messages) < self.listen_batch_size:
+                        try:
+                            messages.append(await socket.recv_multipart(zmq.NOBLOCK))
+                        except zmq.Again:
+                            break
+                    # database access must not block the event loop
+                    await run_in_database_thread(self.__handle_messages__, messages)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.log_error(str(e) + "\n" + traceback.format_exc())
+        finally:
+            socket.close(linger=0)
+            context.term()
+
+    def __connect__(self, context, listener_url):
         self.log_debug("connecting to %s" % listener_url)
 
-        self.context = zmq.Context()
-        self.socket = self.context.socket(zmq.SUB)
-        self.socket.setsockopt_string(zmq.SUBSCRIBE, "")
+        socket = context.socket(zmq.SUB)
+        socket.setsockopt_string(zmq.SUBSCRIBE, "")
         try:
             # requires PyZMQ to be built against ZeroMQ 4.2+
-            self.socket.setsockopt(zmq.HEARTBEAT_IVL, 1000)  # 1 s
-            self.socket.setsockopt(zmq.HEARTBEAT_TIMEOUT, 10000)  # 10 s
+            socket.setsockopt(zmq.HEARTBEAT_IVL, 1000)  # 1 s
+            socket.setsockopt(zmq.HEARTBEAT_TIMEOUT, 10000)  # 10 s
         except AttributeError:
             self.log_warn('PyZMQ has no support for heartbeat (requires ZeroMQ library 4.2+), connection may be unstable')
             pass
 
-        self.socket.connect(listener_url)
+        socket.connect(listener_url)
 
         self.log_debug("connected to %s" % listener_url)
+        return socket
 
-        while True:
+    def __handle_messages__(self, messages):
+        events = []
+        for message in messages:
+            # a malformed message must not prevent the others from being
+            # handled
             try:
-                message = self.socket.recv_multipart()
-                (topic, uuid, dt, username, data) = (u(m) for m in message[:])
-                data = json.loads(data)
-                self.receive_event(topic, data)
-            except Exception as e:
-                self.log_error(str(e) + "\n" + traceback.format_exc())
+                events.append(self.__decode_event__(message))
+            except ValueError as e:
+                self.log_warn("ignoring invalid event: %s" % str(e))
+        self.receive_events(events)
+        self.record_events(len(messages), self.__event_lag__(messages[-1]))
+
+    def __decode_event__(self, message):
+        (topic, uuid, dt, username, data) = (u(m) for m in message[:])
+        data = json.loads(data)
+        if not isinstance(data, dict):
+            raise ValueError("expected a JSON object, got %r" % data)
+        return (topic, data)
+
+    def __event_lag__(self, message):
+        try:
+            sent = dateutil.parser.parse(u(message[2]))
+        except (IndexError, ValueError, OverflowError):
+            return None
+        if sent.tzinfo is None:
+            # LAVA uses UTC
+            sent = sent.replace(tzinfo=dateutil.tz.tzutc())
+        return (timezone.now() - sent).total_seconds()
 
     def job_url(self, test_job):
         url = urlsplit(self.data.url)
@@ -117,6 +230,26 @@ class Backend(BaseBackend):
         super(Backend, self).__init__(data)
         self.complete_statuses = ['Complete', 'Incomplete', 'Canceled']
         self.__proxy__ = None
+        self.__prefetched__ = {}
+        self.__name_lookups_executor__ = None
+
+    # maximum number of calls sent in a single system.multicall request
+    multicall_size = 100
+
+    # maximum number of system.multicall requests made in parallel
+    multicall_workers = 4
+
+    # number of test results requested at a time for each test suite
+    results_page_size = 500
+
+    # maximum size, in characters, of the log kept for each test job; can be
+    # overriden with the CI_LAVA_MAX_LOG_SIZE backend setting
+    max_log_size = 100 * 1024 * 1024
+
+    log_chunk_size = 64 * 1024
+
+    # maximum number of events from the LAVA event socket handled at once
+    listen_batch_size = 100
 
     def url_remove_token(self, text):
         if self.data is not None and self.data.token is not None:
@@ -126,17 +259,20 @@ class Backend(BaseBackend):
     @property
     def proxy(self):
         if self.__proxy__ is None:
-            url = urlsplit(self.data.url)
-            endpoint = '%s://%s:%s@%s%s' % (
-                url.scheme,
-                self.data.username,
-                self.data.token,
-                url.netloc,
-                url.path
-            )
-            self.__proxy__ = xmlrpclib.ServerProxy(endpoint)
+            self.__proxy__ = self.__create_proxy__()
         return self.__proxy__
 
+    def __create_proxy__(self):
+        url = urlsplit(self.data.url)
+        endpoint = '%s://%s:%s@%s%s' % (
+            url.scheme,
+            self.data.username,
+            self.data.token,
+            url.netloc,
+            url.path
+        )
+        return xmlrpclib.ServerProxy(endpoint, transport=SessionTransport(self.data.url))
+
     def get_listener_url(self):
         url = urlsplit(self.data.url)
         hostname = url.netloc
@@ -186,14 +322,71 @@ class Backend(BaseBackend):
     def __submit__(self, definition):
         return self.proxy.scheduler.submit_job(definition)
 
+    def __submit_many__(self, definitions):
+        return self.__multicall__([('scheduler.submit_job', (definition,)) for definition in definitions])
+
     def __get_job_details__(self, job_id):
         return self.proxy.scheduler.job_details(job_id)
 
+    def __get_many_job_details__(self, job_ids):
+        details = self.__multicall__([('scheduler.job_details', (job_id,)) for job_id in job_ids])
+        return dict(zip(job_ids, details))
+
+    def __multicall__(self, calls):
+        """
+        Makes the given calls, a list of (method_name, args) tuples, using as
+        few system.multicall requests as possible, sent in parallel when
+        there are more calls than fit in a single one. Returns the results
+        in the same order as the calls; for the calls that failed, the
+        corresponding xmlrpclib.Fault is returned instead of being raised.
+        """
+        chunks = [calls[i:i + self.multicall_size] for i in range(0, len(calls), self.multicall_size)]
+        if len(chunks) <= 1:
+            responses = [self.__run_multicall__(self.proxy, chunk) for chunk in chunks]
+        else:
+            # ServerProxy objects cannot be shared between threads
+            def run(chunk):
+                return self.__run_multicall__(self.__create_proxy__(), chunk)
+            with ThreadPoolExecutor(max_workers=self.multicall_workers) as executor:
+                responses = list(executor.map(run, chunks))
+        return [result for response in responses for result in response]
+
+    def __run_multicall__(self, proxy, calls):
+        multicall = xmlrpclib.MultiCall(proxy)
+        for method, args in calls:
+            getattr(multicall, method)(*args)
+        response = multicall()
+        results = []
+        for i in range(len(calls)):
+            try:
+                results.append(response[i])
+            except xmlrpclib.Fault as fault:
+                results.append(fault)
+        return results
+
+    def __unwrap__(self, result):
+        if isinstance(result, xmlrpclib.Fault):
+            raise result
+        return result
+
     def __download_full_log__(self, job_id):
+        """
+        Iterates over the lines of the plain log of a test job, as they are
+        downloaded.
+        """
         url = self.data.url.replace('/RPC2', '/scheduler/job/%s/log_file/plain' % job_id)
         payload = {"user": self.data.username, "token": self.data.token}
-        response = requests.get(url, params=payload)
-        return response.content
+        session = get_session(self.data.url)
+        with session.get(url, params=payload, stream=True, timeout=settings.CI_HTTP_TIMEOUT) as response:
+            response.raise_for_status()
+            pending = b''
+            for chunk in response.iter_content(chunk_size=self.log_chunk_size):
+                lines = (pending + chunk).split(b'\n')
+                pending = lines.pop()
+                for line in lines:
+                    yield line
+            if pending:
+                yield pending
 
     def __get_job_logs__(self, job_id):
         logger.debug("Retrieving logs job: %s" % job_id)
@@ -201,71 +394,127 @@ class Backend(BaseBackend):
         return self.__parse_log__(log_data)
 
     def __parse_log__(self, log_data):
-        returned_log = ""
-        start_dict = False
-        tmp_dict = None
-        tmp_key = None
-        is_value = False
-        for event in yaml.parse(log_data, Loader=yaml.CLoader):
-            if isinstance(event, yaml.MappingStartEvent):
-                start_dict = True
-                tmp_dict = {}
-            if isinstance(event, yaml.MappingEndEvent):
-                start_dict = False
-                if tmp_dict:
-                    if 'lvl' in tmp_dict.keys() and tmp_dict['lvl'] == 'target':
-                        if 'msg' in tmp_dict.keys():
-                            if isinstance(tmp_dict['msg'], bytes):
-                                try:
-                                    # seems like latin-1 is the encoding used by serial
-                                    # this might not be true in all cases
-                                    returned_log = returned_log + "\n" + tmp_dict["msg"].decode('latin-1', 'ignore')
-                                except ValueError:
-                                    # despite ignoring errors, they are still raised sometimes
-                                    pass
-                            else:
-                                returned_log = returned_log + "\n" + tmp_dict['msg']
-                del tmp_dict
-                tmp_dict = None
-                is_value = False
-            if start_dict is True and isinstance(event, yaml.ScalarEvent):
-                if is_value is False:
-                    # the event.value is a dict key
-                    tmp_key = event.value
-                    is_value = True
-                else:
-                    # the event.value is a dict value
-                    tmp_dict.update({tmp_key: event.value})
-                    is_value = False
-
-        return returned_log
+        """
+        Extracts the messages from the target (i.e. the serial console
+        output) from a LAVA log, which can be given as a string or as an
+        iterable of lines. Each log entry is parsed on its own, as soon as
+        it is complete, and the output stops growing once it reaches
+        max_log_size characters.
+        """
+        if isinstance(log_data, (str, bytes)):
+            log_data = log_data.splitlines()
+
+        max_log_size = self.max_log_size
+        if self.settings is not None:
+            max_log_size = self.settings.get('CI_LAVA_MAX_LOG_SIZE', max_log_size)
+
+        output = io.StringIO()
+        size = 0
+        for entry in self.__iter_log_entries__(log_data):
+            msg = self.__target_message__(entry)
+            if msg is None:
+                continue
+            if size + len(msg) + 1 > max_log_size:
+                output.write("\n[log truncated at %d characters]" % max_log_size)
+                break
+            output.write("\n")
+            output.write(msg)
+            size += len(msg) + 1
+
+        return output.getvalue()
+
+    def __iter_log_entries__(self, lines):
+        """
+        Groups the lines of a LAVA log into entries, i.e. the items of the
+        top level YAML list (usually one per line).
+        """
+        entry = []
+        for line in lines:
+            if isinstance(line, bytes):
+                line = line.decode('utf-8', 'replace')
+            if line.startswith('- ') and entry:
+                yield '\n'.join(entry)
+                entry = []
+            entry.append(line)
+        if entry:
+            yield '\n'.join(entry)
+
+    def __target_message__(self, entry):
+        if 'target' not in entry:
+            # cheap check to skip the vast majority of non-target entries
+            return None
+        try:
+            data = yaml.load(entry, Loader=yaml.CLoader)
+        except yaml.YAMLError:
+            return None
+        if not isinstance(data, list) or not data or not isinstance(data[0], dict):
+            return None
+        data = data[0]
+        if data.get('lvl') != 'target' or 'msg' not in data:
+            return None
+        msg = data['msg']
+        if isinstance(msg, bytes):
+            # seems like latin-1 is the encoding used by serial
+            # this might not be true in all cases
+            return msg.decode('latin-1', 'ignore')
+        return str(msg)
 
     def __get_testjob_results_yaml__(self, job_id):
-        logger.debug("Retrieving result summary for job: %s" % job_id)
-        suites = self.proxy.results.get_testjob_suites_list_yaml(job_id)
-        y = yaml.load(suites)
-        lava_job_results = []
-        for suite in y:
-            limit = 500
-            offset = 0
-            while True:
-                logger.debug(
-                    "requesting results for %s with offset of %s"
-                    % (suite['name'], offset)
-                )
-                results = self.proxy.results.get_testsuite_results_yaml(
-                    job_id,
-                    suite['name'],
-                    limit,
-                    offset)
-                yaml_results = yaml.load(results, Loader=yaml.CLoader)
-                lava_job_results = lava_job_results + yaml_results
-                if len(yaml_results) == limit:
-                    offset = offset + limit
-                else:
-                    break
-
-        return lava_job_results
+        """
+        Iterates over the test results of a test job. Pages of results are
+        only requested as the previous ones are consumed, so the results of
+        large test jobs never need to be all in memory at the same time.
+        """
+        for _, _, results in self.__iter_testsuite_results__([job_id]):
+            for result in self.__unwrap__(results):
+                yield result
+
+    def __iter_testsuite_results__(self, job_ids):
+        """
+        Yields (job_id, suite, results) tuples with each page of test results
+        of the given test jobs. The suites of all test jobs are listed in a
+        single round trip, and then pages of results are requested for all
+        of the suites together, until every suite has been read completely.
+        Pages are parsed one at a time, as they are consumed.
+
+        When retrieving the results of a test job fails, the
+        xmlrpclib.Fault is yielded in place of the results, and nothing else
+        is yielded for that test job.
+        """
+        logger.debug("Retrieving result summary for jobs: %s" % ", ".join(str(j) for j in job_ids))
+        limit = self.results_page_size
+        failed = set()
+        pending = []
+
+        suite_lists = self.__multicall__([('results.get_testjob_suites_list_yaml', (job_id,)) for job_id in job_ids])
+        for job_id, suite_list in zip(job_ids, suite_lists):
+            if isinstance(suite_list, xmlrpclib.Fault):
+                failed.add(job_id)
+                yield (job_id, None, suite_list)
+                continue
+            for suite in yaml.load(suite_list, Loader=yaml.CLoader):
+                pending.append((job_id, suite['name'], 0))
+
+        while pending:
+            logger.debug("requesting %d pages of results" % len(pending))
+            calls = [
+                ('results.get_testsuite_results_yaml', (job_id, suite, limit, offset))
+                for job_id, suite, offset in pending
+            ]
+            responses = self.__multicall__(calls)
+            next_pending = []
+            for (job_id, suite, offset), response in zip(pending, responses):
+                if job_id in failed:
+                    continue
+                if isinstance(response, xmlrpclib.Fault):
+                    failed.add(job_id)
+                    yield (job_id, suite, response)
+                    continue
+                results = yaml.load(response, Loader=yaml.CLoader)
+                yield (job_id, suite, results)
+                if len(results) == limit:
+                    next_pending.append((job_id, suite, offset + limit))
+            pending = next_pending
 
     def __get_publisher_event_socket__(self):
         return self.proxy.scheduler.get_publisher_event_socket()
@@ -355,41 +604,87 @@ class Backend(BaseBackend):
         return (data['status'], completed, job_metadata, results, metrics)
 
     def receive_event(self, topic, data):
-        if topic.split('.')[-1] != "testjob":
-            return
-        lava_id = data.get('job')
-        if not lava_id:
+        self.receive_events([(topic, data)])
+
+    def receive_events(self, events):
+        """
+        Handles a batch of (topic, data) events from the LAVA event socket.
+        The test jobs are looked up with a single query, and their status is
+        updated in bulk. Job names that are not in the job definition are
+        looked up in the background, so that receiving events never waits on
+        the LAVA server.
+        """
+        statuses = OrderedDict()
+        for topic, data in events:
+            if topic.split('.')[-1] != "testjob":
+                continue
+            lava_id = data.get('job')
+            if not lava_id:
+                continue
+            if 'sub_id' in data.keys():
+                lava_id = data['sub_id']
+            lava_status = data.get('state', 'Unknown')
+            if lava_status == 'Finished':
+                lava_status = data.get('health', 'Unknown')
+            # only the most recent status of each job matters
+            statuses.pop(str(lava_id), None)
+            statuses[str(lava_id)] = lava_status
+        if not statuses:
             return
-        if 'sub_id' in data.keys():
-            lava_id = data['sub_id']
-        lava_status = data.get('state', 'Unknown')
-        db_test_job_list = self.data.test_jobs.filter(
-            submitted=True,
-            fetched=False,
-            job_id=lava_id)
-        if db_test_job_list.exists() and \
-                len(db_test_job_list) == 1:
-            self.log_debug("interesting message received: %r" % data)
+
+        matches = {}
+        for job in self.data.test_jobs.filter(submitted=True, fetched=False, job_id__in=list(statuses.keys())):
+            matches.setdefault(job.job_id, []).append(job)
+
+        updates = {}
+        to_fetch = []
+        for lava_id, lava_status in statuses.items():
+            jobs = matches.get(lava_id, [])
+            if len(jobs) != 1:
+                continue
+            job = jobs[0]
+            self.log_debug("interesting event received: job %s is %s" % (lava_id, lava_status))
+            updates.setdefault(lava_status, []).append(job.id)
+            if job.name is None:
+                self.__set_job_name__(job, lava_id)
+            if lava_status in self.complete_statuses:
+                to_fetch.append(job.id)
+
+        for lava_status, ids in updates.items():
+            TestJob.objects.filter(id__in=ids).update(job_status=lava_status)
+
+        if to_fetch:
+            self.log_info("scheduling fetch for jobs %s" % ", ".join(str(i) for i in to_fetch))
+            # introduce 2 min delay to allow LAVA for storing all results
+            # this workaround should be removed once LAVA issue is fixed
+            fetch_batch.apply_async(args=[to_fetch], countdown=120)
+
+    def __set_job_name__(self, job, lava_id):
+        name = None
+        if job.definition:
+            # no need to ask the server for what is already in the definition
+            name = self.__lava_job_name(job.definition)
+        if name is not None:
+            TestJob.objects.filter(id=job.id).update(name=name)
         else:
-            return
+            self.__name_lookups__.submit(self.__lookup_job_name__, job.id, lava_id)
+
+    @property
+    def __name_lookups__(self):
+        if self.__name_lookups_executor__ is None:
+            self.__name_lookups_executor__ = ThreadPoolExecutor(max_workers=2)
+        return self.__name_lookups_executor__
 
-        job = db_test_job_list[0]
-        job.job_status = lava_status
-        if lava_status == 'Finished':
-            lava_health = data.get('health', 'Unknown')
-            job.job_status = lava_health
-        if job.name is None:
-            # fetch job name once
-            data = self.__get_job_details__(lava_id)
+    def __lookup_job_name__(self, test_job_id, lava_id):
+        try:
+            # ServerProxy objects cannot be shared between threads
+            data = self.__create_proxy__().scheduler.job_details(lava_id)
             if data['is_pipeline'] is False:
                 return
             definition = yaml.load(data['definition'])
             if data['multinode_definition']:
                 definition = yaml.load(data['multinode_definition'])
-            job.name = definition['job_name'][:255]
-        job.save()
-        if job.job_status in self.complete_statuses:
-            self.log_info("scheduling fetch for job %s" % job.job_id)
-            # introduce 2 min delay to allow LAVA for storing all results
-            # this workaround should be removed once LAVA issue is fixed
-            fetch.apply_async(args=[job.id], countdown=120)
+            name = definition['job_name'][:255]
+            TestJob.objects.filter(id=test_job_id, name__isnull=True).update(name=name)
+        except Exception as e:
+            self.log_error("could not get name for job %s: %s" % (lava_id, self.url_remove_token(str(e))))
@@ -1,7 +1,13 @@
+import asyncio
+import time
 import yaml
 import logging
 
 
+from squad.ci.models import ListenerLease
+from squad.ci.exceptions import SubmissionIssue
+
+
 logger = logging.getLogger('squad.ci.backend')
 
 
@@ -15,9 +21,15 @@ class Backend(object):
     actual backend, it's not mandatory to implement every method.
     """
 
+    # how often, in seconds, listener statistics are saved
+    stats_interval = 5
+
     def __init__(self, data):
         self.data = data
         self.settings = None
+        self.__events__ = 0
+        self.__lag__ = None
+        self.__stats_saved_at__ = time.time()
         if self.data is not None and \
                 self.data.backend_settings is not None and \
                 len(self.data.backend_settings) > 0:
@@ -39,6 +51,26 @@ class Backend(object):
         """
         pass
 
+    def submit_many(self, test_jobs):
+        """
+        Optional. Submits several test jobs at once, which implementations
+        can do in fewer requests to the backend service than submitting them
+        one by one with submit().
+
+        The return value must be a list with one item for each test job, in
+        the same order: the job id as provided by the backend, or the
+        squad.ci.exceptions.SubmissionIssue (or TemporarySubmissionIssue)
+        for the test jobs that could not be submitted. Issues that affect
+        the whole batch can be raised instead.
+        """
+        results = []
+        for test_job in test_jobs:
+            try:
+                results.append(self.submit(test_job))
+            except SubmissionIssue as issue:
+                results.append(issue)
+        return results
+
     def resubmit(self, test_job):
         """
         Re-submits given test job to the backend service
@@ -77,6 +109,18 @@ class Backend(object):
         """
         pass
 
+    def prefetch(self, test_jobs):
+        """
+        Optional. Called with a list of test jobs that are about to be fetched,
+        allowing implementations to retrieve data for all of them at once
+        (e.g. in a single request to the backend service) and hold it until
+        fetch() is called for each of them.
+
+        Errors must not be raised from here; fetch() must still work for any
+        test job whose data could not be prefetched.
+        """
+        pass
+
     def listen(self):
         """
         Listens the backend service for realtime test results. What to do with
@@ -84,6 +128,34 @@ class Backend(object):
         """
         pass
 
+    async def listen_async(self):
+        """
+        Coroutine equivalent of listen(), used when the listeners of all
+        backends run in a single process. Implementations should override
+        this to wait for data asynchronously (e.g. with zmq.asyncio), or to
+        poll the backend service periodically with asyncio.sleep() between
+        attempts; the default implementation just runs listen() in a
+        separate thread.
+        """
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.listen)
+
+    def record_events(self, count, lag=None):
+        """
+        To be called by listen() implementations for each batch of events
+        received from the backend service, with how late (in seconds) the
+        most recent of them was received, if known. These statistics are
+        saved every stats_interval seconds, and can be seen in the listener
+        leases when running sharded listeners.
+        """
+        self.__events__ += count
+        if lag is not None:
+            self.__lag__ = lag
+        if time.time() - self.__stats_saved_at__ >= self.stats_interval:
+            ListenerLease.record(self.data.id, self.__events__, self.__lag__)
+            self.__events__ = 0
+            self.__stats_saved_at__ = time.time()
+
     def job_url(selt, test_job):
         """
         Returns the URL of the test job in the backend
@@ -12,3 +12,15 @@ class FetchIssue(Exception):
 
 class TemporaryFetchIssue(FetchIssue):
     retry = True
+
+
+class Throttled(Exception):
+    """
+    Raised when an operation cannot be done now because a backend is at its
+    concurrency or rate limit. `retry_after` is the number of seconds to
+    wait before trying again.
+    """
+
+    def __init__(self, retry_after):
+        super(Throttled, self).__init__("backend is busy, retry after %.1fs" % retry_after)
+        self.retry_after = retry_after
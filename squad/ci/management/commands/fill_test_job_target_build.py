@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Exists, OuterRef, Subquery
+
+
+from squad.core.models import Build
+from squad.ci.models import TestJob
+
+
+class Command(BaseCommand):
+
+    help = """Links test jobs that have no target build to their builds, if
+    they exist. Test jobs only look up their build when they are created or
+    changed, so this is needed for existing test jobs whose builds were
+    created later."""
+
+    def handle(self, *args, **options):
+        builds = Build.objects.filter(
+            project_id=OuterRef('target_id'),
+            version=OuterRef('build'),
+        )
+        pending = TestJob.objects.filter(
+            target_build__isnull=True,
+        ).annotate(
+            has_build=Exists(builds),
+        ).filter(has_build=True)
+
+        # a single UPDATE ... SET target_build_id = (SELECT ...)
+        updated = pending.update(target_build_id=Subquery(builds.values('id')[:1]))
+
+        self.stdout.write("%d test jobs updated" % updated)
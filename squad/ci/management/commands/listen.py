@@ -1,13 +1,23 @@
+import asyncio
 import logging
+import os
+import select
 import signal
+import socket
 import subprocess
 import sys
 import time
+import traceback
+from datetime import timedelta
 from django.core.management.base import BaseCommand
+from django.db import connection, transaction, IntegrityError
 from django.db.models import Field
+from django.db.models.functions import Now
+from django.utils import timezone
 
 
-from squad.ci.models import Backend
+from squad.ci.models import Backend, BackendChanges, Listener as ListenerModel, ListenerLease
+from squad.ci.utils import run_in_database_thread
 
 
 logger = logging.getLogger()
@@ -34,10 +44,183 @@ class Listener(object):
         sys.exit()
 
 
+class BackendChangesWatcher(object):
+    """
+    Detects changes to the configuration of backends (see
+    squad.ci.models.BackendChanges) without querying the database. On
+    PostgreSQL, it waits for notifications from other processes. On SQLite,
+    it checks the modification time of the database file, and only when
+    that changes it reports a possible change. With other databases, it
+    assumes that something may have changed every fallback_interval seconds.
+    """
+
+    poll_interval = 0.5
+    fallback_interval = 5
+
+    def __init__(self):
+        self.__version__ = BackendChanges.version
+        self.__mtime__ = self.__database_mtime__()
+        self.__last_fallback__ = time.time()
+        self.__listening__ = None
+
+    def changed(self):
+        """
+        Returns whether backends may have changed since the last call. Never
+        blocks.
+        """
+        changed = False
+        if BackendChanges.version != self.__version__:
+            self.__version__ = BackendChanges.version
+            changed = True
+
+        if connection.vendor == 'postgresql':
+            pg = self.__listen__()
+            pg.poll()
+            if pg.notifies:
+                del pg.notifies[:]
+                changed = True
+        elif connection.vendor == 'sqlite':
+            mtime = self.__database_mtime__()
+            if mtime != self.__mtime__:
+                self.__mtime__ = mtime
+                changed = True
+        elif time.time() - self.__last_fallback__ >= self.fallback_interval:
+            self.__last_fallback__ = time.time()
+            changed = True
+
+        return changed
+
+    def wait(self, timeout):
+        """
+        Blocks until a change is detected, or for timeout seconds. Returns
+        whether a change was detected.
+        """
+        deadline = time.time() + timeout
+        while not self.changed():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            if connection.vendor == 'postgresql':
+                select.select([self.__listen__()], [], [], remaining)
+            else:
+                time.sleep(min(self.poll_interval, remaining))
+        return True
+
+    def __listen__(self):
+        connection.ensure_connection()
+        pg = connection.connection
+        # LISTEN again if reconnected
+        if self.__listening__ is not pg:
+            with connection.cursor() as cursor:
+                cursor.execute('LISTEN %s' % BackendChanges.CHANNEL)
+            self.__listening__ = pg
+        return pg
+
+    def __database_mtime__(self):
+        if connection.vendor != 'sqlite':
+            return None
+        name = connection.settings_dict['NAME']
+        mtimes = []
+        for path in (name, name + '-wal'):
+            try:
+                mtimes.append(os.stat(path).st_mtime)
+            except (OSError, TypeError):
+                pass
+        return mtimes and max(mtimes) or None
+
+
+class Shard(object):
+    """
+    Splits the backends between several listener processes, possibly on
+    different hosts, using leases stored in the database. Each listener
+    sends a heartbeat every heartbeat_interval seconds; a listener that
+    misses heartbeats for timeout seconds is considered dead, and its
+    backends are taken over by the others.
+
+    Heartbeats are timestamped, and checked, with the clock of the database
+    server, so that clock skew between hosts does not make listeners look
+    dead to each other.
+    """
+
+    heartbeat_interval = 2
+    timeout = 10
+
+    # interval, in seconds, over which message rates are calculated
+    rate_interval = 60
+
+    def __init__(self, name=None):
+        self.name = name or '%s:%d' % (socket.gethostname(), os.getpid())
+        self.__samples__ = {}
+
+    def heartbeat(self):
+        """
+        Renews the leases of this listener, takes over the backends from
+        dead listeners, and balances the backends between the live ones.
+        Returns the ids of the backends that this listener must listen to.
+        """
+        now = timezone.now()
+        listener, _ = ListenerModel.objects.update_or_create(name=self.name, defaults={'heartbeat_at': Now()})
+        # also releases their leases
+        ListenerModel.objects.filter(heartbeat_at__lt=Now() - timedelta(seconds=self.timeout)).delete()
+
+        backend_ids = list(Backend.objects.order_by('id').values_list('id', flat=True))
+        listeners = ListenerModel.objects.count()
+        share = -(-len(backend_ids) // listeners)  # rounded up
+
+        leases = {lease.backend_id: lease for lease in listener.leases.all()}
+        mine = sorted(leases.keys())
+
+        if len(mine) > share:
+            # let other listeners take the extra backends
+            ListenerLease.objects.filter(listener=listener, backend_id__in=mine[share:]).delete()
+            mine = mine[:share]
+
+        taken = set(ListenerLease.objects.values_list('backend_id', flat=True))
+        for backend_id in backend_ids:
+            if len(mine) >= share:
+                break
+            if backend_id in taken:
+                continue
+            try:
+                with transaction.atomic():
+                    ListenerLease.objects.create(backend_id=backend_id, listener=listener)
+                mine.append(backend_id)
+                self.__samples__[backend_id] = (0, now)
+            except IntegrityError:
+                pass  # another listener was faster
+
+        self.__update_rates__([leases[b] for b in mine if b in leases], now)
+        return sorted(mine)
+
+    def __update_rates__(self, leases, now):
+        for lease in leases:
+            sample = self.__samples__.get(lease.backend_id)
+            if sample is None:
+                self.__samples__[lease.backend_id] = (lease.messages, now)
+                continue
+            elapsed = (now - sample[1]).total_seconds()
+            if elapsed > 0 and elapsed >= self.rate_interval:
+                rate = (lease.messages - sample[0]) / elapsed
+                ListenerLease.objects.filter(pk=lease.pk).update(message_rate=rate)
+                self.__samples__[lease.backend_id] = (lease.messages, now)
+                logger.info("Backend %d: %.2f messages/s, lag: %s s" % (lease.backend_id, rate, lease.lag))
+
+    def leave(self):
+        """
+        Releases all leases of this listener right away.
+        """
+        ListenerModel.objects.filter(name=self.name).delete()
+
+
 class ListenerManager(object):
 
-    def __init__(self, argv):
+    # check all backends every so often, even without any changes
+    resync_interval = 300
+
+    def __init__(self, argv, shard=None):
         self.argv = argv
+        self.shard = shard
+        self.watcher = BackendChangesWatcher()
         self.__processes__ = {}
         self.__fields__ = {}
 
@@ -51,9 +234,25 @@ class ListenerManager(object):
         signal.signal(signal.SIGTERM, signal.getsignal(signal.SIGINT))
 
     def keep_listeners_running(self):
+        self.update_listeners(self.get_backends())
+
+    def get_backends(self):
+        """
+        Returns the backends to listen to.
+        """
+        backends = Backend.objects.all()
+        if self.shard:
+            backends = backends.filter(id__in=self.shard.heartbeat())
+        return list(backends)
+
+    def update_listeners(self, backends):
+        """
+        Starts, restarts or stops listeners so that there is one running for
+        each of *backends*, with their current configuration.
+        """
         ids = list(self.__processes__.keys())
 
-        for backend in Backend.objects.all():
+        for backend in backends:
             process = self.__processes__.get(backend.id)
             if process:
                 # already running: restart if needed
@@ -80,17 +279,21 @@ class ListenerManager(object):
         try:
             while True:
                 self.keep_listeners_running()
-                # FIXME: ideally we should have a blocking call here that waits
-                # for a change to happen in the database, but we didn't find a
-                # simple/portable way of doing that yet. Let's just sleep for a
-                # few seconds instead, for now.
-                time.sleep(5)
+                self.watcher.wait(self.check_interval)
         except KeyboardInterrupt:
             pass  # cleanup() will terminate sub-processes
 
+    @property
+    def check_interval(self):
+        if self.shard:
+            return self.shard.heartbeat_interval
+        return self.resync_interval
+
     def cleanup(self):
         for backend_id in list(self.__processes__.keys()):
             self.stop(backend_id)
+        if self.shard:
+            self.shard.leave()
 
     def stop(self, backend_id):
         process = self.__processes__[backend_id]
@@ -100,6 +303,71 @@ class ListenerManager(object):
         self.__processes__.pop(backend_id)
 
 
+class AsyncListenerManager(ListenerManager):
+    """
+    Runs the listeners of all backends in this same process, as tasks in a
+    single asyncio event loop (see listen_async in the backend
+    implementations), instead of one process per backend.
+
+    Each listener still runs on its own: a listener that crashes is
+    restarted after restart_delay seconds without affecting the others, and
+    listeners are restarted when their backend is changed.
+
+    The event loop never accesses the database itself: that is done in a
+    fixed number of threads (see squad.ci.utils.run_in_database_thread).
+    """
+
+    restart_delay = 10
+
+    def run(self):
+        self.setup_signals()
+        self.event_loop = asyncio.get_event_loop()
+        try:
+            self.event_loop.run_until_complete(self.loop())
+        except KeyboardInterrupt:
+            pass
+        self.cleanup()
+
+    async def loop(self):
+        last_check = 0
+        while True:
+            if self.watcher.changed() or time.time() - last_check >= self.check_interval:
+                backends = await run_in_database_thread(self.get_backends)
+                self.update_listeners(backends)
+                last_check = time.time()
+            await asyncio.sleep(self.watcher.poll_interval)
+
+    def start(self, backend):
+        # __processes__ holds the asyncio tasks instead of processes
+        self.__processes__[backend.id] = asyncio.ensure_future(self.listen(backend))
+        self.__fields__[backend.id] = fields(backend)
+
+    async def listen(self, backend):
+        while True:
+            try:
+                logger.info("Backend %s starting" % backend.name)
+                await backend.get_implementation().listen_async()
+                logger.info("Backend %s exited on its own" % backend.name)
+                return
+            except asyncio.CancelledError:
+                logger.info("Backend %s finishing ..." % backend.name)
+                raise
+            except Exception as e:
+                logger.error("Backend %s crashed, restarting in %d seconds: %s\n%s" % (
+                    backend.name, self.restart_delay, e, traceback.format_exc()))
+                await asyncio.sleep(self.restart_delay)
+
+    def cleanup(self):
+        tasks = list(self.__processes__.values())
+        super(AsyncListenerManager, self).cleanup()
+        if tasks:
+            self.event_loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+
+    def stop(self, backend_id):
+        task = self.__processes__.pop(backend_id)
+        task.cancel()
+
+
 def fields(model):
     return {f.name: getattr(model, f.name) for f in model._meta.get_fields() if isinstance(f, Field)}
 
@@ -114,6 +382,18 @@ class Command(BaseCommand):
             type=str,
             help='Backend name to listen to. If ommited, start the master process.',
         )
+        parser.add_argument(
+            '--asyncio',
+            action='store_true',
+            dest='asyncio',
+            help='Run the listeners of all backends in a single process, using asyncio, instead of one process per backend.',
+        )
+        parser.add_argument(
+            '--sharded',
+            action='store_true',
+            dest='sharded',
+            help='Split the backends with the other listeners started with --sharded, possibly on other hosts.',
+        )
 
     def handle(self, *args, **options):
         backend_name = options.get("BACKEND")
@@ -121,4 +401,8 @@ class Command(BaseCommand):
             backend = Backend.objects.get(name=backend_name)
             Listener(backend).run()
         else:
-            ListenerManager(sys.argv).run()
+            shard = options.get("sharded") and Shard() or None
+            if options.get("asyncio"):
+                AsyncListenerManager(sys.argv, shard=shard).run()
+            else:
+                ListenerManager(sys.argv, shard=shard).run()
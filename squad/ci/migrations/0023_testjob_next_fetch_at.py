@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 22:04
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def schedule_pending_test_jobs(apps, schema_editor):
+    TestJob = apps.get_model('ci', 'TestJob')
+    TestJob.objects.filter(submitted=True, fetched=False).update(next_fetch_at=timezone.now())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ci', '0022_backend_poll_enabled'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='testjob',
+            name='next_fetch_at',
+            field=models.DateTimeField(blank=True, db_index=True, default=None, null=True),
+        ),
+        migrations.RunPython(
+            schedule_pending_test_jobs,
+            reverse_code=migrations.RunPython.noop,
+        ),
+    ]
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 22:06
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ci', '0023_testjob_next_fetch_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BackendLease',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('expires_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='BackendThrottle',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tokens', models.FloatField(default=0)),
+                ('updated_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='backend',
+            name='max_concurrency',
+            field=models.IntegerField(blank=True, help_text='Maximum number of test jobs being fetched or submitted at the same time (empty = no limit)', null=True),
+        ),
+        migrations.AddField(
+            model_name='backend',
+            name='max_requests_per_second',
+            field=models.FloatField(blank=True, help_text='Maximum number of test job fetches or submissions per second (empty = no limit)', null=True),
+        ),
+        migrations.AddField(
+            model_name='backendthrottle',
+            name='backend',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='throttle_state', to='ci.Backend'),
+        ),
+        migrations.AddField(
+            model_name='backendlease',
+            name='backend',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='leases', to='ci.Backend'),
+        ),
+    ]
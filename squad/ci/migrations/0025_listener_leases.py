@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 22:22
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ci', '0024_backend_throttling'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Listener',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('heartbeat_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ListenerLease',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('messages', models.IntegerField(default=0)),
+                ('message_rate', models.FloatField(default=0, help_text='Messages per second')),
+                ('lag', models.FloatField(help_text='How late, in seconds, the last message was received', null=True)),
+                ('last_message_at', models.DateTimeField(null=True)),
+                ('backend', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='listener_lease', to='ci.Backend')),
+                ('listener', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='leases', to='ci.Listener')),
+            ],
+        ),
+    ]
@@ -1,19 +1,24 @@
 import json
 import logging
-import traceback
-from django.db import models
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from django.db import connection, models, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils import timezone
 from dateutil.relativedelta import relativedelta
 
 
-from squad.core.tasks import ReceiveTestRun, UpdateProjectStatus
+from squad.core.tasks import ReceiveTestRun, PostProcessTestRun
 from squad.core.models import Project, Build, TestRun, slug_validator
-from squad.core.plugins import apply_plugins
+from squad.core.plugins import Plugin, get_plugins_by_feature
 from squad.core.tasks.exceptions import InvalidMetadata
 from squad.core.utils import yaml_validator
 
 
 from squad.ci.backend import get_backend_implementation, ALL_BACKENDS
+from squad.ci.exceptions import SubmissionIssue, Throttled
 
 
 logger = logging.getLogger()
@@ -43,23 +48,42 @@ class Backend(models.Model):
     max_fetch_attempts = models.IntegerField(default=3)
     poll_enabled = models.BooleanField(default=True)
 
-    def poll(self):
+    max_concurrency = models.IntegerField(
+        null=True,
+        blank=True,
+        help_text='Maximum number of test jobs being fetched or submitted at the same time (empty = no limit)',
+    )
+    max_requests_per_second = models.FloatField(
+        null=True,
+        blank=True,
+        help_text='Maximum number of test job fetches or submissions per second (empty = no limit)',
+    )
+
+    # leases are considered abandoned (e.g. the worker holding it died)
+    # after this many seconds
+    lease_timeout = 3600
+
+    # how long to wait before trying again when all slots are in use
+    concurrency_retry_delay = 10
+
+    def poll(self, limit=None):
+        """
+        Yields the test jobs that are due to be fetched, i.e. the ones whose
+        next_fetch_at is in the past, oldest first. At most *limit* test
+        jobs are returned, if specified.
+        """
         if not self.poll_enabled:
             return
         test_jobs = self.test_jobs.filter(
             submitted=True,
             fetched=False,
-            fetch_attempts__lt=self.max_fetch_attempts
-        )
+            fetch_attempts__lt=self.max_fetch_attempts,
+            next_fetch_at__lte=timezone.now(),
+        ).order_by('next_fetch_at')
+        if limit:
+            test_jobs = test_jobs[:limit]
         for test_job in test_jobs:
-            last = test_job.last_fetch_attempt
-            if last:
-                now = timezone.now()
-                next_poll = last + relativedelta(minutes=self.poll_interval)
-                if now > next_poll:
-                    yield test_job
-            else:
-                yield test_job
+            yield test_job
 
     def fetch(self, test_job):
         if not test_job.fetched:
@@ -68,6 +92,9 @@ class Backend(models.Model):
     def really_fetch(self, test_job):
         implementation = self.get_implementation()
 
+        # saves the query for the backend when recalculating next_fetch_at
+        test_job.backend = self
+
         test_job.last_fetch_attempt = timezone.now()
         test_job.save()
 
@@ -113,8 +140,6 @@ class Backend(models.Model):
                 test_job.save()
 
                 self.__postprocess_testjob__(test_job)
-
-                UpdateProjectStatus()(testrun)
             except InvalidMetadata as exception:
                 # mark test job as fetched to prevent resubmission
                 # on next fetch attempt
@@ -124,12 +149,16 @@ class Backend(models.Model):
                 test_job.save()
 
     def __postprocess_testjob__(self, test_job):
+        """
+        Runs the test run and test job plugins, and then updates the project
+        status (see PostProcessTestRun).
+        """
+        # squad.ci.tasks imports this module
+        from squad.ci.tasks import postprocess_test_job_plugin
         project = test_job.target
-        for plugin in apply_plugins(project.enabled_plugins):
-            try:
-                plugin.postprocess_testjob(test_job)
-            except Exception as e:
-                logger.error("Plugin postprocessing error: " + str(e) + "\n" + traceback.format_exc())
+        plugins = get_plugins_by_feature([Plugin.postprocess_testjob], project.enabled_plugins or [])
+        tasks = [postprocess_test_job_plugin.si(p, test_job.id) for p in plugins]
+        PostProcessTestRun()(test_job.testrun, tasks)
 
     def submit(self, test_job):
         test_job.job_id = self.get_implementation().submit(test_job)
@@ -137,13 +166,216 @@ class Backend(models.Model):
         test_job.submitted_at = timezone.now()
         test_job.save()
 
+    def submit_many(self, test_jobs):
+        """
+        Submits several test jobs at once (see the submit_many method of the
+        implementations). Returns the test jobs that could not be submitted,
+        as a list of (test_job, SubmissionIssue) tuples.
+        """
+        results = self.get_implementation().submit_many(test_jobs)
+        now = timezone.now()
+        issues = []
+        for test_job, result in zip(test_jobs, results):
+            if isinstance(result, SubmissionIssue):
+                issues.append((test_job, result))
+                continue
+            test_job.job_id = result
+            test_job.submitted = True
+            test_job.submitted_at = now
+            test_job.save()
+        return issues
+
+    def prefetch(self, test_jobs):
+        """
+        Lets the implementation retrieve the data for several test jobs at
+        once, before they are fetched one by one.
+        """
+        self.get_implementation().prefetch(test_jobs)
+
+    # implementation objects, per backend id and configuration. They hold
+    # state that must not be shared between threads (the backend they were
+    # last used for, the XML-RPC proxy, prefetched data), so each thread
+    # has its own; see __implementation_cache__.
+    __implementations__ = threading.local()
+
+    # maximum number of implementation objects kept by each thread
+    max_cached_implementations = 32
+
+    @classmethod
+    def __implementation_cache__(cls):
+        cache = getattr(cls.__implementations__, 'cache', None)
+        if cache is None:
+            cache = cls.__implementations__.cache = OrderedDict()
+        return cache
+
     def get_implementation(self):
-        return get_backend_implementation(self)
+        """
+        Returns the implementation object for this backend. The same object
+        (with its parsed settings, XML-RPC proxy, prefetched data etc) is
+        returned every time in the current thread for as long as the
+        configuration of the backend does not change, so that e.g. listing
+        many test jobs does not parse the backend settings for each of them.
+        """
+        if self.id is None:
+            return get_backend_implementation(self)
+        cache = Backend.__implementation_cache__()
+        key = (self.id, self.implementation_type, self.url, self.username, self.token, self.backend_settings)
+        implementation = cache.get(key)
+        if implementation is None:
+            implementation = get_backend_implementation(self)
+            cache[key] = implementation
+            while len(cache) > self.max_cached_implementations:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(key)
+            # other fields (e.g. name) might have changed
+            implementation.data = self
+        return implementation
+
+    @contextmanager
+    def throttle(self):
+        """
+        Context manager that enforces max_concurrency and
+        max_requests_per_second for the code it wraps, across all workers.
+        Raises squad.ci.exceptions.Throttled, with the number of seconds to
+        wait before trying again, if any of the limits was reached.
+        """
+        lease = self.__acquire__()
+        try:
+            yield
+        finally:
+            if lease is not None:
+                lease.delete()
+
+    def __acquire__(self):
+        if not self.max_concurrency and not self.max_requests_per_second:
+            return None
+
+        now = timezone.now()
+        with transaction.atomic():
+            # the lock on the BackendThrottle row serializes all workers
+            throttle, _ = BackendThrottle.objects.select_for_update().get_or_create(
+                backend=self,
+                defaults={'tokens': 1, 'updated_at': now},
+            )
+
+            if self.max_concurrency:
+                self.leases.filter(expires_at__lte=now).delete()
+                if self.leases.count() >= self.max_concurrency:
+                    raise Throttled(self.concurrency_retry_delay)
+
+            rate = self.max_requests_per_second
+            if rate:
+                # token bucket, allowing bursts of up to one second worth
+                # of requests
+                elapsed = (now - throttle.updated_at).total_seconds()
+                tokens = min(max(1.0, rate), throttle.tokens + elapsed * rate)
+                if tokens < 1:
+                    raise Throttled((1 - tokens) / rate)
+                throttle.tokens = tokens - 1
+                throttle.updated_at = now
+                throttle.save()
+
+            if self.max_concurrency:
+                expires_at = now + relativedelta(seconds=self.lease_timeout)
+                return self.leases.create(expires_at=expires_at)
+        return None
 
     def __str__(self):
         return '%s (%s)' % (self.name, self.implementation_type)
 
 
+class BackendThrottle(models.Model):
+    """
+    Shared state for enforcing the request rate limit of a backend: a token
+    bucket, with the number of tokens available at updated_at.
+    """
+    backend = models.OneToOneField(Backend, related_name='throttle_state')
+    tokens = models.FloatField(default=0)
+    updated_at = models.DateTimeField()
+
+
+class BackendLease(models.Model):
+    """
+    A slot in the concurrency limit of a backend, taken while a test job is
+    being fetched or submitted.
+    """
+    backend = models.ForeignKey(Backend, related_name='leases')
+    expires_at = models.DateTimeField()
+
+
+class Listener(models.Model):
+    """
+    A listener process, when running sharded (see ``squad-admin listen
+    --sharded``). Listeners that stop sending heartbeats are removed, and
+    their backends are taken over by the remaining ones.
+    """
+    name = models.CharField(max_length=255, unique=True)
+    heartbeat_at = models.DateTimeField()
+
+    def __str__(self):
+        return self.name
+
+
+class ListenerLease(models.Model):
+    """
+    Assigns a backend to the listener that listens to it, and holds
+    statistics about the events received from it.
+    """
+    backend = models.OneToOneField(Backend, related_name='listener_lease')
+    listener = models.ForeignKey(Listener, related_name='leases')
+    messages = models.IntegerField(default=0)
+    message_rate = models.FloatField(default=0, help_text='Messages per second')
+    lag = models.FloatField(null=True, help_text='How late, in seconds, the last message was received')
+    last_message_at = models.DateTimeField(null=True)
+
+    @classmethod
+    def record(cls, backend_id, messages, lag):
+        cls.objects.filter(backend_id=backend_id).update(
+            messages=models.F('messages') + messages,
+            lag=lag,
+            last_message_at=timezone.now(),
+        )
+
+
+class BackendChanges(object):
+    """
+    Announces changes to the configuration of backends, so that listeners
+    can be reconfigured right away instead of checking every backend for
+    changes all the time. The version is bumped in the current process; on
+    PostgreSQL, a notification is also sent on the CHANNEL channel
+    (delivered to other processes when the transaction commits).
+    """
+
+    CHANNEL = 'squad_ci_backends'
+
+    version = 0
+
+    @classmethod
+    def notify(cls):
+        cls.version += 1
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('NOTIFY %s' % cls.CHANNEL)
+
+
+@receiver(post_save, sender=Backend)
+@receiver(post_delete, sender=Backend)
+def notify_backend_changes(sender, **kwargs):
+    BackendChanges.notify()
+
+
+@receiver(post_save, sender=Backend)
+@receiver(post_delete, sender=Backend)
+def forget_backend_implementations(sender, instance, **kwargs):
+    # other threads will not find their entries anymore anyway, since a
+    # changed configuration is part of the key; this just frees them sooner
+    cache = Backend.__implementation_cache__()
+    for key in list(cache.keys()):
+        if key[0] == instance.id:
+            cache.pop(key, None)
+
+
 class TestJob(models.Model):
     # input - internal
     backend = models.ForeignKey(Backend, related_name='test_jobs')
@@ -172,6 +404,9 @@ class TestJob(models.Model):
     fetched = models.BooleanField(default=False)
     fetch_attempts = models.IntegerField(default=0)
     last_fetch_attempt = models.DateTimeField(null=True, default=None, blank=True)
+    # when this job should be fetched next; null if there is nothing left to
+    # fetch. This is recalculated on save(), when any of FETCH_FIELDS change.
+    next_fetch_at = models.DateTimeField(null=True, default=None, blank=True, db_index=True)
     failure = models.TextField(null=True, blank=True)
 
     can_resubmit = models.BooleanField(default=False)
@@ -181,10 +416,54 @@ class TestJob(models.Model):
     # reference to the job that was used as base for resubmission
     parent_job = models.ForeignKey('self', default=None, blank=True, null=True, related_name="resubmitted_jobs")
 
+    # fields that next_fetch_at depends on
+    FETCH_FIELDS = ('backend_id', 'submitted', 'submitted_at', 'fetched', 'fetch_attempts', 'last_fetch_attempt')
+
+    def __init__(self, *args, **kwargs):
+        super(TestJob, self).__init__(*args, **kwargs)
+        self.__resolved_build__ = self.__build_key__()
+        self.__fetch_state__ = self.__fetch_key__()
+
+    def __build_key__(self):
+        # don't trigger loading deferred fields
+        return (self.__dict__.get('target_id'), self.__dict__.get('build'))
+
+    def __fetch_key__(self):
+        return tuple(self.__dict__.get(f) for f in self.FETCH_FIELDS)
+
     def save(self, *args, **kwargs):
-        self.target_build = self.target.builds.filter(version=self.build).first()
+        # look up the build only when needed: on creation, when the build or
+        # target change, or while the build does not exist yet
+        key = self.__build_key__()
+        if self._state.adding or self.target_build_id is None or key != self.__resolved_build__:
+            self.target_build = self.target.builds.filter(version=self.build).first()
+            self.__resolved_build__ = key
+        # recalculate next_fetch_at only when it can have changed, so that
+        # unrelated changes don't undo the postponement done by poll
+        fetch_state = self.__fetch_key__()
+        if self._state.adding or fetch_state != self.__fetch_state__:
+            self.next_fetch_at = self.get_next_fetch_at()
+            self.__fetch_state__ = fetch_state
         super(TestJob, self).save(*args, **kwargs)
 
+    def get_next_fetch_at(self):
+        """
+        Submitted jobs are due to be fetched right away, and then every
+        Backend.poll_interval minutes. Each failed fetch attempt doubles the
+        interval until the next one.
+        """
+        if not self.submitted or self.fetched:
+            return None
+        if self.last_fetch_attempt is None and not self.fetch_attempts:
+            return self.submitted_at or timezone.now()
+        backend = self.backend
+        if self.fetch_attempts >= backend.max_fetch_attempts:
+            return None
+        if self.last_fetch_attempt is None:
+            return self.submitted_at or timezone.now()
+        interval = backend.poll_interval * 2 ** self.fetch_attempts
+        return self.last_fetch_attempt + relativedelta(minutes=interval)
+
     def success(self):
         return not self.failure
     success.boolean = True
@@ -1,9 +1,14 @@
 from squad.celery import app as celery
 from squad.ci.models import Backend, TestJob
-from squad.ci.exceptions import SubmissionIssue, FetchIssue
+from squad.ci.exceptions import SubmissionIssue, FetchIssue, Throttled
+from squad.core.mail import send_message
+from squad.core.tasks import RunPlugin
 from celery.utils.log import get_task_logger
+from collections import OrderedDict
+from dateutil.relativedelta import relativedelta
 from django.core.mail import EmailMultiAlternatives
 from django.conf import settings
+from django.utils import timezone
 from django.template.loader import render_to_string
 
 
@@ -17,15 +22,27 @@ def poll(backend_id=None):
     else:
         backends = Backend.objects.all()
     for backend in backends:
-        for test_job in backend.poll():
-            fetch.delay(test_job.id)
+        test_jobs = list(backend.poll(settings.CI_POLL_BATCH_SIZE))
+        if not test_jobs:
+            continue
 
+        # lease these test jobs until their batch is expected to have run,
+        # plus a margin, so that the next poll does not pick them again.
+        # Fetching them sets the actual next_fetch_at; if a batch is lost,
+        # its test jobs are picked up again once the lease expires.
+        lease = relativedelta(minutes=2 * settings.CI_POLL_INTERVAL)
+        TestJob.objects.filter(id__in=[t.id for t in test_jobs]).update(next_fetch_at=timezone.now() + lease)
 
-@celery.task
-def fetch(job_id):
-    test_job = TestJob.objects.get(pk=job_id)
-    if test_job.fetch_attempts >= test_job.backend.max_fetch_attempts:
-        return
+        # fetch in batches, spread evenly until the next poll
+        ids = [t.id for t in test_jobs]
+        size = settings.CI_FETCH_BATCH_SIZE
+        batches = [ids[i:i + size] for i in range(0, len(ids), size)]
+        step = settings.CI_POLL_INTERVAL * 60 / len(batches)
+        for i, batch in enumerate(batches):
+            fetch_batch.apply_async(args=[batch], countdown=int(i * step))
+
+
+def __fetch_test_job__(test_job):
     logger.info("fetching %s" % test_job)
     try:
         test_job.backend.fetch(test_job)
@@ -37,12 +54,69 @@ def fetch(job_id):
         test_job.save()
 
 
+def __reschedule__(task, args, throttled):
+    """
+    Runs *task* again with *args* once the backend is expected to have free
+    slots. Unlike Task.retry, this does not count as a retry: a busy backend
+    is not a failure, so it must not use up the retries that the task has
+    for actual errors, nor ever make it give up.
+    """
+    task.apply_async(args=args, countdown=throttled.retry_after, retries=task.request.retries)
+
+
+@celery.task(bind=True)
+def fetch(self, job_id):
+    test_job = TestJob.objects.get(pk=job_id)
+    if test_job.fetch_attempts >= test_job.backend.max_fetch_attempts:
+        return
+    try:
+        with test_job.backend.throttle():
+            __fetch_test_job__(test_job)
+    except Throttled as throttled:
+        # backend is busy; wait in the queue instead of failing
+        __reschedule__(self, [job_id], throttled)
+
+
+@celery.task(bind=True)
+def fetch_batch(self, job_ids):
+    """
+    Fetches several test jobs at once. The backend implementation gets the
+    chance to retrieve the data for all of them together (see
+    Backend.prefetch), and then each test job is processed as in fetch.
+    """
+    test_jobs = TestJob.objects.filter(pk__in=job_ids).select_related('backend').order_by('id')
+    backends = {}
+    pending = []
+    for test_job in test_jobs:
+        # share one backend object, and thus the prefetched data, among
+        # all test jobs from the same backend
+        test_job.backend = backends.setdefault(test_job.backend_id, test_job.backend)
+        if not test_job.fetched and test_job.fetch_attempts < test_job.backend.max_fetch_attempts:
+            pending.append(test_job)
+
+    done = 0
+    try:
+        for backend in backends.values():
+            with backend.throttle():
+                backend.prefetch([t for t in pending if t.backend is backend])
+        for test_job in pending:
+            with test_job.backend.throttle():
+                __fetch_test_job__(test_job)
+            done += 1
+    except Throttled as throttled:
+        remaining = [t.id for t in pending[done:]]
+        __reschedule__(self, [remaining], throttled)
+
+
 @celery.task(bind=True)
 def submit(self, job_id):
     test_job = TestJob.objects.get(pk=job_id)
     try:
-        test_job.backend.submit(test_job)
+        with test_job.backend.throttle():
+            test_job.backend.submit(test_job)
         test_job.save()
+    except Throttled as throttled:
+        __reschedule__(self, [job_id], throttled)
     except SubmissionIssue as issue:
         logger.error("submitting job %s to %s: %s" % (test_job.id, test_job.backend.name, str(issue)))
         test_job.failure = str(issue)
@@ -51,6 +125,58 @@ def submit(self, job_id):
             raise self.retry(exc=issue, countdown=3600)  # retry in 1 hour
 
 
+@celery.task(bind=True)
+def submit_batch(self, job_ids):
+    """
+    Submits several test jobs at once. The test jobs for each backend are
+    handed to it together (see Backend.submit_many), so that it can submit
+    them in as few requests as possible.
+    """
+    test_jobs = TestJob.objects.filter(pk__in=job_ids, submitted=False).select_related('backend').order_by('id')
+    batches = OrderedDict()
+    for test_job in test_jobs:
+        batches.setdefault(test_job.backend_id, []).append(test_job)
+
+    batches = list(batches.values())
+    failed = []
+    done = 0
+    try:
+        for batch in batches:
+            backend = batch[0].backend
+            try:
+                with backend.throttle():
+                    issues = backend.submit_many(batch)
+            except SubmissionIssue as issue:
+                issues = [(test_job, issue) for test_job in batch]
+            done += 1
+            for test_job, issue in issues:
+                logger.error("submitting job %s to %s: %s" % (test_job.id, backend.name, str(issue)))
+                test_job.failure = str(issue)
+                test_job.save()
+                if issue.retry:
+                    failed.append(test_job.id)
+    except Throttled as throttled:
+        if failed:
+            # same as self.retry, which can't be used here because the
+            # remaining test jobs still have to be rescheduled
+            if self.max_retries is None or self.request.retries < self.max_retries:
+                self.apply_async(args=[failed], countdown=3600, retries=self.request.retries + 1)
+            else:
+                logger.error("giving up submitting jobs %s" % failed)
+        remaining = [t.id for batch in batches[done:] for t in batch]
+        __reschedule__(self, [remaining], throttled)
+        return
+
+    if failed:
+        raise self.retry(args=[failed], countdown=3600)  # retry in 1 hour
+
+
+@celery.task(soft_time_limit=settings.PLUGINS_TIMEOUT, time_limit=settings.PLUGINS_TIMEOUT + 60)
+def postprocess_test_job_plugin(plugin_name, job_id):
+    test_job = TestJob.objects.select_related('testrun').get(pk=job_id)
+    RunPlugin()(plugin_name, 'postprocess_testjob', test_job, test_job.testrun)
+
+
 @celery.task
 def send_testjob_resubmit_admin_email(job_id, resubmitted_job_id):
     test_job = TestJob.objects.get(pk=job_id)
@@ -85,4 +211,4 @@ def send_testjob_resubmit_admin_email(job_id, resubmitted_job_id):
     message = EmailMultiAlternatives(subject, text_message, sender, emails)
     if test_job.target.html_mail:
         message.attach_alternative(html_message, "text/html")
-    message.send()
+    send_message(message)
@@ -0,0 +1,96 @@
+import os
+import ssl
+import threading
+import requests
+
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+from xmlrpc import client as xmlrpclib
+
+
+__sessions__ = {}
+__lock__ = threading.Lock()
+
+
+def get_session(url):
+    """
+    Returns the requests.Session used for all HTTP requests to the server in
+    the given URL from the current process. Sessions keep connections open,
+    so that they are reused by subsequent requests (including XML-RPC calls
+    made through SessionTransport) instead of going through a new TCP and
+    TLS handshake every time.
+    """
+    parts = urlsplit(url)
+    # connections must not be shared with processes forked from this one
+    key = (os.getpid(), parts.scheme, parts.hostname, parts.port)
+    with __lock__:
+        session = __sessions__.get(key)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=settings.CI_HTTP_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            __sessions__[key] = session
+        return session
+
+
+def connection_stats():
+    """
+    Returns a dictionary with how many connections were opened by the
+    sessions of the current process ("connections"), and how many requests
+    were made over them ("requests").
+    """
+    connections = 0
+    requests_made = 0
+    pid = os.getpid()
+    with __lock__:
+        sessions = [s for k, s in __sessions__.items() if k[0] == pid]
+    for session in sessions:
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    connections += pool.num_connections
+                    requests_made += pool.num_requests
+    return {'connections': connections, 'requests': requests_made}
+
+
+class SessionTransport(xmlrpclib.Transport):
+    """
+    XML-RPC transport that makes its requests with the shared session for
+    the server (see get_session), instead of opening a new connection for
+    each call like the standard one does.
+    """
+
+    def __init__(self, url):
+        super(SessionTransport, self).__init__()
+        self.scheme = urlsplit(url).scheme
+        self.session = get_session(url)
+
+    def request(self, host, handler, request_body, verbose=False):
+        # get_host_info takes care of credentials in the URL
+        host, extra_headers, _ = self.get_host_info(host)
+        headers = dict(extra_headers or [])
+        headers['Content-Type'] = 'text/xml'
+        headers['User-Agent'] = self.user_agent
+
+        url = '%s://%s%s' % (self.scheme, host, handler)
+        try:
+            response = self.session.post(url, data=request_body, headers=headers, timeout=settings.CI_HTTP_TIMEOUT)
+        except requests.exceptions.SSLError as error:
+            # same as the standard transport; callers treat these as fatal
+            raise ssl.SSLError(str(error))
+        except requests.RequestException as error:
+            # connection errors, timeouts etc: callers expect the same
+            # exceptions as from the standard transport, and treat
+            # ProtocolError as a temporary issue
+            raise xmlrpclib.ProtocolError(url, 0, str(error), {})
+        if response.status_code != 200:
+            raise xmlrpclib.ProtocolError(url, response.status_code, response.reason, response.headers)
+
+        parser, unmarshaller = self.getparser()
+        parser.feed(response.content)
+        parser.close()
+        return unmarshaller.close()
@@ -0,0 +1,28 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import close_old_connections
+
+
+# threads that do the database work of the listeners running in an asyncio
+# event loop (see `squad-admin listen --asyncio`). Each of them holds its own
+# database connection, so there is a fixed number of them.
+database_threads = ThreadPoolExecutor(max_workers=settings.CI_LISTENER_DATABASE_THREADS)
+
+
+def __run_with_connection__(func, args):
+    # like Django does around each request
+    close_old_connections()
+    try:
+        return func(*args)
+    finally:
+        close_old_connections()
+
+
+async def run_in_database_thread(func, *args):
+    """
+    Runs func(*args), which accesses the database, in one of the database
+    threads, so that it does not block the event loop. Returns its result.
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(database_threads, __run_with_connection__, func, args)
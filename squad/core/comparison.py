@@ -163,13 +163,22 @@ class TestComparison(object):
         comparisons = self.regressions
         if not regression:
             comparisons = self.fixes
-        result = OrderedDict()
-        for env, tests in comparisons.items():
-            this_env = OrderedDict()
-            for test in tests:
-                suite, testname = parse_name(test)
-                if suite not in this_env:
-                    this_env[suite] = []
-                this_env[suite].append(testname)
-            result[env] = this_env
-        return result
+        return group_by_suite(comparisons)
+
+
+def group_by_suite(changes):
+    """
+    Takes a dictionary of environment -> list of full test names (such as
+    TestComparison.regressions) and returns it with each list of tests
+    split into a dictionary of suite -> list of test names.
+    """
+    result = OrderedDict()
+    for env, tests in changes.items():
+        this_env = OrderedDict()
+        for test in tests:
+            suite, testname = parse_name(test)
+            if suite not in this_env:
+                this_env[suite] = []
+            this_env[suite].append(testname)
+        result[env] = this_env
+    return result
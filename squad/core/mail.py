@@ -0,0 +1,186 @@
+import copy
+import logging
+import smtplib
+import threading
+import time
+
+
+from django.conf import settings
+from django.core.mail import get_connection
+
+
+logger = logging.getLogger()
+
+
+class DeliveryStats(object):
+
+    def __init__(self):
+        self.messages = 0
+        self.failures = 0
+        self.seconds = 0.0
+
+    @property
+    def throughput(self):
+        """
+        Messages delivered per second spent talking to the mail server.
+        """
+        if not self.seconds:
+            return 0.0
+        return self.messages / self.seconds
+
+    @property
+    def latency(self):
+        """
+        Average time, in seconds, spent to deliver a single message.
+        """
+        if not self.messages:
+            return 0.0
+        return self.seconds / self.messages
+
+
+class MailDelivery(object):
+    """
+    Delivers outgoing email messages over a single mail server connection
+    that is kept open and reused by all messages sent from the current
+    process, instead of opening a new connection for each message.
+
+    Messages with many recipients are split into batches of at most
+    settings.EMAIL_MAX_RECIPIENTS recipients each. Transient failures (lost
+    connections, 4xx SMTP responses) are retried on a fresh connection up to
+    settings.EMAIL_MAX_ATTEMPTS times.
+    """
+
+    # mail servers drop connections that are idle for too long, so don't
+    # even try to reuse those
+    idle_timeout = 60
+
+    retry_delay = 1
+
+    def __init__(self):
+        self.stats = DeliveryStats()
+        self.__queue__ = []
+        self.__connection__ = None
+        self.__last_used__ = 0
+        self.__lock__ = threading.RLock()
+
+    def queue(self, message):
+        batches = self.__split__(message)
+        with self.__lock__:
+            self.__queue__.extend(batches)
+
+    def flush(self):
+        """
+        Sends all queued messages, and returns how many were sent. If a
+        message cannot be delivered, the exception is raised after trying
+        to send the remaining ones.
+        """
+        with self.__lock__:
+            queue = self.__queue__
+            self.__queue__ = []
+        return self.__deliver__(queue)
+
+    def send(self, message):
+        return self.__deliver__(self.__split__(message))
+
+    def close(self):
+        with self.__lock__:
+            if self.__connection__ is not None:
+                try:
+                    self.__connection__.close()
+                except Exception:
+                    pass
+                self.__connection__ = None
+
+    def __split__(self, message):
+        """
+        Splits a message in batches of at most EMAIL_MAX_RECIPIENTS "to"
+        recipients. Cc and Bcc recipients only get the first batch.
+        """
+        max_recipients = settings.EMAIL_MAX_RECIPIENTS
+        recipients = message.to
+        if len(recipients) <= max_recipients:
+            return [message]
+        batches = []
+        for i in range(0, len(recipients), max_recipients):
+            batch = copy.copy(message)
+            batch.to = recipients[i:i + max_recipients]
+            if i > 0:
+                batch.cc = []
+                batch.bcc = []
+            batches.append(batch)
+        return batches
+
+    def __deliver__(self, messages):
+        if not messages:
+            return 0
+
+        start = time.time()
+        sent = 0
+        error = None
+        for message in messages:
+            try:
+                self.__send__(message)
+                sent += 1
+            except Exception as e:
+                error = e
+                with self.__lock__:
+                    self.stats.failures += 1
+        elapsed = time.time() - start
+
+        with self.__lock__:
+            self.stats.messages += sent
+            self.stats.seconds += elapsed
+            logger.info(
+                "Delivered %d email message(s) in %.3fs; %.1f messages/s, %.3fs/message on average" % (
+                    sent, elapsed, self.stats.throughput, self.stats.latency
+                )
+            )
+
+        if error:
+            raise error
+        return sent
+
+    def __send__(self, message):
+        attempts = settings.EMAIL_MAX_ATTEMPTS
+        for attempt in range(1, attempts + 1):
+            # the lock is only held while talking to the mail server, so
+            # that other senders are not blocked while this one backs off
+            with self.__lock__:
+                try:
+                    self.__get_connection__().send_messages([message])
+                    self.__last_used__ = time.time()
+                    return
+                except Exception as e:
+                    self.close()
+                    if attempt == attempts or not self.__is_transient__(e):
+                        raise
+                    logger.warning("Email delivery failed (attempt %d of %d): %s" % (attempt, attempts, e))
+            time.sleep(self.retry_delay * 2 ** (attempt - 1))
+
+    def __get_connection__(self):
+        if self.__connection__ is not None and time.time() - self.__last_used__ > self.idle_timeout:
+            self.close()
+        if self.__connection__ is None:
+            self.__connection__ = get_connection()
+            self.__connection__.open()
+        return self.__connection__
+
+    def __is_transient__(self, error):
+        if isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)):
+            return True
+        if isinstance(error, smtplib.SMTPResponseException):
+            return 400 <= error.smtp_code < 500
+        if isinstance(error, smtplib.SMTPException):
+            return False
+        return isinstance(error, OSError)
+
+
+delivery = MailDelivery()
+
+
+def send_message(message):
+    """
+    Sends an email message (e.g. django.core.mail.EmailMultiAlternatives)
+    using the shared MailDelivery instance.
+    """
+    return delivery.send(message)
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 22:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0091_notification_delivery_remove_unique_status'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='project',
+            name='notification_strategy',
+            field=models.CharField(choices=[('all', 'All builds'), ('change', 'Only on change'), ('digest', 'Periodic digest')], default='all', max_length=32),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 23:41
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def set_digest_since(apps, schema_editor):
+    Project = apps.get_model('core', 'Project')
+    Project.objects.filter(notification_strategy='digest').update(digest_since=timezone.now())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0092_project_notify_digest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='digest_since',
+            field=models.DateTimeField(editable=False, null=True),
+        ),
+        migrations.RunPython(
+            set_digest_since,
+            reverse_code=migrations.RunPython.noop,
+        ),
+    ]
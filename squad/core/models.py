@@ -3,12 +3,17 @@ import json
 import yaml
 from collections import OrderedDict
 from hashlib import sha1
+from uuid import uuid4
 
 
 from dateutil.relativedelta import relativedelta
+from django.conf import settings
+from django.core.cache import cache
 from django.db import models
 from django.db.models import Q, Count
 from django.db.models.query import prefetch_related_objects
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
 from django.contrib.auth.models import Group as UserGroup
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
@@ -30,14 +35,77 @@ slug_pattern = '[a-zA-Z0-9][a-zA-Z0-9_.-]*'
 slug_validator = RegexValidator(regex='^' + slug_pattern)
 
 
+class AccessCache(object):
+    """
+    Caches access control information for each user (e.g. which groups they
+    are a member of) for settings.ACCESS_CACHE_TIMEOUT seconds. All entries
+    are invalidated at once when group membership or projects change, by
+    changing the version that is part of all the cache keys. Nothing is
+    cached when ACCESS_CACHE_TIMEOUT is 0 (the default).
+
+    Invalidation only reaches other processes if they share the cache backend
+    (e.g. memcached or redis); with a per-process cache, other processes can
+    see stale information for up to ACCESS_CACHE_TIMEOUT seconds.
+    """
+
+    VERSION_KEY = 'squad:access:version'
+
+    @classmethod
+    def enabled(cls):
+        return settings.ACCESS_CACHE_TIMEOUT > 0
+
+    @classmethod
+    def get(cls, user, kind, compute):
+        if not cls.enabled():
+            return compute()
+        key = cls.__key__(user, kind)
+        value = cache.get(key)
+        if value is None:
+            value = compute()
+            cache.set(key, value, settings.ACCESS_CACHE_TIMEOUT)
+        return value
+
+    @classmethod
+    def invalidate(cls):
+        cache.set(cls.VERSION_KEY, uuid4().hex, None)
+
+    @classmethod
+    def __key__(cls, user, kind):
+        version = cache.get(cls.VERSION_KEY)
+        if version is None:
+            cache.add(cls.VERSION_KEY, uuid4().hex, None)
+            version = cache.get(cls.VERSION_KEY)
+        if user.is_superuser or user.is_staff:
+            who = 'admin'
+        elif user.is_authenticated:
+            who = 'user%d' % user.id
+        else:
+            who = 'anonymous'
+        return 'squad:access:%s:%s:%s' % (version, kind, who)
+
+
 class GroupManager(models.Manager):
 
     def accessible_to(self, user):
         projects = Project.objects.accessible_to(user)
-        project_ids = [p.id for p in projects]
-        group_ids = set([p.group_id for p in projects])
+        project_ids = projects.values('id')
+        group_ids = projects.values('group_id')
         return self.filter(id__in=group_ids).annotate(project_count=Count('projects', filter=Q(id__in=project_ids)))
 
+    def member_group_ids(self, user):
+        """
+        Returns the ids of the groups that *user* is a member of, i.e. the
+        groups associated with any of the user's Django groups.
+        """
+        if not user.is_authenticated:
+            return []
+
+        def compute():
+            groups = Group.objects.filter(user_groups__in=user.groups.all())
+            return list(groups.values_list('id', flat=True).distinct())
+
+        return AccessCache.get(user, 'groups', compute)
+
 
 class Group(models.Model):
     objects = GroupManager()
@@ -60,10 +128,18 @@ class ProjectManager(models.Manager):
         if user.is_superuser or user.is_staff:
             return self.all()
         else:
-            groups = Group.objects.filter(user_groups__in=user.groups.all())
-            group_ids = [g['id'] for g in groups.values('id')]
+            group_ids = Group.objects.member_group_ids(user)
             return self.filter(Q(group_id__in=group_ids) | Q(is_public=True))
 
+    def accessible_ids(self, user):
+        """
+        Returns a list with the ids of all projects accessible to *user*.
+        """
+        def compute():
+            return list(Project.objects.accessible_to(user).values_list('id', flat=True))
+
+        return AccessCache.get(user, 'projects', compute)
+
 
 class EmailTemplate(models.Model):
     name = models.CharField(max_length=100, unique=True)
@@ -108,16 +184,28 @@ class Project(models.Model):
 
     NOTIFY_ALL_BUILDS = 'all'
     NOTIFY_ON_CHANGE = 'change'
+    NOTIFY_DIGEST = 'digest'
     notification_strategy = models.CharField(
         max_length=32,
-        choices=((NOTIFY_ALL_BUILDS, 'All builds'), (NOTIFY_ON_CHANGE, 'Only on change')),
+        choices=((NOTIFY_ALL_BUILDS, 'All builds'), (NOTIFY_ON_CHANGE, 'Only on change'), (NOTIFY_DIGEST, 'Periodic digest')),
         default='all'
     )
+    # when the digest notification strategy was enabled; digests only
+    # include builds created since then
+    digest_since = models.DateTimeField(null=True, editable=False)
 
     def __init__(self, *args, **kwargs):
         super(Project, self).__init__(*args, **kwargs)
         self.__status__ = None
 
+    def save(self, *args, **kwargs):
+        if self.notification_strategy == Project.NOTIFY_DIGEST:
+            if self.digest_since is None:
+                self.digest_since = timezone.now()
+        else:
+            self.digest_since = None
+        super(Project, self).save(*args, **kwargs)
+
     @property
     def status(self):
         if not self.__status__:
@@ -130,7 +218,7 @@ class Project(models.Model):
         return self.is_public or self.writable_by(user)
 
     def writable_by(self, user):
-        return user.is_superuser or user.is_staff or self.group.user_groups.filter(id__in=user.groups.all()).exists()
+        return user.is_superuser or user.is_staff or self.group_id in Group.objects.member_group_ids(user)
 
     @property
     def full_name(self):
@@ -148,6 +236,18 @@ class Project(models.Model):
         return self.enabled_plugins_list
 
 
+@receiver(m2m_changed, sender=Group.user_groups.through)
+@receiver(m2m_changed, sender=User.groups.through)
+@receiver(post_save, sender=Project)
+@receiver(post_delete, sender=Project)
+@receiver(post_delete, sender=Group)
+@receiver(post_delete, sender=UserGroup)
+def invalidate_access_cache(sender, **kwargs):
+    action = kwargs.get('action')
+    if action is None or action.startswith('post_'):
+        AccessCache.invalidate()
+
+
 class Token(models.Model):
     project = models.ForeignKey(Project, related_name='tokens', null=True)
     key = models.CharField(max_length=64, unique=True)
@@ -519,12 +619,16 @@ class Test(models.Model):
 
     @property
     def status(self):
-        if self.result:
+        return Test.get_status(self.result, self.has_known_issues)
+
+    @staticmethod
+    def get_status(result, has_known_issues):
+        if result:
             return 'pass'
-        elif self.result is None:
+        elif result is None:
             return 'skip'
         else:
-            if self.has_known_issues:
+            if has_known_issues:
                 return 'xfail'
             else:
                 return 'fail'
@@ -730,6 +834,13 @@ class ProjectStatus(models.Model, TestSummaryBase):
         blank=True,
         validators=[yaml_validator]
     )
+    # the build that regressions and fixes were computed against
+    baseline = models.ForeignKey(
+        'Build',
+        null=True,
+        related_name='+',
+        on_delete=models.SET_NULL,
+    )
 
     class Meta:
         verbose_name_plural = "Project statuses"
@@ -754,13 +865,13 @@ class ProjectStatus(models.Model, TestSummaryBase):
             status__finished=True,
             datetime__lt=build.datetime,
             project=build.project,
-        ).order_by('build__datetime').last()
+        ).order_by('datetime').last()
         if previous_build is not None:
             comparison = TestComparison(previous_build, build)
             if comparison.regressions:
-                regressions = yaml.dump(comparison.regressions)
+                regressions = yaml.dump(dict(comparison.regressions))
             if comparison.fixes:
-                fixes = yaml.dump(comparison.fixes)
+                fixes = yaml.dump(dict(comparison.fixes))
 
         finished, _ = build.finished
         data = {
@@ -776,7 +887,8 @@ class ProjectStatus(models.Model, TestSummaryBase):
             'test_runs_completed': test_runs_completed,
             'test_runs_incomplete': test_runs_incomplete,
             'regressions': regressions,
-            'fixes': fixes
+            'fixes': fixes,
+            'baseline': previous_build,
         }
 
         status, created = cls.objects.get_or_create(build=build, defaults=data)
@@ -800,6 +912,7 @@ class ProjectStatus(models.Model, TestSummaryBase):
             status.test_runs_incomplete = test_runs_incomplete
             status.regressions = regressions
             status.fixes = fixes
+            status.baseline = previous_build
             status.save()
         return status
 
@@ -1,31 +1,98 @@
 from collections import OrderedDict
+from hashlib import sha1
 from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.core.mail import EmailMultiAlternatives
 from django.conf import settings
 import django.template
 from django.template.loader import render_to_string
 from re import sub
+from threading import Lock
 
 
-from squad.core.models import Project, ProjectStatus, Build, KnownIssue, NotificationDelivery
-from squad.core.comparison import TestComparison
+from squad.core.models import Project, ProjectStatus, Build, KnownIssue, NotificationDelivery, EmailTemplate
+from squad.core.comparison import TestComparison, group_by_suite
+from squad.core.mail import send_message
 
 
 jinja2 = django.template.engines['jinja2']
 
 
+class CompiledTemplates(object):
+    """
+    Cache of compiled Jinja2 templates, so that the templates from
+    EmailTemplate objects are not parsed and compiled again for every
+    notification. Templates are keyed by the id of the EmailTemplate they
+    come from plus a hash of their source, so a template that changed is
+    never served from the cache, even if it was changed in another process.
+    At most MAX_SIZE templates are kept; the least recently used ones are
+    dropped first.
+    """
+
+    MAX_SIZE = 256
+
+    __templates__ = OrderedDict()
+    __lock__ = Lock()
+
+    @classmethod
+    def get(cls, source, template_id=None):
+        key = (template_id, sha1(source.encode()).hexdigest())
+        with cls.__lock__:
+            template = cls.__templates__.get(key)
+            if template is not None:
+                cls.__templates__.move_to_end(key)
+                return template
+
+        template = jinja2.from_string(source)
+
+        with cls.__lock__:
+            cls.__templates__[key] = template
+            while len(cls.__templates__) > cls.MAX_SIZE:
+                cls.__templates__.popitem(last=False)
+        return template
+
+    @classmethod
+    def invalidate(cls, template_id):
+        with cls.__lock__:
+            for key in [k for k in cls.__templates__ if k[0] == template_id]:
+                del cls.__templates__[key]
+
+    @classmethod
+    def precompile(cls, email_template):
+        for source in (email_template.subject, email_template.plain_text, email_template.html):
+            if source:
+                cls.get(source, email_template.id)
+
+
+@receiver(post_save, sender=EmailTemplate)
+@receiver(post_delete, sender=EmailTemplate)
+def invalidate_compiled_templates(sender, instance, **kwargs):
+    CompiledTemplates.invalidate(instance.id)
+
+
 class Notification(object):
     """
     Represents a notification about a project status change, that may or may
     not need to be sent.
+
+    Regressions and fixes are taken from the ones stored in the
+    ProjectStatus when comparing against the default baseline (i.e. the
+    previous finished build), as long as they were computed against that
+    same build; the full comparison between both builds is only done when
+    the complete diff is needed.
     """
 
     def __init__(self, status, previous=None):
         self.status = status
         self.build = status.build
+        use_stored_changes = previous is None
         if previous is None:
             previous = status.get_previous()
+        self.previous_status = previous
         self.previous_build = previous and previous.build or None
+        previous_build_id = previous and previous.build_id or None
+        self.__use_stored_changes__ = use_stored_changes and status.baseline_id == previous_build_id
 
     __comparison__ = None
 
@@ -42,6 +109,36 @@ class Notification(object):
     def diff(self):
         return self.comparison.diff
 
+    @property
+    def regressions(self):
+        if self.__use_stored_changes__ and self.__comparison__ is None:
+            return self.status.get_regressions()
+        return self.comparison.regressions
+
+    @property
+    def fixes(self):
+        if self.__use_stored_changes__ and self.__comparison__ is None:
+            return self.status.get_fixes()
+        return self.comparison.fixes
+
+    @property
+    def has_changes(self):
+        """
+        Returns whether any test results changed since the previous build.
+        Stored regressions and fixes, and the test totals of both builds,
+        are checked first; only when those show no changes is the full diff
+        computed.
+        """
+        if self.previous_build is None:
+            return False
+        if self.regressions or self.fixes:
+            return True
+        totals = ('tests_pass', 'tests_fail', 'tests_xfail', 'tests_skip')
+        previous = self.previous_status
+        if any(getattr(self.status, t) != getattr(previous, t) for t in totals):
+            return True
+        return bool(self.diff)
+
     @property
     def project(self):
         return self.build.project
@@ -82,44 +179,46 @@ class Notification(object):
             'important_metadata': self.important_metadata,
             'metadata': self.metadata,
             'project': self.project,
-            'regressions': len(self.comparison.regressions),
+            'regressions': len(self.regressions),
             'tests_fail': summary.tests_fail,
             'tests_pass': summary.tests_pass,
             'tests_total': summary.tests_total,
         }
         custom_email_template = self.project.custom_email_template
         if custom_email_template and custom_email_template.subject:
-            template = custom_email_template.subject
+            template = CompiledTemplates.get(custom_email_template.subject, custom_email_template.id)
         else:
-            template = '{{project}}: {{tests_total}} tests, {{tests_fail}} failed, {{tests_pass}} passed (build {{build}})'
-        return jinja2.from_string(template).render(subject_data)
+            template = CompiledTemplates.get('{{project}}: {{tests_total}} tests, {{tests_fail}} failed, {{tests_pass}} passed (build {{build}})')
+        return template.render(subject_data)
 
     def message(self, do_html=True, custom_email_template=None):
         """
         Returns a tuple with (text_message,html_message)
         """
+        regressions = self.regressions
+        fixes = self.fixes
         context = {
             'build': self.build,
             'important_metadata': self.important_metadata,
             'metadata': self.metadata,
             'notification': self,
             'previous_build': self.previous_build,
-            'regressions_grouped_by_suite': self.comparison.regressions_grouped_by_suite,
-            'fixes_grouped_by_suite': self.comparison.fixes_grouped_by_suite,
+            'regressions_grouped_by_suite': group_by_suite(regressions),
+            'fixes_grouped_by_suite': group_by_suite(fixes),
             'known_issues': self.known_issues,
-            'regressions': self.comparison.regressions,
-            'fixes': self.comparison.fixes,
+            'regressions': regressions,
+            'fixes': fixes,
             'settings': settings,
             'summary': self.summary,
         }
 
         html_message = ''
         if custom_email_template:
-            text_template = jinja2.from_string(custom_email_template.plain_text)
+            text_template = CompiledTemplates.get(custom_email_template.plain_text, custom_email_template.id)
             text_message = text_template.render(context)
 
             if do_html:
-                html_template = jinja2.from_string(custom_email_template.html)
+                html_template = CompiledTemplates.get(custom_email_template.html, custom_email_template.id)
                 html_message = html_template.render(context)
         else:
             text_message = render_to_string(
@@ -149,7 +248,7 @@ class Notification(object):
         message = EmailMultiAlternatives(subject, txt, sender, recipients)
         if self.project.html_mail:
             message.attach_alternative(html, "text/html")
-        message.send()
+        send_message(message)
 
         self.mark_as_notified()
 
@@ -189,17 +288,115 @@ class PreviewNotification(Notification):
         return (txt, html)
 
 
+class Digest(object):
+    """
+    A single notification about all the builds of a project that finished
+    since the last digest was sent, for projects using the
+    Project.NOTIFY_DIGEST notification strategy. Builds created before the
+    project switched to that strategy are not included.
+
+    Regressions and fixes are the ones stored in each build's ProjectStatus,
+    so no builds need to be compared to produce a digest.
+    """
+
+    def __init__(self, project):
+        self.project = project
+        statuses = ProjectStatus.objects.filter(
+            build__project=project,
+            finished=True,
+            notified=False,
+        )
+        if project.digest_since:
+            statuses = statuses.filter(created_at__gte=project.digest_since)
+        if project.moderate_notifications:
+            statuses = statuses.filter(approved=True)
+        self.statuses = list(statuses.select_related('build').order_by('build__datetime'))
+
+    @property
+    def builds(self):
+        return [status.build for status in self.statuses]
+
+    def __merge_changes__(self, get_changes):
+        result = OrderedDict()
+        for status in self.statuses:
+            for env, tests in get_changes(status).items():
+                env_tests = result.setdefault(env, [])
+                env_tests += [t for t in tests if t not in env_tests]
+        return result
+
+    @property
+    def regressions(self):
+        return self.__merge_changes__(lambda status: status.get_regressions())
+
+    @property
+    def fixes(self):
+        return self.__merge_changes__(lambda status: status.get_fixes())
+
+    @property
+    def recipients(self):
+        emails = []
+        for subscription in self.project.subscriptions.select_related('user'):
+            email = subscription.get_email()
+            if email:
+                emails.append(email)
+        return emails
+
+    @property
+    def subject(self):
+        builds = self.builds
+        return '%s: %d builds (%s to %s)' % (self.project, len(builds), builds[0].version, builds[-1].version)
+
+    def message(self, do_html=True):
+        """
+        Returns a tuple with (text_message,html_message)
+        """
+        context = {
+            'project': self.project,
+            'statuses': self.statuses,
+            'regressions': self.regressions,
+            'fixes': self.fixes,
+            'settings': settings,
+        }
+        text_message = render_to_string('squad/notification/digest.txt', context=context)
+        html_message = ''
+        if do_html:
+            html_message = render_to_string('squad/notification/digest.html', context=context)
+        return (text_message, html_message)
+
+    def send(self):
+        if not self.statuses:
+            return
+
+        recipients = self.recipients
+        if recipients:
+            sender = "%s <%s>" % (settings.SITE_NAME, settings.EMAIL_FROM)
+            subject = self.subject
+            txt, html = self.message(self.project.html_mail)
+
+            last_status = self.statuses[-1]
+            if not NotificationDelivery.exists(last_status, subject, txt, html):
+                message = EmailMultiAlternatives(subject, txt, sender, recipients)
+                if self.project.html_mail:
+                    message.attach_alternative(html, "text/html")
+                send_message(message)
+
+        ProjectStatus.objects.filter(id__in=[s.id for s in self.statuses]).update(notified=True)
+
+
 def send_status_notification(status, project=None):
     project = project or status.build.project
     send_admin_notification(status, project)
 
     if project.moderate_notifications and not status.approved:
         notification = PreviewNotification(status)
+    elif project.notification_strategy == Project.NOTIFY_DIGEST:
+        # will be included in the next digest; see Digest
+        return
     else:
         notification = Notification(status)
 
     if project.notification_strategy == Project.NOTIFY_ON_CHANGE:
-        if not notification.diff or not notification.previous_build:
+        if not notification.has_changes:
             return
 
     notification.send()
@@ -238,4 +435,4 @@ def send_admin_notification(status, project):
     if NotificationDelivery.exists(status, subject, txt, html):
         return
 
-    message.send()
+    send_message(message)
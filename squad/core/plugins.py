@@ -1,61 +1,138 @@
+import os
 from django.db import models
 from django.forms import MultipleChoiceField, ChoiceField, CheckboxSelectMultiple
-from pkg_resources import EntryPoint, iter_entry_points
+from importlib import import_module
 from pkgutil import iter_modules
 
+try:
+    from importlib.metadata import entry_points
+except ImportError:
+    # Python < 3.8
+    entry_points = None
+
 
 class PluginNotFound(Exception):
     pass
 
 
+def __builtin_plugins__():
+    path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'plugins')
+    return {
+        m: (lambda m=m: import_module('squad.plugins.' + m).Plugin)
+        for _, m, _ in iter_modules([path])
+    }
+
+
+def __external_plugins__():
+    if entry_points is None:
+        # importing pkg_resources is slow, so only do it when needed
+        from pkg_resources import iter_entry_points
+        return {e.name: e.resolve for e in iter_entry_points('squad_plugins')}
+
+    all_entry_points = entry_points()
+    if hasattr(all_entry_points, 'select'):
+        plugins = all_entry_points.select(group='squad_plugins')
+    else:
+        plugins = all_entry_points.get('squad_plugins', [])
+    return {e.name: e.load for e in plugins}
+
+
 class PluginLoader(object):
+    """
+    Registry of the available plugins, i.e. the modules in squad.plugins
+    and the ones registered under the `squad_plugins` entry point group.
+
+    Plugins are only imported when first used, and a single instance of
+    each plugin is shared by all its users. The plugins implementing each
+    hook (i.e. each Plugin method) are also only looked up once.
+    """
+
+    # plugin name => function that imports the plugin and returns its class
+    __entry_points__ = None
+
+    __plugins__ = {}
+    __instances__ = {}
 
-    __plugins__ = None
+    # hook name => {plugin name => whether the plugin implements it}
+    __hooks__ = {}
 
     @classmethod
-    def load_all(cls):
-        if cls.__plugins__ is not None:
-            return cls.__plugins__
+    def names(cls):
+        if cls.__entry_points__ is None:
+            loaders = __builtin_plugins__()
+            loaders.update(__external_plugins__())
+            cls.__entry_points__ = loaders
+        return list(cls.__entry_points__.keys())
 
-        entry_points = []
+    @classmethod
+    def load(cls, name):
+        plugin = cls.__plugins__.get(name)
+        if plugin is None:
+            if name not in cls.names():
+                raise PluginNotFound(name)
+            plugin = cls.__entry_points__[name]()
+            cls.__plugins__[name] = plugin
+        return plugin
 
-        # builtin plugins
-        for _, m, _ in iter_modules(['squad/plugins']):
-            e = EntryPoint(m, 'squad.plugins.' + m, attrs=('Plugin',))
-            entry_points.append(e)
+    @classmethod
+    def load_all(cls):
+        return {name: cls.load(name) for name in cls.names()}
 
-        # external plugins
-        plugins = iter_entry_points('squad_plugins')
-        entry_points += list(plugins)
+    @classmethod
+    def get_instance(cls, name):
+        instance = cls.__instances__.get(name)
+        if instance is None:
+            instance = cls.load(name)()
+            cls.__instances__[name] = instance
+        return instance
 
-        cls.__plugins__ = {e.name: e.resolve() for e in entry_points}
-        return cls.__plugins__
+    @classmethod
+    def implementing(cls, hook, names):
+        """
+        Returns the names, out of *names*, of the plugins that implement the
+        given hook, i.e. that override that method of Plugin. Only those
+        plugins are loaded; names of plugins that don't exist are left out.
+        """
+        implemented = cls.__hooks__.setdefault(hook, {})
+        default = getattr(Plugin, hook, None)
+        plugins = []
+        for name in names:
+            if name not in implemented:
+                try:
+                    plugin = cls.load(name)
+                except PluginNotFound:
+                    continue
+                implemented[name] = getattr(plugin, hook, default) is not default
+            if implemented[name]:
+                plugins.append(name)
+        return plugins
 
 
 def get_plugin_instance(name):
-    try:
-        plugin_class = PluginLoader.load_all()[name]
-    except KeyError:
-        raise PluginNotFound(name)
-    return plugin_class()
+    return PluginLoader.get_instance(name)
 
 
 def get_all_plugins():
-    plugins = PluginLoader.load_all()
-    return plugins.keys()
+    return PluginLoader.names()
 
 
-def get_plugins_by_feature(features):
+def get_plugins_by_feature(features, plugin_names=None):
     """
     Returns a list of plugin names where the plugins implement at least one of
     the *features*. *features* must a list of Plugin methods, e.g.
     [Plugin.postprocess_testrun, Plugin.postprocess_testjob]
+
+    If *plugin_names* is given, only those plugins are considered, and they
+    are returned in the same order.
     """
+    if plugin_names is None:
+        plugin_names = get_all_plugins()
     if not features:
-        return get_all_plugins()
-    plugins = PluginLoader.load_all().items()
-    names = set([f.__name__ for f in features])
-    return [e for e, plugin in plugins if names & set(plugin.__dict__.keys())]
+        return list(plugin_names)
+    implementing = set()
+    for feature in features:
+        implementing.update(PluginLoader.implementing(feature.__name__, plugin_names))
+    return [name for name in plugin_names if name in implementing]
 
 
 def apply_plugins(plugin_names):
@@ -57,3 +57,37 @@ def get_tests_series(project, environments):
             for s in series
         ]
     return results
+
+
+def get_builds_results(builds):
+    """
+    Summarizes the test results of several builds at once, from a single
+    grouped query. Returns a dictionary mapping build ids to environment
+    slugs, and those to the test counts for that environment, with the counts
+    for each suite under "suites".
+    """
+    statuses = models.Status.objects.filter(
+        test_run__build__in=builds,
+    ).values(
+        'test_run__build_id',
+        'test_run__environment__slug',
+        'suite__slug',
+    ).annotate(
+        **{
+            'pass': Sum('tests_pass'),
+            'fail': Sum('tests_fail'),
+            'xfail': Sum('tests_xfail'),
+            'skip': Sum('tests_skip'),
+        }
+    ).order_by()
+
+    results = {}
+    for s in statuses:
+        environments = results.setdefault(s['test_run__build_id'], {})
+        entry = environments.setdefault(s['test_run__environment__slug'], {'suites': {}})
+        counts = {k: s[k] for k in ('pass', 'fail', 'xfail', 'skip')}
+        if s['suite__slug'] is None:
+            entry.update(counts)
+        else:
+            entry['suites'][s['suite__slug']] = counts
+    return results
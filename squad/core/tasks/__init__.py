@@ -1,10 +1,13 @@
 from collections import defaultdict
 import json
 import logging
+import time
 import traceback
 import uuid
 
 
+from celery import chain
+from django.conf import settings
 from django.db import transaction
 
 
@@ -12,7 +15,7 @@ from squad.celery import app as celery
 from squad.core.models import TestRun, Suite, SuiteVersion, SuiteMetadata, Test, Metric, Status, ProjectStatus, KnownIssue
 from squad.core.data import JSONTestDataParser, JSONMetricDataParser
 from squad.core.statistics import geomean
-from squad.core.plugins import apply_plugins
+from squad.core.plugins import Plugin, PluginNotFound, get_plugin_instance, get_plugins_by_feature
 from squad.core.utils import join_name
 from . import exceptions
 
@@ -87,6 +90,12 @@ class ValidateTestRun(object):
 
 
 class ReceiveTestRun(object):
+    """
+    Creates and processes a test run. Unless *update_project_status* is
+    False, it is also post-processed by the enabled plugins and then the
+    project status is updated (see PostProcessTestRun); otherwise, that is
+    left to the caller.
+    """
 
     def __init__(self, project, update_project_status=True):
         self.project = project
@@ -150,7 +159,7 @@ class ReceiveTestRun(object):
         processor(testrun)
 
         if self.update_project_status:
-            UpdateProjectStatus()(testrun)
+            PostProcessTestRun()(testrun)
 
         return testrun
 
@@ -221,17 +230,72 @@ class ParseTestRunData(object):
 
 
 class PostProcessTestRun(object):
-
-    def __call__(self, testrun):
+    """
+    Runs the postprocess_testrun hook of the plugins enabled for the
+    project, followed by any other plugin *tasks* given (e.g. for test job
+    hooks), and then updates the project status.
+
+    Each plugin runs in a background task of its own (see RunPlugin), so
+    that slow plugins don't hold the processing of the test run. The tasks
+    run one after the other, in a chain, and the project status is only
+    updated, and notifications sent, after all of them are done, so that
+    they include the tests added by plugins. A plugin task that fails, or is
+    killed for taking too long, does not prevent the update.
+    """
+
+    def __call__(self, testrun, tasks=()):
         project = testrun.build.project
-        for plugin in apply_plugins(project.enabled_plugins):
-            try:
-                self.__call_plugin__(plugin, testrun)
-            except Exception as e:
-                logger.error("Plugin postprocessing error: " + str(e) + "\n" + traceback.format_exc())
+        plugins = get_plugins_by_feature([Plugin.postprocess_testrun], project.enabled_plugins or [])
+        tasks = [postprocess_test_run_plugin.si(p, testrun.id) for p in plugins] + list(tasks)
+        if not tasks:
+            UpdateProjectStatus()(testrun)
+            return
+
+        update = update_project_status.si(testrun.id)
+        try:
+            chain(*(tasks + [update])).apply_async(link_error=update)
+        except OSError as e:
+            # can't request background task (see UpdateProjectStatus); run the
+            # plugins right away instead.
+            logger.error("Cannot schedule plugins: " + str(e) + "\n" + traceback.format_exc())
+            for task in tasks:
+                task()
+            UpdateProjectStatus()(testrun)
+
+
+class RunPlugin(object):
+    """
+    Calls a hook of a plugin, with all changes made by the plugin saved in a
+    transaction of its own. Plugins can add tests or metrics to the given
+    test run, or change existing ones, so its status is recalculated after
+    the plugin runs successfully. The project status is updated later, once
+    all plugins are done (see PostProcessTestRun).
+    """
+
+    @staticmethod
+    def __call__(plugin_name, hook, obj, testrun=None):
+        try:
+            plugin = get_plugin_instance(plugin_name)
+        except PluginNotFound:
+            return
 
-    def __call_plugin__(self, plugin, testrun):
-        plugin.postprocess_testrun(testrun)
+        succeeded = False
+        start = time.time()
+        try:
+            with transaction.atomic():
+                getattr(plugin, hook)(obj)
+            succeeded = True
+        except Exception as e:
+            logger.error("Plugin postprocessing error: " + str(e) + "\n" + traceback.format_exc())
+        logger.info("Plugin %s: %s(%s) took %.3fs" % (plugin_name, hook, obj.id, time.time() - start))
+
+        if succeeded and testrun is not None:
+            with transaction.atomic():
+                # the lock serializes status updates for the same test run
+                testrun = TestRun.objects.select_for_update().get(pk=testrun.pk)
+                testrun.status.all().delete()
+                testrun.status_recorded = False
+                RecordTestRunStatus()(testrun)
 
 
 @celery.task
@@ -246,6 +310,26 @@ def postprocess_test_run(test_run_id):
     PostProcessTestRun()(testrun)
 
 
+@celery.task
+def update_project_status(test_run_id):
+    try:
+        testrun = TestRun.objects.get(pk=test_run_id)
+    except TestRun.DoesNotExist:
+        logger.error("TestRun with ID: %s not found" % test_run_id)
+        return
+    UpdateProjectStatus()(testrun)
+
+
+@celery.task(soft_time_limit=settings.PLUGINS_TIMEOUT, time_limit=settings.PLUGINS_TIMEOUT + 60)
+def postprocess_test_run_plugin(plugin_name, test_run_id):
+    try:
+        testrun = TestRun.objects.get(pk=test_run_id)
+    except TestRun.DoesNotExist:
+        logger.error("TestRun with ID: %s not found" % test_run_id)
+        return
+    RunPlugin()(plugin_name, 'postprocess_testrun', testrun, testrun)
+
+
 def get_suite_version(test_run, suite):
     if not suite:
         return None
@@ -322,12 +406,16 @@ class UpdateProjectStatus(object):
 
 
 class ProcessTestRun(object):
+    """
+    Parses the data of a test run and records its status. Plugins run later,
+    outside of this transaction, so that they don't keep it open for as
+    long as they take (see PostProcessTestRun).
+    """
 
     @staticmethod
     def __call__(testrun):
         with transaction.atomic():
             ParseTestRunData()(testrun)
-            PostProcessTestRun()(testrun)
             RecordTestRunStatus()(testrun)
 
 
@@ -1,14 +1,38 @@
+from celery.signals import worker_process_init, worker_process_shutdown
+from django.db import DatabaseError
 from django.db.models import Max
 from django.utils import timezone
+from jinja2 import TemplateSyntaxError
 
 from squad.celery import app as celery
-from squad.core.models import Project, ProjectStatus, Build
-from squad.core.notification import send_status_notification
+from squad.core.models import Project, ProjectStatus, Build, EmailTemplate
+from squad.core.mail import delivery
+from squad.core.notification import send_status_notification, CompiledTemplates, Digest
 
 
 import logging
 
 
+logger = logging.getLogger()
+
+
+@worker_process_init.connect
+def precompile_email_templates(**kwargs):
+    try:
+        for email_template in EmailTemplate.objects.all():
+            try:
+                CompiledTemplates.precompile(email_template)
+            except TemplateSyntaxError as e:
+                logger.warning("Cannot compile email template %s: %s" % (email_template, e))
+    except DatabaseError as e:
+        logger.warning("Cannot precompile email templates: %s" % e)
+
+
+@worker_process_shutdown.connect
+def close_mail_connection(**kwargs):
+    delivery.close()
+
+
 @celery.task
 def maybe_notify_project_status(status_id):
     projectstatus = ProjectStatus.objects.get(pk=status_id)
@@ -42,6 +66,12 @@ def notify_project_status(status_id):
     send_status_notification(projectstatus)
 
 
+@celery.task
+def send_digest_notifications():
+    for project in Project.objects.filter(notification_strategy=Project.NOTIFY_DIGEST):
+        Digest(project).send()
+
+
 @celery.task
 def notification_timeout(status_id):
     projectstatus = ProjectStatus.objects.get(pk=status_id)
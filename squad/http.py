@@ -1,5 +1,13 @@
+from hashlib import sha1
+
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
 from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.http import HttpResponse
 from django.shortcuts import get_object_or_404
 from enum import Enum
@@ -24,20 +32,18 @@ def auth(func, mode=AuthMode.READ):
         group_slug = args[1]
         project_slug = args[2]
 
-        group = get_object_or_404(models.Group, slug=group_slug)
-        project = get_object_or_404(group.projects, slug=project_slug)
+        projects = models.Project.objects.select_related('group')
+        project = get_object_or_404(projects, group__slug=group_slug, slug=project_slug)
 
         tokenkey = request.META.get('HTTP_AUTH_TOKEN', None)
         user = request.user
         token = None
         if tokenkey:
-            try:
-                # truncate keys at 40 characters since djangorestframework's
-                # Token keys are limited to 40 characters
-                token = Token.objects.get(key=tokenkey[0:40])
+            # truncate keys at 40 characters since djangorestframework's
+            # Token keys are limited to 40 characters
+            token = get_token(tokenkey[0:40])
+            if token:
                 user = token.user
-            except Token.DoesNotExist:
-                pass
 
         if not (project.is_public or user.is_authenticated or token):
             raise PermissionDenied()
@@ -54,6 +60,46 @@ def auth(func, mode=AuthMode.READ):
     return auth_wrapper
 
 
+def __token_cache_key__(key):
+    return 'squad:token:' + sha1(key.encode()).hexdigest()
+
+
+def get_token(key):
+    """
+    Returns the API token with the given key, with its user already loaded,
+    or None if there is no such token. Tokens are cached for
+    settings.ACCESS_CACHE_TIMEOUT seconds, or until they or their users are
+    changed; see AccessCache for the caveats.
+    """
+    if not models.AccessCache.enabled():
+        try:
+            return Token.objects.select_related('user').get(key=key)
+        except Token.DoesNotExist:
+            return None
+
+    cache_key = __token_cache_key__(key)
+    token = cache.get(cache_key)
+    if token is None:
+        try:
+            token = Token.objects.select_related('user').get(key=key)
+        except Token.DoesNotExist:
+            return None
+        cache.set(cache_key, token, settings.ACCESS_CACHE_TIMEOUT)
+    return token
+
+
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+def invalidate_token_cache(sender, instance, **kwargs):
+    cache.delete(__token_cache_key__(instance.key))
+
+
+@receiver(post_save, sender=User)
+def invalidate_user_token_cache(sender, instance, **kwargs):
+    keys = Token.objects.filter(user_id=instance.id).values_list('key', flat=True)
+    cache.delete_many([__token_cache_key__(k) for k in keys])
+
+
 def read_file_upload(stream):
     data = bytes()
     for chunk in stream.chunks():
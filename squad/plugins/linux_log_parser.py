@@ -1,55 +1,180 @@
-from collections import namedtuple
+import re
+from functools import lru_cache
 from squad.core.plugins import Plugin as BasePlugin
 
 
+# the line boundaries recognized by str.splitlines()
+LINE_BREAK_CHARS = '\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029'
+LINE_BREAK = re.compile('\r\n|[%s]' % LINE_BREAK_CHARS)
+
+
 class Issue(object):
+    """
+    A kind of problem that can be found in a kernel log. An issue starts at
+    the first line containing one of its `start_markers`, and goes until the
+    line containing its `end_marker`, until it has `max_lines` lines, or
+    until the end of the log, whatever comes first.
+    """
     name = None
-    found = False
-    done = False
+    start_markers = ()
+    end_marker = None
     max_lines = None
 
     def __init__(self):
-        self.__log__ = []
+        self.found = False
+        self.done = False
+        self.__start__ = None
+        self.__limit__ = None
+        self.__log__ = ''
 
     @classmethod
     def find(cls, log):
         issues = [issue_type() for issue_type in cls.__subclasses__()]
-        for line in log.splitlines():
-            for issue in issues:
-                issue.feed(line)
+        Scanner(issues).scan(log)
         return issues
 
-    def feed(self, line):
-        if self.done:
-            return
-        self.__feed__(line)
-        if self.found:
-            self.__log__.append(line)
-            if self.max_lines and len(self.__log__) >= self.max_lines:
-                self.done = True
+    def start(self, log, pos):
+        """
+        Called with the position of the start of the line where a start
+        marker was found.
+        """
+        self.found = True
+        self.__start__ = pos
+        if self.max_lines:
+            for _ in range(self.max_lines):
+                line_break = LINE_BREAK.search(log, pos)
+                if line_break is None:
+                    self.__limit__ = None
+                    break
+                self.__limit__ = line_break.start()
+                pos = line_break.end()
+        if not self.end_marker:
+            self.finish(log)
+
+    def stop(self, log, pos):
+        """
+        Called with the position of the end marker in the log.
+        """
+        line_break = LINE_BREAK.search(log, pos)
+        end = line_break and line_break.start()
+        if self.__limit__ is not None and (end is None or self.__limit__ < end):
+            end = self.__limit__
+        self.finish(log, end)
+
+    def finish(self, log, end=None):
+        if end is None:
+            end = self.__limit__
+        if end is None:
+            end = len(log)
+        # only the lines of the issue are copied, with their line endings
+        # normalized
+        issue_log = LINE_BREAK.sub('\n', log[self.__start__:end])
+        if end == len(log) and issue_log.endswith('\n'):
+            issue_log = issue_log[:-1]
+        self.__log__ = issue_log
+        self.done = True
+
+    def expired(self, pos):
+        """
+        Returns whether the end marker can no longer change the result,
+        because the maximum number of lines ends before *pos*.
+        """
+        return self.__limit__ is not None and self.__limit__ < pos
 
     @property
     def log(self):
-        return "\n".join(self.__log__)
+        return self.__log__
+
+
+class Scanner(object):
+    """
+    Finds issues in a log in a single pass, without splitting it in lines.
+    The markers of all issues are looked for at the same time, with a single
+    regular expression; the search stops as soon as all issues are done.
+
+    Lines are delimited in the same way as by str.splitlines(), but the log
+    is never copied to do so.
+    """
+
+    def __init__(self, issues):
+        self.issues = issues
+
+    def scan(self, log):
+        pos = 0
+        while True:
+            markers = self.__markers__(log, pos)
+            if not markers:
+                break
+            match = self.__pattern__(markers).search(log, pos)
+            if match is None:
+                break
+            # other markers can be in the same line, including the end
+            # marker of an issue that just started there, so the search
+            # continues from the start of this line
+            pos = self.__line_start__(log, pos, match.start())
+            for issue, starting in markers[match.group(0)]:
+                if starting:
+                    issue.start(log, pos)
+                else:
+                    issue.stop(log, match.start())
+
+        for issue in self.issues:
+            if issue.found and not issue.done:
+                issue.finish(log)
+
+    def __markers__(self, log, pos):
+        """
+        Returns the markers that can still change the result from *pos* on,
+        mapped to the issues they affect, as (issue, starting) tuples.
+        """
+        markers = {}
+        for issue in self.issues:
+            if issue.done:
+                continue
+            if issue.found:
+                if issue.expired(pos):
+                    issue.finish(log)
+                    continue
+                markers.setdefault(issue.end_marker, []).append((issue, False))
+            else:
+                for marker in issue.start_markers:
+                    markers.setdefault(marker, []).append((issue, True))
+        return markers
+
+    @staticmethod
+    def __line_start__(log, start, pos):
+        """
+        Returns the start of the line that contains *pos*, given the start
+        of a line before it. Only the text between both is looked at.
+        """
+        return max(start, max(log.rfind(c, start, pos) + 1 for c in LINE_BREAK_CHARS))
+
+    @staticmethod
+    def __pattern__(markers):
+        return compile_markers(frozenset(markers))
+
+
+@lru_cache(maxsize=64)
+def compile_markers(markers):
+    """
+    Returns a regular expression that matches any of the given markers.
+    """
+    # longest first, so that markers containing others win when both match
+    # at the same place
+    alternatives = sorted(markers, key=lambda m: (-len(m), m))
+    return re.compile('|'.join(re.escape(m) for m in alternatives))
 
 
 class Oops(Issue):
     name = 'oops'
+    start_markers = ('------------[ cut here ]------------',)
     max_lines = 50
 
-    def __feed__(self, line):
-        if "------------[ cut here ]------------" in line:
-            self.found = True
-
 
 class KernelPanic(Issue):
     name = 'kernel-panic'
-
-    def __feed__(self, line):
-        if 'Kernel panic - not syncing:' in line:
-            self.found = True
-        if '---[ end Kernel panic - not syncing' in line:
-            self.done = True
+    start_markers = ('Kernel panic - not syncing:',)
+    end_marker = '---[ end Kernel panic - not syncing'
 
 
 class Plugin(BasePlugin):
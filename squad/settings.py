@@ -10,7 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/1.9/ref/settings/
 """
 
-from celery.schedules import crontab
+from datetime import timedelta
 from email.utils import parseaddr
 import os
 import sys
@@ -242,18 +242,62 @@ if not EMAIL_FROM:
     EMAIL_FROM = 'noreply@%s' % HOSTNAME
 SERVER_EMAIL = EMAIL_FROM
 
+# Outgoing email: maximum number of recipients per message (messages to more
+# recipients are split), and how many times to try to deliver a message when
+# the mail server fails with a temporary error.
+EMAIL_MAX_RECIPIENTS = int(os.getenv('SQUAD_EMAIL_MAX_RECIPIENTS', '50'))
+EMAIL_MAX_ATTEMPTS = int(os.getenv('SQUAD_EMAIL_MAX_ATTEMPTS', '3'))
+
 USE_X_FORWARDED_HOST = True
 SECURE_PROXY_SSL_HEADER = ('HTTP_X_FORWARDED_PROTO', 'https')
 
+# For how long (in seconds) to cache access control information, e.g. which
+# projects each user can access; 0 disables caching. Only enable it together
+# with a cache backend shared by all processes (see CACHES in the Django
+# documentation): changes to project or group membership only invalidate the
+# cache of the process where they happen, so with the default (per-process)
+# cache other processes can take up to this long to see them.
+ACCESS_CACHE_TIMEOUT = int(os.getenv('SQUAD_ACCESS_CACHE_TIMEOUT', '0'))
+
 # Celery settings
 CELERY_BROKER_URL = os.getenv('SQUAD_CELERY_BROKER_URL')
 CELERYD_HIJACK_ROOT_LOGGER = False
 CELERY_ACCEPT_CONTENT = ['json', 'msgpack', 'yaml']
 CELERY_TASK_SERIALIZER = 'msgpack'
+# How often (in minutes) to look for CI test jobs that are due to be fetched,
+# and the maximum number of test jobs to be fetched per backend each time.
+# The fetches are spread evenly until the next poll, in groups of up to
+# CI_FETCH_BATCH_SIZE test jobs that the backend can retrieve together.
+CI_POLL_INTERVAL = int(os.getenv('SQUAD_CI_POLL_INTERVAL', '5'))
+CI_POLL_BATCH_SIZE = int(os.getenv('SQUAD_CI_POLL_BATCH_SIZE', '500'))
+CI_FETCH_BATCH_SIZE = int(os.getenv('SQUAD_CI_FETCH_BATCH_SIZE', '20'))
+# Timeout (in seconds) for HTTP requests to CI backends, and the maximum
+# number of connections kept open to each backend server by each process.
+CI_HTTP_TIMEOUT = int(os.getenv('SQUAD_CI_HTTP_TIMEOUT', '120'))
+CI_HTTP_POOL_SIZE = int(os.getenv('SQUAD_CI_HTTP_POOL_SIZE', '8'))
+# Number of threads (and thus database connections) used for database access
+# by the listeners, when they all run in a single process (listen --asyncio).
+CI_LISTENER_DATABASE_THREADS = int(os.getenv('SQUAD_CI_LISTENER_DATABASE_THREADS', '4'))
+# Plugins run in background tasks, and each plugin is stopped after
+# PLUGINS_TIMEOUT seconds. If PLUGINS_QUEUE is set, those tasks are sent to
+# that queue, so that workers dedicated to it limit how many plugins run at
+# the same time.
+PLUGINS_TIMEOUT = int(os.getenv('SQUAD_PLUGINS_TIMEOUT', '300'))
+PLUGINS_QUEUE = os.getenv('SQUAD_PLUGINS_QUEUE')
+if PLUGINS_QUEUE:
+    CELERY_TASK_ROUTES = {
+        'squad.core.tasks.postprocess_test_run_plugin': {'queue': PLUGINS_QUEUE},
+        'squad.ci.tasks.postprocess_test_job_plugin': {'queue': PLUGINS_QUEUE},
+    }
+
 CELERY_BEAT_SCHEDULE = {
-    'poll-every-hour': {
+    'poll-test-jobs': {
         'task': 'squad.ci.tasks.poll',
-        'schedule': crontab(hour='*/1', minute=17),
+        'schedule': timedelta(minutes=CI_POLL_INTERVAL),
+    },
+    'notification-digests': {
+        'task': 'squad.core.tasks.notification.send_digest_notifications',
+        'schedule': timedelta(hours=int(os.getenv('SQUAD_NOTIFICATION_DIGEST_HOURS', '24'))),
     },
 }
 
@@ -271,7 +315,7 @@ REST_FRAMEWORK = {
     'PAGE_SIZE': 50,
     'DEFAULT_AUTHENTICATION_CLASSES': (
         'rest_framework.authentication.SessionAuthentication',
-        'rest_framework.authentication.TokenAuthentication',
+        'squad.api.utils.CachedTokenAuthentication',
     )
 }
 
@@ -1,4 +1,6 @@
+import json
 import os
+from io import BytesIO
 from django.test import TestCase, Client
 from django.test.utils import override_settings
 from django.conf import settings
@@ -88,6 +90,80 @@ class CiApiTest(TestCase):
         job_id = models.TestJob.objects.last().id
         submit.assert_called_with(job_id)
 
+    @patch("squad.ci.tasks.submit_batch.delay")
+    def test_submit_jobs(self, submit_batch):
+        other_backend = models.Backend.objects.create(name='other')
+        jobs = [
+            {'environment': 'env1', 'definition': 'foo: 1'},
+            {'environment': 'env2', 'definition': 'foo: 2', 'backend': 'other'},
+            {'environment': 'env3', 'definition': 'foo: 3'},
+        ]
+        args = {
+            'backend': 'lava',
+            'jobs': json.dumps(jobs),
+        }
+        r = self.client.post('/api/submitjobs/mygroup/myproject/1', args)
+        self.assertEqual(201, r.status_code)
+
+        ids = json.loads(r.content.decode())
+        test_jobs = [models.TestJob.objects.get(pk=i) for i in ids]
+        self.assertEqual(['env1', 'env2', 'env3'], [t.environment for t in test_jobs])
+        self.assertEqual(['foo: 1', 'foo: 2', 'foo: 3'], [t.definition for t in test_jobs])
+        self.assertEqual([self.backend, other_backend, self.backend], [t.backend for t in test_jobs])
+        build = self.project.builds.get(version='1')
+        self.assertEqual([build] * 3, [t.target_build for t in test_jobs])
+
+        # one submission task per backend
+        submit_batch.assert_any_call([ids[0], ids[2]])
+        submit_batch.assert_any_call([ids[1]])
+        self.assertEqual(2, submit_batch.call_count)
+
+    @patch("squad.ci.tasks.submit_batch.delay")
+    def test_submit_jobs_as_file_upload(self, submit_batch):
+        jobs = BytesIO(json.dumps([{'environment': 'myenv', 'definition': 'foo: 1'}]).encode())
+        jobs.name = 'jobs.json'
+        r = self.client.post('/api/submitjobs/mygroup/myproject/1', {'backend': 'lava', 'jobs': jobs})
+        self.assertEqual(201, r.status_code)
+        self.assertEqual(1, models.TestJob.objects.filter(environment='myenv').count())
+
+    @patch("squad.ci.tasks.submit_batch.delay")
+    def test_submit_jobs_interleaved_with_other_submission(self, submit_batch):
+        save = models.TestJob.save
+
+        def save_and_interleave(test_job, *args, **kwargs):
+            save(test_job, *args, **kwargs)
+            # another request inserts its test jobs at the same time
+            models.TestJob.objects.bulk_create([
+                models.TestJob(backend=self.backend, target=self.project, build='2', environment='other', definition='other')
+            ])
+
+        jobs = [{'environment': 'myenv', 'definition': 'foo: %d' % i} for i in range(3)]
+        with patch('squad.ci.models.TestJob.save', save_and_interleave):
+            r = self.client.post('/api/submitjobs/mygroup/myproject/1', {'backend': 'lava', 'jobs': json.dumps(jobs)})
+        self.assertEqual(201, r.status_code)
+
+        ids = json.loads(r.content.decode())
+        definitions = [models.TestJob.objects.get(pk=i).definition for i in ids]
+        self.assertEqual(['foo: 0', 'foo: 1', 'foo: 2'], definitions)
+        submit_batch.assert_called_once_with(ids)
+
+    def test_submit_jobs_validation(self):
+        invalid = [
+            'not json',
+            json.dumps({'environment': 'myenv', 'definition': 'foo: 1'}),
+            json.dumps([{'environment': 'myenv'}]),
+            json.dumps([{'environment': 'my env', 'definition': 'foo: 1'}]),
+            json.dumps([{'environment': 'myenv', 'definition': 'foo: 1', 'backend': 'lava.foo'}]),
+            json.dumps([{'environment': 'myenv', 'definition': {'foo': 1}}]),
+            json.dumps([{'environment': 'myenv', 'definition': 1}]),
+        ]
+        for jobs in invalid:
+            r = self.client.post('/api/submitjobs/mygroup/myproject/1', {'backend': 'lava', 'jobs': jobs})
+            self.assertEqual(400, r.status_code, jobs)
+        r = self.client.post('/api/submitjobs/mygroup/myproject/1', {'backend': 'lava'})
+        self.assertEqual(400, r.status_code)
+        self.assertEqual(0, models.TestJob.objects.count())
+
     @patch("squad.ci.tasks.fetch.delay")
     def test_auth_on_watch_testjob(self, fetch):
         testjob_id = 1234
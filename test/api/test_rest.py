@@ -1,8 +1,9 @@
+import gzip
 import json
 from test.api import APIClient
 from django.test import TestCase
 from squad.core import models
-from squad.core.tasks import UpdateProjectStatus
+from squad.core.tasks import UpdateProjectStatus, RecordTestRunStatus
 from squad.ci import models as ci_models
 
 
@@ -88,6 +89,35 @@ class RestApiTest(TestCase):
         data = self.hit('/api/projects/%d/builds/' % self.project.id)
         self.assertEqual(3, len(data['results']))
 
+    def test_project_test_results(self):
+        suite = self.project.suites.create(slug='foo')
+        self.testrun.tests.create(name='test1', suite=suite, result=True)
+        self.testrun2.tests.create(name='test1', suite=suite, result=False)
+        self.testrun2.tests.create(name='test2', suite=suite, result=False)
+
+        data = self.hit('/api/projects/%d/test_results/?test_name=foo/test1' % self.project.id)
+        results = {b['build']['version']: b['environments'] for b in data}
+        self.assertEqual(3, len(results))
+        self.assertEqual('pass', results['1'][0]['test']['status'])
+        self.assertEqual('fail', results['2'][0]['test']['status'])
+        self.assertEqual('myenv', results['3'][0]['environment']['slug'])
+        self.assertNotIn('test_url_path', results['3'][0])
+
+    def test_project_test_results_query_count(self):
+        suite = self.project.suites.create(slug='foo')
+        for i in range(4, 14):
+            build = self.project.builds.create(version=str(i))
+            for env in ('env1', 'env2', 'env3'):
+                environment, _ = self.project.environments.get_or_create(slug=env)
+                testrun = build.test_runs.create(environment=environment)
+                testrun.tests.create(name='test1', suite=suite, result=True)
+
+        url = '/api/projects/%d/test_results/?test_name=foo/test1' % self.project.id
+        with self.assertNumQueries(8):
+            self.client.get(url + '&limit=5')
+        with self.assertNumQueries(8):
+            self.client.get(url + '&limit=10')
+
     def test_builds(self):
         data = self.hit('/api/builds/')
         self.assertEqual(3, len(data['results']))
@@ -189,3 +219,135 @@ class RestApiTest(TestCase):
     def test_known_issues(self):
         data = self.hit('/api/knownissues/')
         self.assertEqual(1, len(data['results']))
+
+    def test_sparse_fields(self):
+        data = self.hit('/api/builds/?fields=id,version')
+        self.assertEqual(3, len(data['results']))
+        for build in data['results']:
+            self.assertEqual(['id', 'version'], sorted(build.keys()))
+
+    def test_sparse_fields_detail(self):
+        data = self.hit('/api/builds/%d/?fields=version,finished' % self.build.id)
+        self.assertEqual({'version': '1', 'finished': None}, data)
+
+    def test_sparse_fields_project_status(self):
+        UpdateProjectStatus()(self.testrun)
+        data = self.hit('/api/builds/%d/?fields=id&expand=status' % self.build.id)
+        self.assertEqual(self.build.id, data['id'])
+        self.assertIn('tests_pass', data['status'])
+
+    def test_expand(self):
+        data = self.hit('/api/builds/?expand=project')
+        project = data['results'][0]['project']
+        self.assertEqual('myproject', project['slug'])
+        self.assertEqual('mygroup/myproject', project['full_name'])
+
+    def test_expand_many(self):
+        suite = self.project.suites.create(slug='test')
+        test = self.testrun.tests.create(name='bar', suite=suite, result=False)
+        test.known_issues.add(self.knownissue)
+        data = self.hit('/api/tests/?expand=known_issues,suite')
+        self.assertEqual('knownissue_foo', data['results'][0]['known_issues'][0]['title'])
+        self.assertEqual('test', data['results'][0]['suite']['slug'])
+
+    def test_expand_unknown_field(self):
+        data = self.hit('/api/builds/?expand=foo,id')
+        self.assertEqual(3, len(data['results']))
+
+    def test_builds_query_count_is_constant(self):
+        url = '/api/builds/?fields=id,version,finished&expand=project'
+        with self.assertNumQueries(3):
+            self.client.get(url)
+        for i in range(10):
+            build = self.project.builds.create(version='x%d' % i)
+            UpdateProjectStatus()(build.test_runs.create(environment=self.environment))
+        with self.assertNumQueries(3):
+            self.client.get(url)
+
+    def test_tests_query_count_is_constant(self):
+        suite = self.project.suites.create(slug='test')
+        self.testrun.tests.create(name='foo', suite=suite, result=True)
+        with self.assertNumQueries(3):
+            self.client.get('/api/tests/')
+        for i in range(10):
+            test = self.testrun.tests.create(name='bar%d' % i, suite=suite, result=False)
+            test.known_issues.add(self.knownissue)
+        with self.assertNumQueries(3):
+            self.client.get('/api/tests/')
+
+    def __results_fixture__(self):
+        suite = self.project.suites.create(slug='foo')
+        self.testrun.tests.create(name='t1', suite=suite, result=True)
+        self.testrun.tests.create(name='t2', suite=suite, result=False)
+        self.testrun2.tests.create(name='t1', suite=suite, result=None)
+        RecordTestRunStatus()(self.testrun)
+        RecordTestRunStatus()(self.testrun2)
+
+    def test_builds_results(self):
+        self.__results_fixture__()
+        data = self.hit('/api/builds/results/?builds=%d,%d' % (self.build.id, self.build2.id))
+        results = {b['version']: b['environments'] for b in data['results']}
+        self.assertEqual(['1', '2'], sorted(results.keys()))
+        myenv = results['1']['myenv']
+        self.assertEqual(1, myenv['pass'])
+        self.assertEqual(1, myenv['fail'])
+        self.assertEqual({'pass': 1, 'fail': 1, 'xfail': 0, 'skip': 0}, myenv['suites']['foo'])
+        self.assertEqual(1, results['2']['myenv']['suites']['foo']['skip'])
+
+    def test_builds_results_last_builds_of_project(self):
+        self.__results_fixture__()
+        data = self.hit('/api/builds/results/?project=%d&last=2' % self.project.id)
+        self.assertEqual(['3', '2'], [b['version'] for b in data['results']])
+        self.assertEqual({}, data['results'][0]['environments'])
+
+    def test_builds_results_query_count(self):
+        self.__results_fixture__()
+        with self.assertNumQueries(3):
+            self.client.get('/api/builds/results/?project=%d' % self.project.id)
+
+    def test_builds_results_invalid(self):
+        self.assertEqual(400, self.client.get('/api/builds/results/').status_code)
+        self.assertEqual(400, self.client.get('/api/builds/results/?builds=a,b').status_code)
+
+    def test_builds_results_invalid_last(self):
+        for last in ['-1', '0', 'abc']:
+            url = '/api/builds/results/?project=%d&last=%s' % (self.project.id, last)
+            self.assertEqual(400, self.client.get(url).status_code)
+
+    def __stream__(self, url, **kwargs):
+        response = self.client.get(url, **kwargs)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('application/x-ndjson', response['Content-Type'])
+        return response, b''.join(response.streaming_content)
+
+    def __tests_stream_fixture__(self):
+        suite = self.project.suites.create(slug='foo')
+        self.testrun.tests.create(name='t1', suite=suite, result=True)
+        t2 = self.testrun.tests.create(name='t2', suite=suite, result=False, has_known_issues=True)
+        t2.known_issues.add(self.knownissue)
+        self.testrun2.tests.create(name='t3', suite=suite, result=None)
+
+    def test_build_tests_stream(self):
+        self.__tests_stream_fixture__()
+        _, content = self.__stream__('/api/builds/%d/tests_stream/' % self.build.id)
+        lines = [json.loads(line) for line in content.decode().splitlines()]
+        self.assertEqual(
+            [
+                {'name': 'foo/t1', 'environment': 'myenv', 'status': 'pass', 'has_known_issues': False},
+                {'name': 'foo/t2', 'environment': 'myenv', 'status': 'xfail', 'has_known_issues': True},
+            ],
+            lines
+        )
+
+    def test_testrun_tests_stream(self):
+        self.__tests_stream_fixture__()
+        _, content = self.__stream__('/api/testruns/%d/tests_stream/' % self.testrun2.id)
+        lines = [json.loads(line) for line in content.decode().splitlines()]
+        self.assertEqual(1, len(lines))
+        self.assertEqual('skip', lines[0]['status'])
+
+    def test_tests_stream_gzip(self):
+        self.__tests_stream_fixture__()
+        response, content = self.__stream__('/api/builds/%d/tests_stream/' % self.build.id, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual('gzip', response['Content-Encoding'])
+        self.assertEqual(2, len(gzip.decompress(content).splitlines()))
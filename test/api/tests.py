@@ -4,8 +4,10 @@ from io import StringIO
 
 
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.test import TestCase
 from django.test import Client
+from django.test import override_settings
 from test.api import APIClient
 
 
@@ -205,6 +207,17 @@ class CreateTestRunApiTest(ApiTest):
         self.assertEqual(201, response.status_code)
         self.assertEqual(1, models.TestRun.objects.count())
 
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}, ACCESS_CACHE_TIMEOUT=60)
+    def test_deleted_token_is_not_cached(self):
+        cache.clear()
+        self.client.token = self.global_token.key
+        response = self.client.post('/api/submit/mygroup/myproject/1.0.0/myenvironment')
+        self.assertEqual(201, response.status_code)
+
+        self.global_token.delete()
+        response = self.client.post('/api/submit/mygroup/myproject/1.0.1/myenvironment')
+        self.assertEqual(401, response.status_code)
+
     def test_404_on_non_existing_group(self):
         response = self.client.post('/api/submit/mygrouppp/myproject/1.0.0/myenv')
         self.assertEqual(404, response.status_code)
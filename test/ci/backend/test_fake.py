@@ -60,3 +60,9 @@ class FakeBackendTest(TestCase):
         job = TestJob(job_id='123')
         impl = FakeBackend(self.backend)
         self.assertIsInstance(impl.job_url(job), str)
+
+    def test_prefetch(self):
+        job = TestJob.objects.create(backend=self.backend, target=self.project)
+        impl = FakeBackend(self.backend)
+        # just not crashing is OK
+        impl.prefetch([job])
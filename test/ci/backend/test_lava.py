@@ -1,14 +1,22 @@
 from django.core import mail
 from django.test import TestCase
+from django.utils import timezone
+from dateutil.relativedelta import relativedelta
 from mock import patch, MagicMock
+import asyncio
+import zmq
+from xmlrpc.server import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
 import os
+import requests
+import socketserver
+import threading
 import yaml
 import xmlrpc
 
 
-from squad.ci.models import Backend, TestJob
+from squad.ci.models import Backend, TestJob, Listener, ListenerLease
 from squad.ci.backend.lava import Backend as LAVABackend
-from squad.ci.exceptions import SubmissionIssue, TemporarySubmissionIssue
+from squad.ci.exceptions import SubmissionIssue, TemporarySubmissionIssue, FetchIssue, TemporaryFetchIssue
 from squad.core.models import Group, Project
 
 
@@ -501,7 +509,7 @@ class LavaTest(TestCase):
         lava.__get_publisher_event_socket__ = MagicMock(return_value='tcp://*:9999')
         self.assertEqual('tcp://foo.tld:9999', lava.get_listener_url())
 
-    @patch('squad.ci.backend.lava.fetch')
+    @patch('squad.ci.backend.lava.fetch_batch')
     def test_receive_event(self, fetch):
         lava = LAVABackend(self.backend)
         testjob = TestJob.objects.create(
@@ -518,11 +526,133 @@ class LavaTest(TestCase):
         lava.receive_event('foo.com.testjob', {"job": '123', 'state': 'Finished', 'health': 'Complete'})
         # this is workaround to LAVA issues
         # it should be removed when LAVA bug is fixed
-        fetch.apply_async.assert_called_with(args=[testjob.id], countdown=120)
-        # proper solution below
-        # fetch.fetch.assert_called_with(testjob.id)
+        fetch.apply_async.assert_called_with(args=[[testjob.id]], countdown=120)
         self.assertEqual('Complete', TestJob.objects.get(pk=testjob.id).job_status)
 
+    @patch('squad.ci.backend.lava.fetch_batch')
+    @patch("squad.ci.backend.lava.Backend.__lookup_job_name__")
+    def test_receive_event_name_from_definition(self, lookup_job_name, fetch):
+        lava = LAVABackend(self.backend)
+        testjob = TestJob.objects.create(
+            backend=self.backend,
+            target=self.project,
+            submitted=True,
+            job_id='123',
+            definition='job_name: bar',
+        )
+
+        lava.receive_event('foo.com.testjob', {"job": '123', 'state': 'Running'})
+        self.assertEqual('bar', TestJob.objects.get(pk=testjob.id).name)
+        lookup_job_name.assert_not_called()
+
+    @patch('squad.ci.backend.lava.fetch_batch')
+    @patch("squad.ci.backend.lava.Backend.__lookup_job_name__")
+    def test_receive_event_name_looked_up_in_background(self, lookup_job_name, fetch):
+        lava = LAVABackend(self.backend)
+        testjob = TestJob.objects.create(
+            backend=self.backend,
+            target=self.project,
+            submitted=True,
+            job_id='123',
+        )
+
+        lava.receive_event('foo.com.testjob', {"job": '123', 'state': 'Running'})
+        lava.__name_lookups__.shutdown(wait=True)
+        lookup_job_name.assert_called_with(testjob.id, '123')
+        self.assertEqual('Running', TestJob.objects.get(pk=testjob.id).job_status)
+
+    @patch('squad.ci.backend.lava.fetch_batch')
+    def test_receive_events(self, fetch):
+        lava = LAVABackend(self.backend)
+        testjobs = [
+            TestJob.objects.create(
+                backend=self.backend,
+                target=self.project,
+                submitted=True,
+                job_id=str(i),
+                name='foo',
+            )
+            for i in range(4)
+        ]
+
+        events = [
+            ('foo.com.testjob', {'job': '0', 'state': 'Running'}),
+            ('foo.com.device', {'job': '1', 'state': 'Idle'}),
+            ('foo.com.testjob', {'job': '1', 'state': 'Running'}),
+            ('foo.com.testjob', {'job': '1', 'state': 'Finished', 'health': 'Complete'}),
+            ('foo.com.testjob', {'job': '2', 'state': 'Finished', 'health': 'Incomplete'}),
+            ('foo.com.testjob', {'job': '3', 'state': 'Running'}),
+        ]
+        # 1 query to find the test jobs + 1 update per distinct status
+        with self.assertNumQueries(4):
+            lava.receive_events(events)
+
+        statuses = [TestJob.objects.get(pk=t.id).job_status for t in testjobs]
+        self.assertEqual(['Running', 'Complete', 'Incomplete', 'Running'], statuses)
+        fetch.apply_async.assert_called_once_with(args=[[testjobs[1].id, testjobs[2].id]], countdown=120)
+
+    def test_listen_async(self):
+        context = zmq.Context()
+        publisher = context.socket(zmq.PUB)
+        port = publisher.bind_to_random_port('tcp://127.0.0.1')
+
+        lava = LAVABackend(self.backend)
+        lava.get_listener_url = MagicMock(return_value='tcp://127.0.0.1:%d' % port)
+        received = []
+        lava.receive_events = received.extend
+
+        async def publish():
+            # subscribers miss messages published before they connect
+            while not received:
+                publisher.send_multipart([b'foo.com.testjob', b'uuid', b'dt', b'user', b'{"job": "123"}'])
+                await asyncio.sleep(0.01)
+
+        event_loop = asyncio.new_event_loop()
+        try:
+            listener = event_loop.create_task(lava.listen_async())
+            event_loop.run_until_complete(asyncio.wait_for(publish(), 5))
+            listener.cancel()
+            event_loop.run_until_complete(asyncio.gather(listener, return_exceptions=True))
+        finally:
+            event_loop.close()
+            publisher.close(linger=0)
+            context.term()
+
+        self.assertEqual(('foo.com.testjob', {'job': '123'}), received[0])
+
+    def test_listener_statistics(self):
+        listener = Listener.objects.create(name='foo', heartbeat_at=timezone.now())
+        ListenerLease.objects.create(backend=self.backend, listener=listener)
+        lava = LAVABackend(self.backend)
+        lava.receive_events = MagicMock()
+        lava.stats_interval = 0
+
+        dt = (timezone.now() - relativedelta(seconds=30)).replace(tzinfo=None).isoformat()
+        message = [b'foo.com.testjob', b'uuid', dt.encode(), b'user', b'{"job": "123"}']
+        lava.__handle_messages__([message, message])
+
+        lease = ListenerLease.objects.get(backend=self.backend)
+        self.assertEqual(2, lease.messages)
+        self.assertGreaterEqual(lease.lag, 30)
+
+    def test_handle_messages_skips_invalid_ones(self):
+        lava = LAVABackend(self.backend)
+        lava.receive_events = MagicMock()
+
+        messages = [
+            [b'foo.com.testjob', b'uuid', b'dt', b'user', b'{"job": "1"}'],
+            [b'foo.com.testjob', b'uuid', b'dt', b'user', b'{"job": '],
+            [b'foo.com.testjob', b'uuid'],
+            [b'foo.com.testjob', b'uuid', b'dt', b'user', b'"job"'],
+            [b'foo.com.testjob', b'uuid', b'dt', b'user', b'{"job": "2"}'],
+        ]
+        lava.__handle_messages__(messages)
+
+        lava.receive_events.assert_called_once_with([
+            ('foo.com.testjob', {'job': '1'}),
+            ('foo.com.testjob', {'job': '2'}),
+        ])
+
     def test_receive_event_no_testjob(self):
         backend = MagicMock()
         backend.url = 'https://foo.tld/RPC2'
@@ -539,7 +669,7 @@ class LavaTest(TestCase):
         # just not crashing is OK
         lava.receive_event('foo.com.device', {'job': '123'})
 
-    @patch('squad.ci.backend.lava.fetch')
+    @patch('squad.ci.backend.lava.fetch_batch')
     def test_receive_event_no_status(self, fetch):
         lava = LAVABackend(self.backend)
         testjob = TestJob.objects.create(
@@ -562,3 +692,242 @@ class LavaTest(TestCase):
         log = lava.__parse_log__(log_data)
         self.assertIn("target message", log)
         self.assertNotIn("info message", log)
+
+    def test_lava_log_parsing_binary_message(self):
+        lava = LAVABackend(self.backend)
+        log = lava.__parse_log__('- {"lvl": "target", "msg": !!binary "w6k="}\n')
+        self.assertEqual("\n\xc3\xa9", log)
+
+    def test_lava_log_parsing_multiline_entry(self):
+        lava = LAVABackend(self.backend)
+        log_data = '- {"lvl": "target",\n   "msg": "foo"}\n- {"lvl": "info", "msg": "bar"}\n'
+        self.assertEqual("\nfoo", lava.__parse_log__(log_data))
+
+    def test_lava_log_parsing_limit(self):
+        lava = LAVABackend(self.backend)
+        lava.max_log_size = 10
+        log_data = ''.join('- {"lvl": "target", "msg": "line %d"}\n' % i for i in range(5))
+        self.assertEqual("\nline 0\n[log truncated at 10 characters]", lava.__parse_log__(log_data))
+
+    @patch('squad.ci.backend.lava.get_session')
+    def test_download_log_in_chunks(self, get_session):
+        get = get_session.return_value.get
+        response = get.return_value.__enter__.return_value
+        response.iter_content.return_value = [
+            b'- {"lvl": "target", "msg": "fo',
+            b'o"}\n- {"lvl": "info", "msg": "x"}\n- {"lvl": "tar',
+            b'get", "msg": "bar"}',
+        ]
+        lava = LAVABackend(self.backend)
+        self.assertEqual("\nfoo\nbar", lava.__get_job_logs__('123'))
+        self.assertTrue(get.call_args[1]['stream'])
+
+
+class FakeLAVAServer(object):
+    """
+    Local stand-in for the LAVA XML-RPC API, serving the given jobs (a
+    dictionary of job id => (details, results)) and counting the requests
+    it receives.
+    """
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.requests = 0
+
+        fake = self
+
+        class RequestHandler(SimpleXMLRPCRequestHandler):
+            # allow keep-alive connections
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                fake.requests += 1
+                super(RequestHandler, self).do_POST()
+
+            def setup(self):
+                fake.connections += 1
+                super(RequestHandler, self).setup()
+
+        class Server(socketserver.ThreadingMixIn, SimpleXMLRPCServer):
+            daemon_threads = True
+
+        self.connections = 0
+        self.server = Server(('127.0.0.1', 0), requestHandler=RequestHandler, logRequests=False)
+        self.server.register_multicall_functions()
+        self.server.register_function(self.job_details, 'scheduler.job_details')
+        self.server.register_function(self.suites_list, 'results.get_testjob_suites_list_yaml')
+        self.server.register_function(self.suite_results, 'results.get_testsuite_results_yaml')
+        self.server.register_function(self.submit_job, 'scheduler.submit_job')
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.01,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/RPC2' % self.server.server_address[1]
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __job__(self, job_id):
+        if job_id not in self.jobs:
+            raise xmlrpc.client.Fault(404, 'Job not found')
+        return self.jobs[job_id]
+
+    def job_details(self, job_id):
+        return self.__job__(job_id)[0]
+
+    def suites_list(self, job_id):
+        suites = []
+        for result in self.__job__(job_id)[1]:
+            if result['suite'] not in suites:
+                suites.append(result['suite'])
+        return yaml.dump([{'name': suite} for suite in suites])
+
+    def suite_results(self, job_id, suite, limit, offset):
+        results = [r for r in self.__job__(job_id)[1] if r['suite'] == suite]
+        return yaml.dump(results[offset:offset + limit])
+
+    def submit_job(self, definition):
+        if 'job_name' not in yaml.safe_load(definition):
+            raise xmlrpc.client.Fault(400, 'Invalid job definition')
+        job_id = str(len(self.jobs) + 1)
+        self.jobs[job_id] = (JOB_DETAILS_RUNNING, [])
+        return job_id
+
+
+class LavaMulticallTest(TestCase):
+
+    def setUp(self):
+        self.server = FakeLAVAServer({
+            '1': (JOB_DETAILS, TEST_RESULTS),
+            '2': (JOB_DETAILS, TEST_RESULTS_WITH_SUITE_VERSIONS),
+            '3': (JOB_DETAILS_RUNNING, []),
+        })
+        self.backend = Backend.objects.create(
+            url=self.server.url,
+            username='myuser',
+            token='mypassword',
+            implementation_type='lava',
+        )
+        self.lava = LAVABackend(self.backend)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_get_testjob_results_yaml(self):
+        self.assertEqual(TEST_RESULTS, list(self.lava.__get_testjob_results_yaml__('1')))
+        # suites list + 1 page of results from all suites
+        self.assertEqual(2, self.server.requests)
+
+    def test_get_testjob_results_yaml_paginated(self):
+        self.lava.results_page_size = 1
+        results = list(self.lava.__get_testjob_results_yaml__('1'))
+        self.assertEqual(
+            sorted(TEST_RESULTS, key=lambda r: r['name']),
+            sorted(results, key=lambda r: r['name']),
+        )
+        # suites list + 3 rounds of pages: the longest suite has 2 results,
+        # and then an empty page
+        self.assertEqual(4, self.server.requests)
+
+    def test_get_testjob_results_yaml_streaming(self):
+        self.lava.results_page_size = 1
+        results = self.lava.__get_testjob_results_yaml__('1')
+        self.assertEqual(0, self.server.requests)
+        next(results)
+        # suites list + first page of all suites
+        self.assertEqual(2, self.server.requests)
+
+    def test_get_testjob_results_yaml_in_parallel(self):
+        self.lava.multicall_size = 1
+        self.assertEqual(TEST_RESULTS, list(self.lava.__get_testjob_results_yaml__('1')))
+        # suites list + 1 page from each of the 2 suites, in separate requests
+        self.assertEqual(3, self.server.requests)
+
+    def test_multicall_size(self):
+        self.lava.multicall_size = 2
+        details = self.lava.__get_many_job_details__(['1', '2', '3'])
+        self.assertEqual('Running', details['3']['status'])
+        self.assertEqual(2, self.server.requests)
+
+    @patch("squad.ci.backend.lava.Backend.__get_job_logs__", return_value="abc")
+    def test_prefetch(self, get_logs):
+        test_jobs = [TestJob(backend=self.backend, job_id=job_id) for job_id in ['1', '2', '3']]
+        self.lava.prefetch(test_jobs)
+        # job details only
+        self.assertEqual(1, self.server.requests)
+
+        # results are streamed for each job: suites list + results
+        status, completed, metadata, results, metrics, logs = self.lava.fetch(test_jobs[0])
+        self.assertEqual('pass', results['DefinitionFoo/case_bar'])
+        self.assertEqual(3, self.server.requests)
+        status, completed, metadata, results, metrics, logs = self.lava.fetch(test_jobs[1])
+        self.assertEqual(29.72, metrics['suite1/test1'])
+        self.assertEqual(5, self.server.requests)
+
+        # job is not complete; nothing else to request
+        self.assertIsNone(self.lava.fetch(test_jobs[2]))
+        self.assertEqual(5, self.server.requests)
+
+    @patch("squad.ci.backend.lava.Backend.__get_job_logs__", return_value="abc")
+    def test_prefetch_with_failure(self, get_logs):
+        test_jobs = [TestJob(backend=self.backend, job_id=job_id) for job_id in ['1', '999']]
+        self.lava.prefetch(test_jobs)
+
+        self.assertEqual('Complete', self.lava.fetch(test_jobs[0])[0])
+        with self.assertRaises(FetchIssue):
+            self.lava.fetch(test_jobs[1])
+
+    def test_connection_reuse(self):
+        self.lava.__get_job_details__('1')
+        self.lava.__get_job_details__('2')
+        # a new backend implementation object still uses the same connection
+        LAVABackend(self.backend).__get_job_details__('3')
+        self.assertEqual(3, self.server.requests)
+        self.assertEqual(1, self.server.connections)
+
+    def test_fault(self):
+        with self.assertRaises(xmlrpc.client.Fault):
+            self.lava.__get_job_details__('999')
+
+    @patch('requests.Session.post', side_effect=requests.exceptions.ConnectionError('connection refused'))
+    def test_connection_error(self, post):
+        with self.assertRaises(TemporaryFetchIssue):
+            self.lava.fetch(TestJob(backend=self.backend, job_id='1'))
+        with self.assertRaises(TemporarySubmissionIssue):
+            self.lava.submit(TestJob(backend=self.backend, definition='job_name: foo'))
+        with self.assertRaises(TemporarySubmissionIssue):
+            self.lava.submit_many([TestJob(backend=self.backend, definition='job_name: foo')])
+
+    @patch('requests.Session.post', side_effect=requests.exceptions.Timeout('timed out'))
+    def test_timeout(self, post):
+        with self.assertRaises(TemporaryFetchIssue):
+            self.lava.fetch(TestJob(backend=self.backend, job_id='1'))
+
+    @patch('requests.Session.post', side_effect=requests.exceptions.SSLError('certificate verify failed'))
+    def test_ssl_error(self, post):
+        with self.assertRaises(FetchIssue) as context:
+            self.lava.fetch(TestJob(backend=self.backend, job_id='1'))
+        self.assertNotIsInstance(context.exception, TemporaryFetchIssue)
+
+    @patch("squad.ci.backend.lava.Backend.__get_job_logs__", return_value="abc")
+    def test_fetch_without_prefetch(self, get_logs):
+        test_job = TestJob(backend=self.backend, job_id='1')
+        self.assertEqual('Complete', self.lava.fetch(test_job)[0])
+        # job details + suites list + results
+        self.assertEqual(3, self.server.requests)
+
+    def test_submit_many(self):
+        test_jobs = [
+            TestJob(backend=self.backend, definition=definition)
+            for definition in ("job_name: foo", "foo: 1", "job_name: bar")
+        ]
+        results = self.lava.submit_many(test_jobs)
+        self.assertEqual('4', results[0])
+        self.assertIsInstance(results[1], SubmissionIssue)
+        self.assertNotIsInstance(results[1], TemporarySubmissionIssue)
+        self.assertEqual('5', results[2])
+        self.assertEqual(['foo', None, 'bar'], [t.name for t in test_jobs])
+        self.assertEqual(1, self.server.requests)
@@ -1,10 +1,14 @@
+import asyncio
+import threading
+from dateutil.relativedelta import relativedelta
 from django.test import TestCase
+from django.utils import timezone
 from mock import patch, MagicMock, call
 
 
-from squad.ci.models import Backend
-from squad.ci.management.commands.listen import ListenerManager, Command
-from squad.ci.management.commands.listen import Listener
+from squad.ci.models import Backend, Listener as ListenerModel, ListenerLease
+from squad.ci.management.commands.listen import ListenerManager, AsyncListenerManager, Command
+from squad.ci.management.commands.listen import Listener, BackendChangesWatcher, Shard
 
 
 argv = ['./manage.py', 'listen']
@@ -84,6 +88,16 @@ class TestListenerManager(TestCase):
         manager.keep_listeners_running()
         manager.stop.assert_called_with(bid)
 
+    def test_loop_waits_for_changes(self):
+        manager = ListenerManager(argv)
+        manager.keep_listeners_running = MagicMock(side_effect=[None, KeyboardInterrupt()])
+        manager.watcher = MagicMock()
+
+        manager.loop()
+
+        manager.watcher.wait.assert_called_once_with(manager.resync_interval)
+        self.assertEqual(2, manager.keep_listeners_running.call_count)
+
     @patch('squad.ci.management.commands.listen.subprocess.Popen')
     def test_keep_listeners_running_changed(self, Popen):
         manager = ListenerManager(argv)
@@ -104,6 +118,211 @@ class TestListenerManager(TestCase):
         manager.start.assert_called_with(backend)
 
 
+class TestShard(TestCase):
+
+    def setUp(self):
+        self.backends = [Backend.objects.create(name='backend%d' % i) for i in range(4)]
+        self.ids = [b.id for b in self.backends]
+
+    def test_single_listener(self):
+        self.assertEqual(self.ids, Shard('a').heartbeat())
+
+    def test_split_backends(self):
+        a = Shard('a')
+        b = Shard('b')
+        self.assertEqual(self.ids, a.heartbeat())
+        self.assertEqual([], b.heartbeat())
+
+        # a gives up half of the backends, which b then takes
+        self.assertEqual(self.ids[:2], a.heartbeat())
+        self.assertEqual(self.ids[2:], b.heartbeat())
+
+        self.assertEqual(self.ids[:2], a.heartbeat())
+        self.assertEqual(self.ids[2:], b.heartbeat())
+
+    def test_failover(self):
+        a = Shard('a')
+        b = Shard('b')
+        a.heartbeat()
+        b.heartbeat()
+        a.heartbeat()
+        b.heartbeat()
+
+        # a stops sending heartbeats
+        ListenerModel.objects.filter(name='a').update(heartbeat_at=timezone.now() - relativedelta(seconds=a.timeout + 1))
+        self.assertEqual(self.ids, b.heartbeat())
+
+    def test_reap_only_dead_listeners(self):
+        a = Shard('a')
+        b = Shard('b')
+        c = Shard('c')
+        a.heartbeat()
+        b.heartbeat()
+
+        ListenerModel.objects.filter(name='a').update(heartbeat_at=timezone.now() - relativedelta(seconds=a.timeout + 1))
+        c.heartbeat()
+        self.assertEqual(['b', 'c'], sorted(ListenerModel.objects.values_list('name', flat=True)))
+
+    def test_leave(self):
+        a = Shard('a')
+        b = Shard('b')
+        a.heartbeat()
+        a.leave()
+        self.assertEqual(self.ids, b.heartbeat())
+
+    def test_message_rate(self):
+        a = Shard('a')
+        a.rate_interval = 0
+        a.heartbeat()
+        ListenerLease.record(self.ids[0], 10, 0.5)
+        a.heartbeat()
+
+        lease = ListenerLease.objects.get(backend_id=self.ids[0])
+        self.assertEqual(10, lease.messages)
+        self.assertEqual(0.5, lease.lag)
+        self.assertGreater(lease.message_rate, 0)
+
+    @patch('squad.ci.management.commands.listen.subprocess.Popen')
+    def test_listener_manager(self, Popen):
+        Shard('other').heartbeat()
+        ListenerLease.objects.filter(backend_id__in=self.ids[2:]).delete()
+
+        manager = ListenerManager(argv, shard=Shard('a'))
+        manager.keep_listeners_running()
+        self.assertEqual(set(self.ids[2:]), set(manager.__processes__.keys()))
+
+
+class TestBackendChangesWatcher(TestCase):
+
+    def test_changed(self):
+        watcher = BackendChangesWatcher()
+        self.assertFalse(watcher.changed())
+
+        backend = Backend.objects.create(name="foo")
+        self.assertTrue(watcher.changed())
+        self.assertFalse(watcher.changed())
+
+        backend.delete()
+        self.assertTrue(watcher.changed())
+
+    def test_wait(self):
+        watcher = BackendChangesWatcher()
+        watcher.poll_interval = 0.01
+        self.assertFalse(watcher.wait(0.05))
+
+        Backend.objects.create(name="foo")
+        self.assertTrue(watcher.wait(60))
+
+    @patch('squad.ci.management.commands.listen.BackendChangesWatcher.__database_mtime__')
+    def test_changed_by_other_process(self, database_mtime):
+        database_mtime.side_effect = [1, 1, 2]
+        watcher = BackendChangesWatcher()
+        self.assertFalse(watcher.changed())
+        self.assertTrue(watcher.changed())
+
+
+class FakeImplementation(object):
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    async def listen_async(self):
+        self.calls += 1
+        outcome = self.outcomes.pop(0) if self.outcomes else None
+        if outcome == 'forever':
+            await asyncio.sleep(3600)
+        elif outcome is not None:
+            raise outcome
+
+
+class TestAsyncListenerManager(TestCase):
+
+    def setUp(self):
+        self.event_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.event_loop)
+        self.manager = AsyncListenerManager(argv)
+        self.manager.event_loop = self.event_loop
+        self.manager.restart_delay = 0
+
+    def tearDown(self):
+        self.event_loop.close()
+        asyncio.set_event_loop(None)
+
+    def run_loop(self):
+        self.event_loop.run_until_complete(asyncio.sleep(0.01))
+
+    @patch('squad.ci.models.Backend.get_implementation')
+    def test_start_and_stop(self, get_implementation):
+        impl = FakeImplementation('forever')
+        get_implementation.return_value = impl
+        backend = Backend.objects.create(name="foo")
+
+        self.manager.start(backend)
+        self.run_loop()
+        task = self.manager.__processes__[backend.id]
+        self.assertEqual(1, impl.calls)
+        self.assertFalse(task.done())
+
+        self.manager.cleanup()
+        self.assertTrue(task.cancelled())
+        self.assertEqual({}, self.manager.__processes__)
+
+    @patch('squad.ci.models.Backend.get_implementation')
+    def test_restart_crashed_listener(self, get_implementation):
+        crashing = FakeImplementation(RuntimeError('crash'), 'forever')
+        other = FakeImplementation('forever')
+        get_implementation.side_effect = lambda: crashing if get_implementation.call_count % 2 else other
+        backend1 = Backend.objects.create(name="foo")
+        backend2 = Backend.objects.create(name="bar")
+
+        self.manager.start(backend1)
+        self.manager.start(backend2)
+        self.run_loop()
+
+        self.assertEqual(2, crashing.calls)
+        self.assertEqual(1, other.calls)
+        self.manager.cleanup()
+
+    @patch('squad.ci.models.Backend.get_implementation')
+    def test_restart_changed_backend(self, get_implementation):
+        get_implementation.side_effect = lambda: FakeImplementation('forever')
+        backend = Backend.objects.create(name="foo")
+
+        self.manager.keep_listeners_running()
+        self.run_loop()
+        task = self.manager.__processes__[backend.id]
+
+        backend.name = 'bar'
+        backend.save()
+        self.manager.keep_listeners_running()
+        self.run_loop()
+
+        self.assertTrue(task.cancelled())
+        self.assertIsNot(task, self.manager.__processes__[backend.id])
+        self.manager.cleanup()
+
+    @patch('squad.ci.models.Backend.get_implementation')
+    def test_database_access_out_of_event_loop(self, get_implementation):
+        get_implementation.side_effect = lambda: FakeImplementation('forever')
+        backend = Backend.objects.create(name="foo")
+        threads = []
+
+        def get_backends():
+            threads.append(threading.current_thread())
+            return [backend]
+
+        with patch.object(self.manager, 'get_backends', get_backends):
+            loop = self.event_loop.create_task(self.manager.loop())
+            self.event_loop.run_until_complete(asyncio.sleep(0.1))
+            loop.cancel()
+            self.event_loop.run_until_complete(asyncio.gather(loop, return_exceptions=True))
+
+        self.assertNotIn(threading.current_thread(), threads)
+        self.assertEqual([backend.id], list(self.manager.__processes__.keys()))
+        self.manager.cleanup()
+
+
 class TestListener(TestCase):
 
     def test_run(self):
@@ -123,6 +342,23 @@ class TestCommand(TestCase):
         ListenerManager.assert_called_once()
         ListenerManager.return_value.run.assert_called_once()
 
+    @patch("squad.ci.management.commands.listen.AsyncListenerManager")
+    @patch("squad.ci.management.commands.listen.ListenerManager")
+    def test_handle_asyncio(self, ListenerManager, AsyncListenerManager):
+        command = Command()
+        command.handle(asyncio=True)
+
+        ListenerManager.assert_not_called()
+        AsyncListenerManager.return_value.run.assert_called_once()
+
+    @patch("squad.ci.management.commands.listen.Shard")
+    @patch("squad.ci.management.commands.listen.ListenerManager")
+    def test_handle_sharded(self, ListenerManager, Shard):
+        command = Command()
+        command.handle(sharded=True)
+
+        self.assertEqual(Shard.return_value, ListenerManager.call_args[1]['shard'])
+
     @patch("squad.ci.management.commands.listen.Backend")
     @patch("squad.ci.management.commands.listen.ListenerManager")
     @patch("squad.ci.management.commands.listen.Listener")
@@ -1,13 +1,18 @@
 from django.utils import timezone
 from dateutil.relativedelta import relativedelta
+from django.core.management import call_command
 from django.test import TestCase
+from io import StringIO
+import threading
 from mock import patch, MagicMock
 
 
 from squad.core import models as core_models
+from squad.core.plugins import PluginLoader
 
 
 from squad.ci import models
+from squad.ci.exceptions import Throttled
 from squad.ci.backend.null import Backend
 
 
@@ -25,6 +30,50 @@ class BackendTest(TestCase):
         impl = backend.get_implementation()
         self.assertIsInstance(impl, Backend)
 
+    def test_implementation_cached(self):
+        backend = models.Backend.objects.create(backend_settings='foo: bar')
+        impl = backend.get_implementation()
+
+        with patch('squad.ci.models.get_backend_implementation') as get_backend_implementation:
+            same_backend = models.Backend.objects.get(pk=backend.id)
+            self.assertIs(impl, same_backend.get_implementation())
+            get_backend_implementation.assert_not_called()
+        self.assertIs(same_backend, impl.data)
+
+    def test_implementation_cache_changed_backend(self):
+        backend = models.Backend.objects.create(backend_settings='foo: bar')
+        impl = backend.get_implementation()
+
+        backend.backend_settings = 'foo: baz'
+        new_impl = backend.get_implementation()
+        self.assertIsNot(impl, new_impl)
+        self.assertEqual({'foo': 'baz'}, new_impl.settings)
+
+    def test_implementation_cache_saved_backend(self):
+        backend = models.Backend.objects.create()
+        impl = backend.get_implementation()
+        backend.save()
+        self.assertIsNot(impl, backend.get_implementation())
+
+    def test_implementation_per_thread(self):
+        backend = models.Backend.objects.create()
+        impl = backend.get_implementation()
+        other = []
+        thread = threading.Thread(target=lambda: other.append(backend.get_implementation()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(impl, other[0])
+        self.assertIs(impl, backend.get_implementation())
+
+    @patch('squad.ci.models.Backend.max_cached_implementations', 2)
+    def test_implementation_cache_bounded(self):
+        backends = [models.Backend.objects.create(name='b%d' % i) for i in range(3)]
+        impls = [b.get_implementation() for b in backends]
+        self.assertIs(impls[2], backends[2].get_implementation())
+        self.assertIs(impls[1], backends[1].get_implementation())
+        # least recently used
+        self.assertIsNot(impls[0], backends[0].get_implementation())
+
 
 NOW = timezone.now()
 
@@ -79,6 +128,96 @@ class BackendPollTest(BackendTestBase):
         jobs = list(self.backend.poll())
         self.assertEqual([], jobs)
 
+    def test_poll_limit(self):
+        past = timezone.now() - relativedelta(minutes=10)
+        test_job1 = self.create_test_job(submitted=True, submitted_at=past)
+        self.create_test_job(submitted=True)
+        jobs = list(self.backend.poll(1))
+        self.assertEqual([test_job1], jobs)
+
+    def test_next_fetch_at(self):
+        test_job = self.create_test_job(submitted=False)
+        self.assertIsNone(test_job.next_fetch_at)
+
+        test_job.submitted = True
+        test_job.submitted_at = NOW
+        test_job.save()
+        self.assertEqual(NOW, test_job.next_fetch_at)
+
+        test_job.last_fetch_attempt = NOW
+        test_job.save()
+        self.assertEqual(NOW + relativedelta(minutes=self.backend.poll_interval), test_job.next_fetch_at)
+
+        test_job.fetched = True
+        test_job.save()
+        self.assertIsNone(test_job.next_fetch_at)
+
+    def test_next_fetch_at_backoff(self):
+        test_job = self.create_test_job(submitted=True, last_fetch_attempt=NOW, fetch_attempts=2)
+        self.assertEqual(NOW + relativedelta(minutes=4 * self.backend.poll_interval), test_job.next_fetch_at)
+
+    def test_next_fetch_at_kept_on_unrelated_changes(self):
+        test_job = self.create_test_job(submitted=True, submitted_at=NOW)
+        later = NOW + relativedelta(minutes=30)
+        models.TestJob.objects.filter(id=test_job.id).update(next_fetch_at=later)
+
+        test_job = models.TestJob.objects.get(id=test_job.id)
+        test_job.job_status = 'Running'
+        test_job.save()
+        self.assertEqual(later, models.TestJob.objects.get(id=test_job.id).next_fetch_at)
+
+    def test_next_fetch_at_does_not_load_backend_before_first_attempt(self):
+        self.project.builds.create(version='1')
+        test_job = self.create_test_job(submitted=False, build='1')
+        test_job = models.TestJob.objects.get(id=test_job.id)
+        test_job.submitted = True
+        test_job.submitted_at = NOW
+        with self.assertNumQueries(1):
+            test_job.save()
+        self.assertEqual(NOW, test_job.next_fetch_at)
+
+
+class BackendThrottleTest(BackendTestBase):
+
+    def test_no_limits(self):
+        for i in range(10):
+            with self.backend.throttle():
+                pass
+        self.assertEqual(0, models.BackendThrottle.objects.count())
+
+    def test_concurrency(self):
+        self.backend.max_concurrency = 2
+        with self.backend.throttle():
+            with self.backend.throttle():
+                with self.assertRaises(Throttled) as throttled:
+                    with self.backend.throttle():
+                        pass
+                self.assertEqual(self.backend.concurrency_retry_delay, throttled.exception.retry_after)
+        self.assertEqual(0, self.backend.leases.count())
+        with self.backend.throttle():
+            pass
+
+    def test_expired_lease(self):
+        self.backend.max_concurrency = 1
+        self.backend.leases.create(expires_at=timezone.now() - relativedelta(seconds=1))
+        with self.backend.throttle():
+            self.assertEqual(1, self.backend.leases.count())
+
+    def test_requests_per_second(self):
+        self.backend.max_requests_per_second = 0.5
+        with patch('django.utils.timezone.now', return_value=NOW):
+            with self.backend.throttle():
+                pass
+            with self.assertRaises(Throttled) as throttled:
+                with self.backend.throttle():
+                    pass
+            self.assertEqual(2, throttled.exception.retry_after)
+
+        later = NOW + relativedelta(seconds=2)
+        with patch('django.utils.timezone.now', return_value=later):
+            with self.backend.throttle():
+                pass
+
 
 class BackendFetchTest(BackendTestBase):
 
@@ -437,6 +576,23 @@ class BackendFetchTest(BackendTestBase):
         self.backend.really_fetch(test_job)
         postprocess.assert_called()
 
+    @patch.dict(PluginLoader.__hooks__, {'postprocess_testjob': {'example': True}})
+    @patch('squad.plugins.example.Plugin.postprocess_testjob')
+    def test_postprocess_testjob_plugins(self, plugin_method):
+        self.project.enabled_plugins_list = ['example']
+        self.project.save()
+        build = self.project.builds.create(version='1')
+        testrun = build.test_runs.create(environment=self.project.environments.create(slug='myenv'))
+        test_job = self.create_test_job(job_id='999', build='1', testrun=testrun)
+
+        def check_status_not_updated_yet(test_job):
+            self.assertFalse(core_models.ProjectStatus.objects.filter(build=build).exists())
+        plugin_method.side_effect = check_status_not_updated_yet
+
+        self.backend.__postprocess_testjob__(test_job)
+        plugin_method.assert_called_with(test_job)
+        self.assertTrue(core_models.ProjectStatus.objects.filter(build=build).exists())
+
 
 class BackendSubmitTest(BackendTestBase):
 
@@ -487,3 +643,73 @@ class TestJobTest(TestCase):
         )
         testjob.resubmit()
         self.assertEqual(1, testjob.resubmitted_count)
+
+    def test_target_build(self):
+        build = self.project.builds.create(version='1')
+        testjob = models.TestJob.objects.create(
+            target=self.project,
+            build='1',
+            environment='myenv',
+            backend=self.backend,
+        )
+        self.assertEqual(build, testjob.target_build)
+
+    def test_target_build_not_looked_up_again(self):
+        self.project.builds.create(version='1')
+        testjob = models.TestJob.objects.create(
+            target=self.project,
+            build='1',
+            environment='myenv',
+            backend=self.backend,
+        )
+        testjob = models.TestJob.objects.select_related('backend').get(pk=testjob.id)
+        testjob.job_status = 'Running'
+        with self.assertNumQueries(1):
+            testjob.save()
+
+    def test_target_build_changed(self):
+        self.project.builds.create(version='1')
+        build2 = self.project.builds.create(version='2')
+        testjob = models.TestJob.objects.create(
+            target=self.project,
+            build='1',
+            environment='myenv',
+            backend=self.backend,
+        )
+        testjob.build = '2'
+        testjob.save()
+        self.assertEqual(build2, testjob.target_build)
+
+    def test_target_build_created_later(self):
+        testjob = models.TestJob.objects.create(
+            target=self.project,
+            build='1',
+            environment='myenv',
+            backend=self.backend,
+        )
+        self.assertIsNone(testjob.target_build)
+        build = self.project.builds.create(version='1')
+        testjob.save()
+        self.assertEqual(build, testjob.target_build)
+
+
+class FillTestJobTargetBuildTest(TestCase):
+
+    def test_fill(self):
+        group = core_models.Group.objects.create(slug='mygroup')
+        project = group.projects.create(slug='myproject')
+        backend = models.Backend.objects.create()
+        testjobs = [
+            models.TestJob.objects.create(target=project, build=version, environment='myenv', backend=backend)
+            for version in ['1', '1', '2', '3']
+        ]
+        build1 = project.builds.create(version='1')
+        build2 = project.builds.create(version='2')
+
+        out = StringIO()
+        with self.assertNumQueries(1):
+            call_command('fill_test_job_target_build', stdout=out)
+        self.assertEqual('3 test jobs updated\n', out.getvalue())
+
+        builds = [models.TestJob.objects.get(pk=t.id).target_build for t in testjobs]
+        self.assertEqual([build1, build1, build2, None], builds)
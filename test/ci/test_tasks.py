@@ -1,4 +1,8 @@
+from contextlib import contextmanager
+from dateutil.relativedelta import relativedelta
 from django.test import TestCase
+from django.utils import timezone
+from django.test import override_settings
 from mock import patch
 
 
@@ -7,9 +11,42 @@ from celery.exceptions import Retry
 
 from squad.ci import models
 from squad.core import models as core_models
-from squad.ci.tasks import poll, fetch, submit
+from squad.ci.tasks import poll, fetch, fetch_batch, submit, submit_batch
 from squad.ci.exceptions import SubmissionIssue, TemporarySubmissionIssue
 from squad.ci.exceptions import FetchIssue, TemporaryFetchIssue
+from squad.ci.exceptions import Throttled
+
+
+def throttled(times):
+    """
+    Returns a replacement for Backend.throttle that is busy for the first
+    *times* calls.
+    """
+    calls = []
+
+    @contextmanager
+    def throttle(backend):
+        calls.append(backend)
+        if len(calls) <= times:
+            raise Throttled(10)
+        yield
+    return throttle
+
+
+def throttled_after(times):
+    """
+    Returns a replacement for Backend.throttle that is busy after the first
+    *times* calls.
+    """
+    calls = []
+
+    @contextmanager
+    def throttle(backend):
+        calls.append(backend)
+        if len(calls) > times:
+            raise Throttled(10)
+        yield
+    return throttle
 
 
 class PollTest(TestCase):
@@ -32,14 +69,85 @@ class PollTest(TestCase):
         poll.apply(args=[b1.id])
         poll_method.assert_called_once()
 
-    @patch("squad.ci.tasks.fetch")
+    @patch("squad.ci.tasks.fetch_batch")
     def test_poll_calls_fetch_on_all_test_jobs(self, fetch_method):
         group = core_models.Group.objects.create(slug='testgroup')
         project = group.projects.create(slug='testproject')
         backend = models.Backend.objects.create(name='b1')
         testjob = backend.test_jobs.create(target=project, submitted=True)
         poll.apply()
-        fetch_method.delay.assert_called_with(testjob.id)
+        fetch_method.apply_async.assert_called_with(args=[[testjob.id]], countdown=0)
+
+    @override_settings(CI_FETCH_BATCH_SIZE=2)
+    @patch("squad.ci.tasks.fetch_batch")
+    def test_poll_groups_fetches(self, fetch_method):
+        group = core_models.Group.objects.create(slug='testgroup')
+        project = group.projects.create(slug='testproject')
+        backend = models.Backend.objects.create(name='b1')
+        ids = [backend.test_jobs.create(target=project, submitted=True).id for i in range(3)]
+        poll.apply()
+        batches = [c[1]['args'][0] for c in fetch_method.apply_async.call_args_list]
+        self.assertEqual([ids[0:2], ids[2:3]], batches)
+
+    @override_settings(CI_POLL_INTERVAL=5, CI_FETCH_BATCH_SIZE=1)
+    @patch("squad.ci.tasks.fetch_batch")
+    def test_poll_spreads_fetches(self, fetch_method):
+        group = core_models.Group.objects.create(slug='testgroup')
+        project = group.projects.create(slug='testproject')
+        backend = models.Backend.objects.create(name='b1')
+        for i in range(3):
+            backend.test_jobs.create(target=project, submitted=True)
+        poll.apply()
+        countdowns = [c[1]['countdown'] for c in fetch_method.apply_async.call_args_list]
+        self.assertEqual([0, 100, 200], countdowns)
+
+    @override_settings(CI_POLL_INTERVAL=5)
+    @patch("squad.ci.tasks.fetch_batch")
+    def test_poll_leases_test_jobs(self, fetch_method):
+        group = core_models.Group.objects.create(slug='testgroup')
+        project = group.projects.create(slug='testproject')
+        backend = models.Backend.objects.create(name='b1', poll_interval=60)
+        testjob = backend.test_jobs.create(target=project, submitted=True)
+        poll.apply()
+
+        # the batch was lost: the test job is picked again once the lease
+        # expires, and not only after the poll interval of the backend
+        testjob.refresh_from_db()
+        lease = (testjob.next_fetch_at - timezone.now()).total_seconds()
+        self.assertTrue(9 * 60 < lease <= 10 * 60)
+
+        models.TestJob.objects.filter(pk=testjob.id).update(next_fetch_at=timezone.now())
+        poll.apply()
+        self.assertEqual(2, fetch_method.apply_async.call_count)
+
+    @patch("squad.ci.tasks.fetch_batch")
+    def test_fetch_sets_next_fetch_at_after_lease(self, fetch_method):
+        group = core_models.Group.objects.create(slug='testgroup')
+        project = group.projects.create(slug='testproject')
+        backend = models.Backend.objects.create(name='b1', poll_interval=60)
+        testjob = backend.test_jobs.create(target=project, submitted=True)
+        poll.apply()
+
+        with patch('squad.ci.backend.null.Backend.fetch', return_value=None):
+            fetch_batch.run([testjob.id])
+        testjob.refresh_from_db()
+        self.assertEqual(testjob.last_fetch_attempt + relativedelta(minutes=60), testjob.next_fetch_at)
+
+    @override_settings(CI_POLL_BATCH_SIZE=2, CI_FETCH_BATCH_SIZE=1)
+    @patch("squad.ci.tasks.fetch_batch")
+    def test_poll_in_batches(self, fetch_method):
+        group = core_models.Group.objects.create(slug='testgroup')
+        project = group.projects.create(slug='testproject')
+        backend = models.Backend.objects.create(name='b1')
+        for i in range(3):
+            backend.test_jobs.create(target=project, submitted=True)
+
+        poll.apply()
+        self.assertEqual(2, fetch_method.apply_async.call_count)
+
+        # jobs already scheduled are not picked again
+        poll.apply()
+        self.assertEqual(3, fetch_method.apply_async.call_count)
 
 
 class FetchTest(TestCase):
@@ -63,6 +171,25 @@ class FetchTest(TestCase):
         fetch.apply(args=[self.test_job.id])
         really_fetch_method.assert_called_with(self.test_job)
 
+    @patch('squad.ci.tasks.fetch.apply_async')
+    @patch('squad.ci.models.Backend.fetch')
+    def test_throttled_fetch_is_rescheduled(self, fetch_method, apply_async):
+        backend = self.test_job.backend
+        backend.max_concurrency = 1
+        backend.save()
+        backend.leases.create(expires_at=timezone.now() + relativedelta(hours=1))
+
+        fetch.apply(args=[self.test_job.id])
+
+        fetch_method.assert_not_called()
+        apply_async.assert_called_with(args=[self.test_job.id], countdown=backend.concurrency_retry_delay, retries=0)
+
+    @patch('squad.ci.models.Backend.throttle', throttled(5))
+    @patch('squad.ci.models.Backend.fetch')
+    def test_throttling_does_not_use_up_retries(self, fetch_method):
+        fetch.apply(args=[self.test_job.id])
+        fetch_method.assert_called_once_with(self.test_job)
+
     @patch('squad.ci.models.Backend.fetch')
     def test_exception_when_fetching(self, fetch_method):
         fetch_method.side_effect = FetchIssue("ERROR")
@@ -91,6 +218,64 @@ class FetchTest(TestCase):
         self.assertEqual(attemps + 1, self.test_job.fetch_attempts)
 
 
+class FetchBatchTest(TestCase):
+
+    def setUp(self):
+        group = core_models.Group.objects.create(slug='test')
+        project = group.projects.create(slug='test')
+        self.backend = models.Backend.objects.create()
+        self.test_jobs = [
+            self.backend.test_jobs.create(target=project, submitted=True, job_id=str(i))
+            for i in range(3)
+        ]
+        self.ids = [t.id for t in self.test_jobs]
+
+    @patch('squad.ci.models.Backend.really_fetch')
+    @patch('squad.ci.models.Backend.prefetch')
+    def test_prefetch_then_fetch_each(self, prefetch, really_fetch):
+        fetch_batch.apply(args=[self.ids])
+        prefetch.assert_called_once_with(self.test_jobs)
+        self.assertEqual(self.test_jobs, [c[0][0] for c in really_fetch.call_args_list])
+
+    @patch('squad.ci.models.Backend.really_fetch')
+    def test_skip_fetched(self, really_fetch):
+        models.TestJob.objects.filter(pk=self.ids[0]).update(fetched=True)
+        fetch_batch.apply(args=[self.ids])
+        self.assertEqual(self.test_jobs[1:], [c[0][0] for c in really_fetch.call_args_list])
+
+    @patch('squad.ci.models.Backend.really_fetch')
+    def test_backend_shared_by_test_jobs(self, really_fetch):
+        fetch_batch.apply(args=[self.ids])
+        backends = set(id(c[0][0].backend) for c in really_fetch.call_args_list)
+        self.assertEqual(1, len(backends))
+
+    @patch('squad.ci.models.Backend.fetch')
+    def test_exception_when_fetching(self, fetch_method):
+        fetch_method.side_effect = [None, FetchIssue("ERROR"), None]
+        fetch_batch.apply(args=[self.ids])
+
+        self.assertEqual(3, fetch_method.call_count)
+        test_job = models.TestJob.objects.get(pk=self.ids[1])
+        self.assertEqual("ERROR", test_job.failure)
+        self.assertTrue(test_job.fetched)
+
+    @patch('squad.ci.tasks.fetch_batch.apply_async')
+    @patch('squad.ci.models.Backend.fetch')
+    def test_throttled_reschedules_remaining_test_jobs(self, fetch_method, apply_async):
+        self.backend.max_concurrency = 1
+        self.backend.save()
+
+        def take_slot(test_job):
+            # some other worker takes the only slot
+            self.backend.leases.create(expires_at=timezone.now() + relativedelta(hours=1))
+        fetch_method.side_effect = take_slot
+
+        fetch_batch.apply(args=[self.ids])
+
+        self.assertEqual(1, fetch_method.call_count)
+        apply_async.assert_called_with(args=[self.ids[1:]], countdown=self.backend.concurrency_retry_delay, retries=0)
+
+
 class SubmitTest(TestCase):
 
     def setUp(self):
@@ -126,3 +311,98 @@ class SubmitTest(TestCase):
         retry.assert_called_with(exc=exception, countdown=3600)
         self.test_job.refresh_from_db()
         self.assertEqual(self.test_job.failure, "TEMPORARY ERROR")
+
+    @patch('squad.ci.models.Backend.throttle', throttled(5))
+    @patch('squad.ci.models.Backend.submit')
+    def test_throttling_does_not_count_against_retries(self, submit_method):
+        submit_method.side_effect = TemporarySubmissionIssue("TEMPORARY ERROR")
+
+        # last retry left; being throttled 5 times must not use it up
+        with self.assertRaises(Retry):
+            submit.apply(args=[self.test_job.id], retries=submit.max_retries - 1)
+
+        submit_method.assert_called_once_with(self.test_job)
+
+
+class SubmitBatchTest(TestCase):
+
+    def setUp(self):
+        group = core_models.Group.objects.create(slug='test')
+        project = group.projects.create(slug='test')
+        self.backend = models.Backend.objects.create(name='one')
+        self.other_backend = models.Backend.objects.create(name='two')
+        self.test_jobs = [
+            models.TestJob.objects.create(backend=backend, target=project)
+            for backend in (self.backend, self.other_backend, self.backend)
+        ]
+        self.ids = [t.id for t in self.test_jobs]
+
+    @patch('squad.ci.backend.null.Backend.submit_many')
+    def test_submit_per_backend(self, submit_many):
+        submit_many.side_effect = lambda test_jobs: ['job-%d' % t.id for t in test_jobs]
+        submit_batch.apply(args=[self.ids])
+
+        self.assertEqual(
+            [[self.ids[0], self.ids[2]], [self.ids[1]]],
+            [[t.id for t in c[0][0]] for c in submit_many.call_args_list]
+        )
+        for test_job in self.test_jobs:
+            test_job.refresh_from_db()
+            self.assertTrue(test_job.submitted)
+            self.assertEqual('job-%d' % test_job.id, test_job.job_id)
+
+    @patch('squad.ci.backend.null.Backend.submit_many')
+    def test_skip_submitted(self, submit_many):
+        submit_many.return_value = []
+        models.TestJob.objects.filter(pk=self.ids[0]).update(submitted=True)
+        submit_batch.apply(args=[self.ids])
+        self.assertEqual([[self.ids[1]], [self.ids[2]]], [[t.id for t in c[0][0]] for c in submit_many.call_args_list])
+
+    @patch('squad.ci.tasks.submit_batch.retry')
+    @patch('squad.ci.backend.null.Backend.submit')
+    def test_submission_issues(self, submit_method, retry):
+        retry.return_value = Retry()
+        submit_method.side_effect = [SubmissionIssue("ERROR"), TemporarySubmissionIssue("TEMPORARY ERROR"), '1']
+
+        with self.assertRaises(Retry):
+            submit_batch.apply(args=[self.ids])
+
+        # test jobs are submitted grouped by backend
+        retry.assert_called_with(args=[[self.ids[2]]], countdown=3600)
+        failures = [models.TestJob.objects.get(pk=i).failure for i in self.ids]
+        self.assertEqual(["ERROR", None, "TEMPORARY ERROR"], failures)
+        self.assertTrue(models.TestJob.objects.get(pk=self.ids[1]).submitted)
+
+    @patch('squad.ci.tasks.submit_batch.retry')
+    @patch('squad.ci.backend.null.Backend.submit_many')
+    def test_issue_for_whole_batch(self, submit_many, retry):
+        retry.return_value = Retry()
+        submit_many.side_effect = [TemporarySubmissionIssue("DOWN"), ['1']]
+
+        with self.assertRaises(Retry):
+            submit_batch.apply(args=[self.ids])
+
+        retry.assert_called_with(args=[[self.ids[0], self.ids[2]]], countdown=3600)
+        self.assertEqual("DOWN", models.TestJob.objects.get(pk=self.ids[2]).failure)
+
+    @patch('squad.ci.tasks.submit_batch.apply_async')
+    @patch('squad.ci.backend.null.Backend.submit_many')
+    def test_throttled_after_issues(self, submit_many, apply_async):
+        submit_many.side_effect = TemporarySubmissionIssue("DOWN")
+        with patch('squad.ci.models.Backend.throttle', throttled_after(1)):
+            submit_batch.apply(args=[self.ids], retries=2)
+
+        # failed test jobs are retried, and that counts as a retry
+        apply_async.assert_any_call(args=[[self.ids[0], self.ids[2]]], countdown=3600, retries=3)
+        # the ones not tried yet are just rescheduled
+        apply_async.assert_any_call(args=[[self.ids[1]]], countdown=10, retries=2)
+
+    @patch('squad.ci.tasks.submit_batch.apply_async')
+    @patch('squad.ci.backend.null.Backend.submit_many')
+    def test_throttled_after_issues_on_last_retry(self, submit_many, apply_async):
+        submit_many.side_effect = TemporarySubmissionIssue("DOWN")
+        retries = submit_batch.max_retries
+        with patch('squad.ci.models.Backend.throttle', throttled_after(1)):
+            submit_batch.apply(args=[self.ids], retries=retries)
+
+        apply_async.assert_called_once_with(args=[[self.ids[1]]], countdown=10, retries=retries)
@@ -0,0 +1,29 @@
+import asyncio
+import threading
+from django.test import TestCase
+from mock import patch
+
+
+from squad.ci.utils import run_in_database_thread
+
+
+class TestRunInDatabaseThread(TestCase):
+
+    @patch('squad.ci.utils.close_old_connections')
+    def test_run_in_database_thread(self, close_old_connections):
+        threads = []
+
+        def func(a, b):
+            threads.append(threading.current_thread())
+            self.assertEqual(1, close_old_connections.call_count)
+            return a + b
+
+        event_loop = asyncio.new_event_loop()
+        try:
+            result = event_loop.run_until_complete(run_in_database_thread(func, 1, 2))
+        finally:
+            event_loop.close()
+
+        self.assertEqual(3, result)
+        self.assertNotIn(threading.current_thread(), threads)
+        self.assertEqual(2, close_old_connections.call_count)
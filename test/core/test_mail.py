@@ -0,0 +1,105 @@
+import smtplib
+import threading
+from django.core import mail
+from django.core.mail import EmailMultiAlternatives
+from django.test import TestCase
+from django.test import override_settings
+from unittest.mock import patch, MagicMock
+
+
+from squad.core.mail import MailDelivery
+
+
+def message(*recipients):
+    return EmailMultiAlternatives('subject', 'body', 'squad@example.com', list(recipients))
+
+
+@patch('squad.core.mail.time.sleep')
+class MailDeliveryTest(TestCase):
+
+    def setUp(self):
+        self.delivery = MailDelivery()
+
+    def test_send(self, sleep):
+        self.delivery.send(message('foo@example.com'))
+        self.assertEqual(1, len(mail.outbox))
+        self.assertEqual(['foo@example.com'], mail.outbox[0].to)
+        self.assertEqual(1, self.delivery.stats.messages)
+
+    @patch('squad.core.mail.get_connection')
+    def test_reuse_connection(self, get_connection, sleep):
+        self.delivery.send(message('foo@example.com'))
+        self.delivery.send(message('bar@example.com'))
+        get_connection.assert_called_once_with()
+        self.assertEqual(2, get_connection.return_value.send_messages.call_count)
+
+    @override_settings(EMAIL_MAX_RECIPIENTS=2)
+    def test_batch_recipients(self, sleep):
+        self.delivery.send(message('a@example.com', 'b@example.com', 'c@example.com', 'd@example.com', 'e@example.com'))
+        self.assertEqual(
+            [['a@example.com', 'b@example.com'], ['c@example.com', 'd@example.com'], ['e@example.com']],
+            [m.to for m in mail.outbox]
+        )
+
+    @override_settings(EMAIL_MAX_RECIPIENTS=2)
+    def test_cc_and_bcc_only_on_first_batch(self, sleep):
+        msg = message('a@example.com', 'b@example.com', 'c@example.com')
+        msg.cc = ['cc@example.com']
+        msg.bcc = ['bcc@example.com']
+        self.delivery.send(msg)
+        self.assertEqual(
+            [['cc@example.com'], []],
+            [m.cc for m in mail.outbox]
+        )
+        self.assertEqual(
+            [['bcc@example.com'], []],
+            [m.bcc for m in mail.outbox]
+        )
+
+    @patch('squad.core.mail.get_connection')
+    def test_retry_on_transient_failure(self, get_connection, sleep):
+        connection = MagicMock()
+        connection.send_messages.side_effect = [smtplib.SMTPServerDisconnected(), 1]
+        get_connection.return_value = connection
+
+        self.delivery.send(message('foo@example.com'))
+
+        self.assertEqual(2, get_connection.call_count)
+        self.assertEqual(2, connection.send_messages.call_count)
+        sleep.assert_called_once_with(1)
+
+    @patch('squad.core.mail.get_connection')
+    def test_lock_released_while_backing_off(self, get_connection, sleep):
+        get_connection.return_value.send_messages.side_effect = [smtplib.SMTPServerDisconnected(), 1]
+        acquired = []
+
+        def try_lock(*args):
+            def acquire():
+                if self.delivery.__lock__.acquire(blocking=False):
+                    acquired.append(True)
+                    self.delivery.__lock__.release()
+            thread = threading.Thread(target=acquire)
+            thread.start()
+            thread.join()
+        sleep.side_effect = try_lock
+
+        self.delivery.send(message('foo@example.com'))
+        self.assertEqual([True], acquired)
+
+    @override_settings(EMAIL_MAX_ATTEMPTS=2)
+    @patch('squad.core.mail.get_connection')
+    def test_give_up_after_max_attempts(self, get_connection, sleep):
+        get_connection.return_value.send_messages.side_effect = smtplib.SMTPResponseException(421, 'busy')
+        with self.assertRaises(smtplib.SMTPResponseException):
+            self.delivery.send(message('foo@example.com'))
+        self.assertEqual(2, get_connection.return_value.send_messages.call_count)
+        self.assertEqual(1, self.delivery.stats.failures)
+
+    @patch('squad.core.mail.get_connection')
+    def test_no_retry_on_permanent_failure(self, get_connection, sleep):
+        error = smtplib.SMTPRecipientsRefused({'foo@example.com': (550, 'no such user')})
+        get_connection.return_value.send_messages.side_effect = error
+        with self.assertRaises(smtplib.SMTPRecipientsRefused):
+            self.delivery.send(message('foo@example.com'))
+        self.assertEqual(1, get_connection.return_value.send_messages.call_count)
+        sleep.assert_not_called()
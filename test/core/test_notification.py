@@ -8,7 +8,8 @@ from unittest.mock import patch, MagicMock, PropertyMock
 
 
 from squad.core.models import Group, Project, Build, ProjectStatus, EmailTemplate
-from squad.core.notification import Notification, send_status_notification
+from squad.core.notification import Notification, send_status_notification, CompiledTemplates, Digest
+from squad.core.tasks.notification import precompile_email_templates, send_digest_notifications
 
 
 class NotificationTest(TestCase):
@@ -30,6 +31,66 @@ class NotificationTest(TestCase):
         self.assertIs(the_diff, notification.diff)
 
 
+class NotificationStoredChangesTest(TestCase):
+
+    def setUp(self):
+        group = Group.objects.create(slug='mygroup')
+        self.project = group.projects.create(slug='myproject')
+        environment = self.project.environments.create(slug='myenv')
+        suite = self.project.suites.create(slug='mysuite')
+
+        t0 = timezone.now() - relativedelta(hours=3)
+        t = timezone.now() - relativedelta(hours=2.75)
+        build1 = self.project.builds.create(version='1', datetime=t0)
+        test_run1 = build1.test_runs.create(environment=environment)
+        test_run1.tests.create(name='foo', suite=suite, result=True)
+        ProjectStatus.create_or_update(build1)
+
+        self.build2 = self.project.builds.create(version='2', datetime=t)
+        test_run2 = self.build2.test_runs.create(environment=environment)
+        test_run2.tests.create(name='foo', suite=suite, result=False)
+        self.status = ProjectStatus.create_or_update(self.build2)
+
+    @patch('squad.core.notification.TestComparison.compare_builds')
+    def test_regressions_from_project_status(self, compare_builds):
+        notification = Notification(self.status)
+        self.assertEqual({'myenv': ['mysuite/foo']}, notification.regressions)
+        self.assertEqual({}, notification.fixes)
+        self.assertTrue(notification.has_changes)
+        compare_builds.assert_not_called()
+
+    @patch('squad.core.notification.TestComparison.compare_builds')
+    def test_custom_template_without_diff(self, compare_builds):
+        template = EmailTemplate.objects.create(plain_text='{% for env, suites in regressions_grouped_by_suite.items() %}{% for suite, tests in suites.items() %}{{env}} {{suite}} {{tests|join}}{% endfor %}{% endfor %}')
+        txt, _ = Notification(self.status).message(False, template)
+        self.assertEqual("myenv mysuite foo", txt)
+        compare_builds.assert_not_called()
+
+    def test_full_comparison_with_default_template(self):
+        txt, _ = Notification(self.status).message(False)
+        self.assertIn('mysuite/foo', txt)
+
+    def test_stored_changes_against_another_baseline(self):
+        # a build in between finished after this status was recorded
+        t = timezone.now() - relativedelta(hours=2.9)
+        build = self.project.builds.create(version='1.5', datetime=t)
+        test_run = build.test_runs.create(environment=self.project.environments.get(slug='myenv'))
+        test_run.tests.create(name='foo', suite=self.project.suites.get(slug='mysuite'), result=False)
+        ProjectStatus.create_or_update(build)
+
+        notification = Notification(self.status)
+        self.assertEqual(build, notification.previous_build)
+        self.assertEqual({}, notification.regressions)
+        self.assertIsNotNone(notification.__comparison__)
+
+    def test_explicit_baseline_uses_full_comparison(self):
+        build3 = self.project.builds.create(version='3')
+        status3 = ProjectStatus.create_or_update(build3)
+        notification = Notification(status3, self.status)
+        self.assertEqual({}, notification.regressions)
+        self.assertIsNotNone(notification.__comparison__)
+
+
 def fake_diff():
     build1 = MagicMock()
     build2 = MagicMock()
@@ -252,3 +313,120 @@ class TestCustomEmailTemplate(TestCase):
 
         msg = mail.outbox[0]
         self.assertEqual('lalala', msg.subject)
+
+
+class TestCompiledTemplates(TestCase):
+
+    def setUp(self):
+        self.template = EmailTemplate.objects.create(name='foo', subject='{{project}}', plain_text='foo')
+
+    @patch('squad.core.notification.jinja2.from_string')
+    def test_compile_once(self, from_string):
+        CompiledTemplates.get(self.template.plain_text, self.template.id)
+        CompiledTemplates.get(self.template.plain_text, self.template.id)
+        from_string.assert_called_once_with('foo')
+
+    def test_changed_source(self):
+        template = CompiledTemplates.get('foo', self.template.id)
+        self.assertIsNot(template, CompiledTemplates.get('bar', self.template.id))
+        self.assertEqual('bar', CompiledTemplates.get('bar', self.template.id).render({}))
+
+    @patch('squad.core.notification.jinja2.from_string')
+    def test_invalidate_on_save(self, from_string):
+        CompiledTemplates.get(self.template.plain_text, self.template.id)
+        self.template.save()
+        CompiledTemplates.get(self.template.plain_text, self.template.id)
+        self.assertEqual(2, from_string.call_count)
+
+    @patch('squad.core.notification.CompiledTemplates.MAX_SIZE', 2)
+    @patch('squad.core.notification.jinja2.from_string')
+    def test_bounded_size(self, from_string):
+        for source in ['a', 'b', 'a', 'c']:
+            CompiledTemplates.get(source, self.template.id)
+        self.assertEqual(2, len(CompiledTemplates.__templates__))
+
+        # 'a' was used more recently than 'b', so 'b' was dropped
+        CompiledTemplates.get('a', self.template.id)
+        self.assertEqual(3, from_string.call_count)
+        CompiledTemplates.get('b', self.template.id)
+        self.assertEqual(4, from_string.call_count)
+
+    @patch('squad.core.notification.jinja2.from_string')
+    def test_precompile_at_worker_startup(self, from_string):
+        self.template.save()  # drop anything compiled by other tests
+        precompile_email_templates()
+        self.assertEqual(2, from_string.call_count)
+        CompiledTemplates.get(self.template.subject, self.template.id)
+        self.assertEqual(2, from_string.call_count)
+
+
+class TestDigest(TestCase):
+
+    def setUp(self):
+        group = Group.objects.create(slug='mygroup')
+        self.project = group.projects.create(slug='myproject', notification_strategy=Project.NOTIFY_DIGEST)
+        self.project.subscriptions.create(email='foo@example.com')
+        self.environment = self.project.environments.create(slug='myenv')
+        self.suite = self.project.suites.create(slug='mysuite')
+        self.statuses = [
+            self.create_build('1', 5, True),
+            self.create_build('2', 4, False),
+            self.create_build('3', 3, True),
+        ]
+
+    def create_build(self, version, hours_ago, result):
+        t = timezone.now() - relativedelta(hours=hours_ago)
+        build = self.project.builds.create(version=version, datetime=t)
+        test_run = build.test_runs.create(environment=self.environment)
+        test_run.tests.create(name='foo', suite=self.suite, result=result)
+        return ProjectStatus.create_or_update(build)
+
+    def test_no_notification_per_build(self):
+        send_status_notification(self.statuses[-1])
+        self.assertEqual(0, len(mail.outbox))
+
+    def test_regressions_and_fixes(self):
+        digest = Digest(self.project)
+        self.assertEqual(['1', '2', '3'], [b.version for b in digest.builds])
+        self.assertEqual({'myenv': ['mysuite/foo']}, digest.regressions)
+        self.assertEqual({'myenv': ['mysuite/foo']}, digest.fixes)
+
+    def test_send_digest(self):
+        send_digest_notifications()
+        self.assertEqual(1, len(mail.outbox))
+        msg = mail.outbox[0]
+        self.assertEqual('mygroup/myproject: 3 builds (1 to 3)', msg.subject)
+        self.assertIn('mysuite/foo', msg.body)
+        self.assertEqual(0, ProjectStatus.objects.filter(notified=False).count())
+
+        send_digest_notifications()
+        self.assertEqual(1, len(mail.outbox))
+
+    @patch('squad.core.notification.TestComparison')
+    def test_no_comparison(self, TestComparison):
+        send_digest_notifications()
+        TestComparison.assert_not_called()
+        TestComparison.compare_builds.assert_not_called()
+
+    def test_moderated_digest_includes_only_approved(self):
+        self.project.moderate_notifications = True
+        self.project.save()
+        ProjectStatus.objects.filter(id=self.statuses[0].id).update(approved=True)
+        self.assertEqual(['1'], [b.version for b in Digest(self.project).builds])
+
+    def test_only_builds_since_digest_was_enabled(self):
+        self.project.notification_strategy = Project.NOTIFY_ALL_BUILDS
+        self.project.save()
+        self.assertIsNone(self.project.digest_since)
+
+        self.project.notification_strategy = Project.NOTIFY_DIGEST
+        self.project.save()
+        self.assertEqual([], Digest(self.project).builds)
+
+        self.create_build('4', 0, True)
+        self.assertEqual(['4'], [b.version for b in Digest(self.project).builds])
+
+    def test_digest_since_kept_on_save(self):
+        digest_since = self.project.digest_since
+        self.project.save()
+        self.assertEqual(digest_since, self.project.digest_since)
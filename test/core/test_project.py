@@ -1,5 +1,7 @@
 from django.test import TestCase
+from django.test import override_settings
 from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 
 
@@ -70,3 +72,54 @@ class ProjectTest(TestCase):
     def test_enabled_plugins(self):
         p = Project(enabled_plugins_list=['aaa', 'bbb'])
         self.assertEqual(['aaa', 'bbb'], p.enabled_plugins)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}, ACCESS_CACHE_TIMEOUT=60)
+class ProjectAccessCacheTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user_group = UserGroup.objects.create(name='mygroup')
+        self.user = User.objects.create(username='u1')
+
+        self.group = Group.objects.create(slug='mygroup')
+        self.group.user_groups.add(self.user_group)
+
+        self.public_project = self.group.projects.create(slug='public')
+        self.private_project = self.group.projects.create(slug='private', is_public=False)
+
+    def test_accessible_ids_cached(self):
+        self.assertEqual([self.public_project.id], Project.objects.accessible_ids(self.user))
+        with self.assertNumQueries(0):
+            self.assertEqual([self.public_project.id], Project.objects.accessible_ids(self.user))
+            self.assertFalse(self.private_project.writable_by(self.user))
+
+    def test_invalidate_on_user_joining_group(self):
+        self.assertFalse(self.private_project.accessible_to(self.user))
+        self.user.groups.add(self.user_group)
+        self.assertTrue(self.private_project.accessible_to(self.user))
+        self.assertEqual(
+            sorted([self.public_project.id, self.private_project.id]),
+            sorted(Project.objects.accessible_ids(self.user))
+        )
+
+    def test_invalidate_on_group_membership_change(self):
+        self.user.groups.add(self.user_group)
+        self.assertTrue(self.private_project.writable_by(self.user))
+        self.group.user_groups.remove(self.user_group)
+        self.assertFalse(self.private_project.writable_by(self.user))
+
+    def test_invalidate_on_project_change(self):
+        Project.objects.accessible_ids(AnonymousUser())
+        self.private_project.is_public = True
+        self.private_project.save()
+        self.assertEqual(
+            sorted([self.public_project.id, self.private_project.id]),
+            sorted(Project.objects.accessible_ids(AnonymousUser()))
+        )
+
+    @override_settings(ACCESS_CACHE_TIMEOUT=0)
+    def test_not_cached_when_disabled(self):
+        self.assertEqual([self.public_project.id], Project.objects.accessible_ids(self.user))
+        with self.assertNumQueries(2):
+            self.assertEqual([self.public_project.id], Project.objects.accessible_ids(self.user))
@@ -14,11 +14,13 @@ from squad.core.tasks import PostProcessTestRun
 from squad.core.tasks import RecordTestRunStatus
 from squad.core.tasks import UpdateProjectStatus
 from squad.core.tasks import ProcessTestRun
+from squad.core.tasks import RunPlugin
 from squad.core.tasks import ProcessAllTestRuns
 from squad.core.tasks import ReceiveTestRun
 from squad.core.tasks import ValidateTestRun
 from squad.core.tasks import CreateBuild
 from squad.core.tasks import exceptions
+from squad.core.tasks import postprocess_test_run_plugin, update_project_status
 
 
 class CommonTestCase(TestCase):
@@ -199,20 +201,115 @@ class ProcessTestRunTest(CommonTestCase):
         self.assertEqual(6, self.testrun.status.count())
 
     @patch('squad.core.tasks.PostProcessTestRun.__call__')
-    def test_postprocess(self, postprocess):
+    def test_no_postprocess(self, postprocess):
         ProcessTestRun()(self.testrun)
-        postprocess.assert_called_with(self.testrun)
+        postprocess.assert_not_called()
 
 
 class TestPostProcessTestRun(CommonTestCase):
 
-    @patch('squad.plugins.example.Plugin.postprocess_testrun')
+    @patch('squad.plugins.linux_log_parser.Plugin.postprocess_testrun')
     def test_calls_enabled_plugin(self, plugin_method):
         project = self.testrun.build.project
-        project.enabled_plugins_list = ['example']
+        project.enabled_plugins_list = ['linux_log_parser']
+        project.save()
+        PostProcessTestRun()(self.testrun)
+        plugin_method.assert_called_with(self.testrun)
+
+    @patch('squad.core.tasks.chain')
+    def test_runs_plugins_in_background(self, chain):
+        project = self.testrun.build.project
+        project.enabled_plugins_list = ['example', 'linux_log_parser']
+        project.save()
+        PostProcessTestRun()(self.testrun)
+
+        # example does not implement postprocess_testrun
+        plugin, update = chain.call_args[0]
+        self.assertEqual(postprocess_test_run_plugin.si('linux_log_parser', self.testrun.id), plugin)
+        self.assertEqual(update_project_status.si(self.testrun.id), update)
+        chain.return_value.apply_async.assert_called_once_with(link_error=update)
+        self.assertFalse(ProjectStatus.objects.filter(build=self.testrun.build).exists())
+
+    @patch('squad.plugins.linux_log_parser.Plugin.postprocess_testrun')
+    @patch('squad.core.tasks.chain')
+    def test_runs_plugins_inline_without_task_queue(self, chain, plugin_method):
+        chain.return_value.apply_async.side_effect = OSError('Connection refused')
+        project = self.testrun.build.project
+        project.enabled_plugins_list = ['linux_log_parser']
         project.save()
         PostProcessTestRun()(self.testrun)
         plugin_method.assert_called_with(self.testrun)
+        self.assertTrue(ProjectStatus.objects.filter(build=self.testrun.build).exists())
+
+    def test_updates_project_status_without_plugins(self):
+        PostProcessTestRun()(self.testrun)
+        self.assertTrue(ProjectStatus.objects.filter(build=self.testrun.build).exists())
+
+    @patch('squad.plugins.linux_log_parser.Plugin.postprocess_testrun')
+    def test_updates_project_status_after_plugins(self, plugin_method):
+        ProcessTestRun()(self.testrun)
+        suite = self.testrun.build.project.suites.create(slug='plugin')
+
+        def add_test(testrun):
+            # nothing was notified yet
+            self.assertFalse(ProjectStatus.objects.filter(build=testrun.build).exists())
+            testrun.tests.create(suite=suite, name='added', result=False)
+        plugin_method.side_effect = add_test
+
+        project = self.testrun.build.project
+        project.enabled_plugins_list = ['linux_log_parser']
+        project.save()
+        PostProcessTestRun()(self.testrun)
+
+        plugin_method.assert_called_once()
+        self.assertEqual(2, ProjectStatus.objects.get(build=self.testrun.build).tests_fail)
+
+
+class RunPluginTest(CommonTestCase):
+
+    def setUp(self):
+        super(RunPluginTest, self).setUp()
+        ProcessTestRun()(self.testrun)
+        self.suite = self.testrun.build.project.suites.create(slug='plugin')
+
+    def add_test(self, testrun):
+        testrun.tests.create(suite=self.suite, name='added', result=False)
+
+    @patch('squad.plugins.example.Plugin.postprocess_testrun')
+    def test_refresh_status_when_tests_change(self, plugin_method):
+        plugin_method.side_effect = self.add_test
+        RunPlugin()('example', 'postprocess_testrun', self.testrun, self.testrun)
+
+        status = self.testrun.status.get(suite=None)
+        self.assertEqual(2, status.tests_fail)
+        self.assertEqual(7, self.testrun.status.count())
+        # left for PostProcessTestRun, after all plugins
+        self.assertFalse(ProjectStatus.objects.filter(build=self.testrun.build).exists())
+
+    @patch('squad.plugins.example.Plugin.postprocess_testrun')
+    def test_refresh_status_when_results_change(self, plugin_method):
+        def fail_test(testrun):
+            testrun.tests.filter(name='test1', suite__slug='foobar').update(result=False)
+        plugin_method.side_effect = fail_test
+        RunPlugin()('example', 'postprocess_testrun', self.testrun, self.testrun)
+
+        status = self.testrun.status.get(suite=None)
+        self.assertEqual(2, status.tests_fail)
+        self.assertEqual(1, self.testrun.status.get(suite__slug='foobar').tests_fail)
+
+    @patch('squad.plugins.example.Plugin.postprocess_testrun')
+    def test_changes_rolled_back_on_error(self, plugin_method):
+        def fail(testrun):
+            self.add_test(testrun)
+            raise RuntimeError('plugin failed')
+        plugin_method.side_effect = fail
+        RunPlugin()('example', 'postprocess_testrun', self.testrun, self.testrun)
+
+        self.assertEqual(5, self.testrun.tests.count())
+        self.assertEqual(1, self.testrun.status.get(suite=None).tests_fail)
+
+    def test_plugin_not_found(self):
+        RunPlugin()('doesnotexist', 'postprocess_testrun', self.testrun, self.testrun)
 
 
 class ReceiveTestRunTest(TestCase):
@@ -339,6 +436,12 @@ class ReceiveTestRunTest(TestCase):
         testrun = TestRun.objects.last()
         self.assertEqual(1, ProjectStatus.objects.filter(build=testrun.build).count())
 
+    @patch('squad.core.tasks.PostProcessTestRun.__call__')
+    def test_postprocess(self, postprocess):
+        receive = ReceiveTestRun(self.project)
+        testrun = receive('199', 'myenv')
+        postprocess.assert_called_with(testrun)
+
     def test_dont_update_project_status(self):
         receive = ReceiveTestRun(self.project, update_project_status=False)
         receive('199', 'myenv')
@@ -1,6 +1,6 @@
 import os
 from django.test import TestCase
-from squad.plugins.linux_log_parser import Plugin
+from squad.plugins.linux_log_parser import Plugin, Issue
 from squad.core.models import Group
 
 
@@ -52,3 +52,47 @@ class TestLinuxLogParser(TestCase):
         test = testrun.tests.get(suite__slug='linux-log-parser', name='check-oops')
         test = testrun.tests.get(suite__slug='linux-log-parser', name='check-kernel-panic')
         self.assertTrue(test.result)
+
+
+class TestIssue(TestCase):
+
+    def find(self, log, name):
+        return [issue for issue in Issue.find(log) if issue.name == name][0]
+
+    def test_max_lines(self):
+        log = "------------[ cut here ]------------\n" + "\n".join(str(i) for i in range(100))
+        oops = self.find(log, 'oops')
+        self.assertTrue(oops.found)
+        self.assertEqual(50, len(oops.log.splitlines()))
+
+    def test_max_lines_with_other_line_endings(self):
+        for eol in ['\r\n', '\r\r\n', '\r', '\x0c', '\u2028']:
+            log = eol.join(["foo", "------------[ cut here ]------------"] + [str(i) for i in range(100)])
+            oops = self.find(log, 'oops')
+            lines = log.splitlines()
+            start = lines.index("------------[ cut here ]------------")
+            self.assertEqual("\n".join(lines[start:start + 50]), oops.log, repr(eol))
+
+    def test_start_of_line_with_other_line_endings(self):
+        for eol in ['\r\n', '\r\r\n', '\r', '\x0c', '\u2028']:
+            log = eol.join(["foo", "[    1.0] Kernel panic - not syncing: bar", "baz"])
+            panic = self.find(log, 'kernel-panic')
+            lines = log.splitlines()
+            start = lines.index("[    1.0] Kernel panic - not syncing: bar")
+            self.assertEqual("\n".join(lines[start:]), panic.log, repr(eol))
+
+    def test_end_marker_in_the_start_line(self):
+        log = "foo\n---[ end Kernel panic - not syncing: bar\nbaz"
+        panic = self.find(log, 'kernel-panic')
+        self.assertEqual("---[ end Kernel panic - not syncing: bar", panic.log)
+
+    def test_until_the_end_of_the_log(self):
+        log = "foo\r\nKernel panic - not syncing: bar\r\nbaz\r\n"
+        panic = self.find(log, 'kernel-panic')
+        self.assertEqual("Kernel panic - not syncing: bar\nbaz", panic.log)
+
+    def test_only_first_occurrence(self):
+        log = read_sample_file('kernelpanic.log')
+        panic = self.find(log, 'kernel-panic')
+        self.assertEqual(3, len(panic.log.splitlines()))
+        self.assertIn('542.187249', panic.log)
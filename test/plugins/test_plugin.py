@@ -1,6 +1,7 @@
 from django.test import TestCase
+from unittest.mock import patch
 from squad.core.plugins import get_plugin_instance, get_plugins_by_feature, apply_plugins
-from squad.core.plugins import Plugin, PluginNotFound
+from squad.core.plugins import Plugin, PluginNotFound, PluginLoader
 
 
 class TestGetPluginsByFeature(TestCase):
@@ -20,6 +21,45 @@ class TestGetPluginsByFeature(TestCase):
         self.assertIn('example', plugins)
         self.assertIn('linux_log_parser', plugins)
 
+    def test_restricted_to_plugin_names(self):
+        plugins = get_plugins_by_feature([Plugin.postprocess_testrun], ['nonexisting', 'example', 'linux_log_parser'])
+        self.assertEqual(['linux_log_parser'], plugins)
+
+    def test_inherited_implementation(self):
+        class Base(Plugin):
+            def postprocess_testjob(self, testjob):
+                pass
+
+        class Derived(Base):
+            pass
+
+        with patch.dict(PluginLoader.__plugins__, {'example': Derived}), patch.dict(PluginLoader.__hooks__, clear=True):
+            plugins = get_plugins_by_feature([Plugin.postprocess_testjob])
+        self.assertIn('example', plugins)
+
+
+class TestPluginLoader(TestCase):
+
+    def test_finds_builtin_plugins(self):
+        self.assertIn('linux_log_parser', PluginLoader.names())
+        self.assertIn('github', PluginLoader.names())
+
+    def test_single_instance(self):
+        self.assertIs(get_plugin_instance('example'), get_plugin_instance('example'))
+
+    def test_hooks_looked_up_once(self):
+        with patch.dict(PluginLoader.__hooks__, clear=True), patch.object(PluginLoader, 'load', wraps=PluginLoader.load) as load:
+            get_plugins_by_feature([Plugin.postprocess_testrun], ['example', 'linux_log_parser'])
+            get_plugins_by_feature([Plugin.postprocess_testrun], ['example', 'linux_log_parser'])
+        self.assertEqual(2, load.call_count)
+
+    def test_loads_only_given_plugins(self):
+        with patch.dict(PluginLoader.__hooks__, clear=True), patch.dict(PluginLoader.__plugins__, clear=True):
+            plugins = get_plugins_by_feature([Plugin.postprocess_testrun], ['linux_log_parser', 'nonexisting'])
+            loaded = list(PluginLoader.__plugins__.keys())
+        self.assertEqual(['linux_log_parser'], plugins)
+        self.assertEqual(['linux_log_parser'], loaded)
+
 
 class TestGetPuginInstance(TestCase):
 